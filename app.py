@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
 import re
+import signal
 import sys
 import threading
 import time
@@ -10,7 +12,7 @@ from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 
 import responses
-import secret
+from responses import escape_slack_markup
 
 # Try to import Google Cloud Logging. Only works if running in GCP; use local logging otherwise.
 try:
@@ -25,24 +27,6 @@ cache_generation_time = 0
 CACHE_REFRESH_TIME = 60 * 60 * 24  # 24 hours
 
 
-def escape_slack_markup(text):
-  """Escape Slack markup characters to prevent injection.
-
-  Args:
-    text: User-provided string that may contain Slack markup
-
-  Returns:
-    Escaped string safe for display
-  """
-  if not text:
-    return text
-  # Escape special Slack markup characters
-  text = str(text).replace('&', '&amp;')
-  text = text.replace('<', '&lt;')
-  text = text.replace('>', '&gt;')
-  return text
-
-
 def setup_local_logging():
   """Configure local console logging with standard format."""
   logging.basicConfig(
@@ -51,6 +35,30 @@ def setup_local_logging():
   )
 
 
+def build_user_cache(members):
+  """Map user IDs to the names screambot calls people by.
+
+  Args:
+    members: List of Slack user objects, as from users.list
+  Returns:
+    dict: Map of user IDs to usernames
+  """
+  new_cache = {}
+  for member in members:
+    uid = member['id']
+    name = member['name']
+    try:
+      profile_name = member['profile'].get('first_name') or member['profile'].get('real_name')
+    except KeyError:
+      profile_name = None
+
+    if profile_name:
+      new_cache[uid] = profile_name
+    else:
+      new_cache[uid] = name
+  return new_cache
+
+
 def refresh_cache(app):
   """Refresh the user cache from Slack API.
 
@@ -68,21 +76,7 @@ def refresh_cache(app):
       logging.warning("Couldn't get a user cache")
       return user_cache, time.time()
 
-    new_cache = {}
-    for member in result['members']:
-      uid = member['id']
-      name = member['name']
-      try:
-        profile_name = member['profile'].get('first_name') or member['profile'].get('real_name')
-      except KeyError:
-        profile_name = None
-
-      if profile_name:
-        new_cache[uid] = profile_name
-      else:
-        new_cache[uid] = name
-
-    user_cache = new_cache
+    user_cache = build_user_cache(result['members'])
     cache_generation_time = time.time()
     logging.info("User cache refreshed with %d users", len(user_cache))
     return user_cache, cache_generation_time
@@ -91,19 +85,25 @@ def refresh_cache(app):
     logging.error("Error refreshing user cache: %s", e)
     return user_cache, time.time()
 
-def show_command_management_ui(channel_id, user_id, app):
+def show_command_management_ui(channel_id, user_id, app, sort_by="trigger"):
   """Show the command management UI using Block Kit.
 
   Args:
     channel_id: Slack channel ID to post the message in
     user_id: Slack user ID (for context)
     app: The Bolt App instance
+    sort_by: "trigger" to list commands alphabetically, or "popularity"
+      to put the most used first
   """
   from storage import get_storage
   from datetime import datetime
 
   storage = get_storage()
   commands = storage.list_all_commands()
+  usage = {row['trigger']: row for row in storage.get_usage("custom", limit=None)}
+  if sort_by == "popularity":
+    # Stable, so commands used equally often stay alphabetical.
+    commands.sort(key=lambda cmd: -usage.get(cmd['trigger'], {}).get('hits', 0))
 
   blocks = [
     {
@@ -132,6 +132,13 @@ def show_command_management_ui(channel_id, user_id, app):
         logging.warning("Failed to parse timestamp '%s' for command '%s': %s",
                        created_at, cmd.get('trigger', 'unknown'), e)
 
+    used = usage.get(cmd['trigger'])
+    if used:
+      times = "once" if used['hits'] == 1 else f"{used['hits']} times"
+      used_text = f"used {times}, last on {used['last_used'][:10]}"
+    else:
+      used_text = "never used"
+
     # Escape user-provided content to prevent Slack markup injection
     safe_trigger = escape_slack_markup(cmd['trigger'])
     safe_response = escape_slack_markup(cmd['response'])
@@ -140,7 +147,7 @@ def show_command_management_ui(channel_id, user_id, app):
       "type": "section",
       "text": {
         "type": "mrkdwn",
-        "text": f"*\"{safe_trigger}\"* → \"{safe_response}\"\n_Created by {creator_name} on {created_at}_"
+        "text": f"*\"{safe_trigger}\"* → \"{safe_response}\"\n_Created by {creator_name} on {created_at}, {used_text}_"
       },
       "accessory": {
         "type": "button",
@@ -186,6 +193,15 @@ def show_command_management_ui(channel_id, user_id, app):
         },
         "style": "primary",
         "action_id": "open_create_command_modal"
+      },
+      {
+        "type": "button",
+        "text": {
+          "type": "plain_text",
+          "text": "Sort by name" if sort_by == "popularity" else "Sort by popularity"
+        },
+        "action_id": "sort_commands",
+        "value": "trigger" if sort_by == "popularity" else "popularity"
       }
     ]
   })
@@ -197,6 +213,35 @@ def show_command_management_ui(channel_id, user_id, app):
     text=f"Custom Commands ({len(commands)})"  # Fallback text
   )
 
+def handle_event(event, say, bot_user_id, app):
+  """Filter a message event from Slack and handle it if it's a real message.
+
+  Args:
+    event: Message event dict from Slack
+    say: Bolt's say function to send responses
+    bot_user_id: This bot's user ID
+    app: The Bolt App instance
+  Returns:
+    bool: True if the event was passed on to handle_message
+  """
+  # Skip bot messages and message subtypes we don't care about
+  if event.get('bot_id'):
+    return False
+
+  # Only handle regular messages and edited messages
+  subtype = event.get('subtype')
+  if subtype and subtype not in ['message_changed']:
+    return False
+
+  # For edited messages, get the actual message content
+  if subtype == 'message_changed':
+    message = event.get('message', {})
+  else:
+    message = event
+
+  handle_message(message, say, bot_user_id, app)
+  return True
+
 def handle_message(message, say, bot_user_id, app):
   """Process a message and respond if appropriate.
 
@@ -222,6 +267,9 @@ def handle_message(message, say, bot_user_id, app):
 
 
 def main():
+  # Tokens are only needed to run the bot, not to import this module.
+  import secret
+
   # Set up logging: Google Cloud Logging if in GCP, otherwise local logging
   logging.getLogger().name = "screambot"
 
@@ -258,22 +306,7 @@ def main():
   @app.event("message")
   def handle_message_events(event, say):
     """Handle messages in channels where screambot is present."""
-    # Skip bot messages and message subtypes we don't care about
-    if event.get('bot_id'):
-      return
-
-    # Only handle regular messages and edited messages
-    subtype = event.get('subtype')
-    if subtype and subtype not in ['message_changed']:
-      return
-
-    # For edited messages, get the actual message content
-    if subtype == 'message_changed':
-      message = event.get('message', {})
-    else:
-      message = event
-
-    handle_message(message, say, bot_user_id, app)
+    handle_event(event, say, bot_user_id, app)
 
   # Initialize user cache so we can respond with people's set usernames.
   refresh_cache(app)
@@ -286,6 +319,13 @@ def main():
   # Make storage available to responses module
   responses.set_storage(storage)
 
+  # Optional directory of large quote files, one <category>.txt per category.
+  quotes_dir = os.environ.get("SCREAMBOT_QUOTES_DIR")
+  if quotes_dir:
+    from quote_corpus import QuoteLibrary
+    responses.set_quote_library(QuoteLibrary(quotes_dir))
+    logging.info("Loading extra quotes from %s", quotes_dir)
+
   # Register Slack action handlers for custom commands UI
 
   @app.action("open_create_command_modal")
@@ -359,6 +399,13 @@ def main():
       }
     )
 
+  @app.action("sort_commands")
+  def handle_sort_commands(ack, action, body):
+    """Show the command list again, sorted the way the button says."""
+    ack()
+    show_command_management_ui(body["channel"]["id"], body["user"]["id"], app,
+                               sort_by=action["value"])
+
   @app.action(re.compile("^delete_command_.*"))
   def handle_delete_command(ack, action, body, client):
     """Handle delete button clicks."""
@@ -410,9 +457,9 @@ def main():
       return
 
     # Save to database
-    success = storage.add_command(trigger.lower(), response_text, user_id)
+    action = storage.add_command(trigger.lower(), response_text, user_id)
 
-    if success:
+    if action:
       ack()
       # Send confirmation (in DM to user)
       try:
@@ -420,12 +467,12 @@ def main():
         safe_response = escape_slack_markup(response_text)
         client.chat_postMessage(
           channel=user_id,
-          text=f"✅ Created command \"{safe_trigger}\" → \"{safe_response}\""
+          text=f"✅ {action.capitalize()}d command \"{safe_trigger}\" → \"{safe_response}\""
         )
       except Exception as e:
         # Fallback if DM fails
         logging.warning(f"Failed to send DM to {user_id}: {e}")
-        logging.info(f"Created command '{trigger}' by {user_id}")
+        logging.info(f"{action.capitalize()}d command '{trigger}' by {user_id}")
     else:
       logging.warning("Failed to create command '%s' for user %s (may already exist)",
                      trigger, user_id)
@@ -446,26 +493,36 @@ def main():
   # Start the Socket Mode handler with auto-reconnect
   logging.info("Screambot = yes!")
 
+  # systemd stops the bot with SIGTERM; shut down as for Ctrl-C, so
+  # storage is closed and nothing waiting to be written is lost.
+  signal.signal(signal.SIGTERM, _interrupt)
+
   # Socket Mode handler automatically reconnects on connection loss
   # But we wrap it in a loop to restart if it exits unexpectedly
-  while True:
-    try:
-      handler = SocketModeHandler(app, secret.SLACK_APP_TOKEN)
-      logging.info("Connecting to Slack...")
-      handler.start()  # Blocks until connection lost
-    except KeyboardInterrupt:
-      logging.info("Received interrupt, shutting down...")
-      break
-    except Exception as e:
-      logging.error("Socket Mode handler crashed: %s", e)
-      logging.info("Reconnecting in 10 seconds...")
-      time.sleep(10)
+  try:
+    while True:
+      try:
+        handler = SocketModeHandler(app, secret.SLACK_APP_TOKEN)
+        logging.info("Connecting to Slack...")
+        handler.start()  # Blocks until connection lost
+      except KeyboardInterrupt:
+        logging.info("Received interrupt, shutting down...")
+        break
+      except Exception as e:
+        logging.error("Socket Mode handler crashed: %s", e)
+        logging.info("Reconnecting in 10 seconds...")
+        time.sleep(10)
+  finally:
+    logging.info("Screambot shutting down")
+
+    # Close storage
+    storage.close()
+    logging.info("Storage closed")
 
-  logging.info("Screambot shutting down")
 
-  # Close storage
-  storage.close()
-  logging.info("Storage closed")
+def _interrupt(signum, frame):
+  """Signal handler that stops the bot the way Ctrl-C does."""
+  raise KeyboardInterrupt
 
 
 if __name__ == "__main__":
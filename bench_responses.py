@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark for the responses.create_response message path.
+
+Runs a seeded, mixed corpus of Slack messages through create_response with
+custom-command tables of different sizes, and reports throughput, latency
+percentiles and memory allocated per call.
+
+  python3 bench_responses.py --sizes 0 1000 50000 --save baseline.json
+  python3 bench_responses.py --sizes 0 1000 50000 --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import responses
+from storage import BACKENDS, create_storage
+
+BOT_ID = "UA1234567"
+USER_ID = "U0BENCH01"
+
+# Share of the corpus for each kind of message. Most traffic in a channel
+# isn't addressed to screambot at all.
+MIX = {
+  "unaddressed": 0.70,
+  "standalone": 0.06,
+  "starter": 0.06,
+  "contain": 0.05,
+  "custom_exact": 0.05,
+  "custom_template": 0.05,
+  "unknown": 0.03,
+}
+
+CHATTER = [
+  "has anyone looked at the deploy dashboard today?",
+  "lunch at noon?",
+  "the build is green again :tada:",
+  "I'll be a few minutes late to standup",
+  "can someone review my PR when they get a chance",
+  "it's raining again",
+  "does anyone know who owns the billing service",
+]
+
+STARTERS = [
+  "hate mondays", "blame the network", "scream it is friday", "hug the on-call",
+  "lose it about flaky tests", "announce that lunch is here", "rant about meetings",
+  "destroy Springfield", "celebrate the launch",
+]
+
+CONTAINS = [
+  "can you even believe this", "good job on the release", "I want a botsnack",
+  "tell me about the tech industry", "systemd broke again", "time for tea",
+]
+
+
+def custom_trigger(i):
+  """Name of the i-th generated custom command."""
+  return "custom%d thing" % i
+
+
+def build_corpus(size, custom_count, seed=0):
+  """Build a deterministic list of (message, kind) pairs.
+
+  Args:
+    size: Number of messages
+    custom_count: Number of custom commands that exist
+    seed: Random seed
+  """
+  rng = random.Random(seed)
+  kinds = list(MIX)
+  weights = [MIX[kind] for kind in kinds]
+  standalones = list(responses.STANDALONE_COMMANDS)
+  corpus = []
+  for kind in rng.choices(kinds, weights, k=size):
+    if kind in ("custom_exact", "custom_template") and not custom_count:
+      kind = "unknown"
+    if kind == "unaddressed":
+      message = rng.choice(CHATTER)
+    elif kind == "standalone":
+      message = "screambot %s" % rng.choice(standalones)
+    elif kind == "starter":
+      message = "<@%s> %s" % (BOT_ID, rng.choice(STARTERS))
+    elif kind == "contain":
+      message = "screambot %s" % rng.choice(CONTAINS)
+    elif kind == "custom_exact":
+      message = "screambot %s" % custom_trigger(rng.randrange(custom_count))
+    elif kind == "custom_template":
+      message = "screambot %s for everyone" % custom_trigger(rng.randrange(custom_count))
+    else:
+      message = "screambot frobnicate the %d widgets" % rng.randrange(1000)
+    corpus.append((message, kind))
+  return corpus
+
+
+def make_storage(path, custom_count, backend="sqlite"):
+  """Create storage holding custom_count generated commands.
+
+  Args:
+    path: Database file, for the "sqlite" backend
+    custom_count: Number of commands to add
+    backend: One of storage.BACKENDS
+  """
+  storage = create_storage(backend, path)
+  storage.import_commands(((custom_trigger(i), "custom response %d: $what" % i)
+                           for i in range(custom_count)), USER_ID)
+  return storage
+
+
+def percentile(sorted_values, fraction):
+  """Nearest-rank percentile of an already sorted list."""
+  if not sorted_values:
+    return 0.0
+  index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+  return sorted_values[index]
+
+
+def run(corpus, repeat):
+  """Time create_response over the corpus.
+
+  Returns:
+    Dict of ops_per_sec, p50_us, p99_us and alloc_bytes_per_call
+  """
+  create_response = responses.create_response
+  messages = [message for message, _ in corpus]
+
+  # Warm up caches and compiled state.
+  for message in messages:
+    create_response(message, BOT_ID, "bench", USER_ID)
+
+  latencies = []
+  clock = time.perf_counter_ns
+  start = clock()
+  for _ in range(repeat):
+    for message in messages:
+      t0 = clock()
+      create_response(message, BOT_ID, "bench", USER_ID)
+      latencies.append(clock() - t0)
+  elapsed = (clock() - start) / 1e9
+  latencies.sort()
+
+  # Allocation pass, separate from timing because tracing is slow.
+  tracemalloc.start()
+  allocated = 0
+  for message in messages:
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    create_response(message, BOT_ID, "bench", USER_ID)
+    allocated += tracemalloc.get_traced_memory()[1] - before
+  tracemalloc.stop()
+
+  return {
+    "ops_per_sec": len(latencies) / elapsed,
+    "p50_us": percentile(latencies, 0.50) / 1e3,
+    "p99_us": percentile(latencies, 0.99) / 1e3,
+    "alloc_bytes_per_call": allocated / len(messages),
+  }
+
+
+def compare(results, baseline, tolerance):
+  """Compare results against a saved baseline.
+
+  Returns:
+    List of human-readable regressions; empty if none
+  """
+  regressions = []
+  for size, current in results.items():
+    previous = baseline.get("results", {}).get(size)
+    if not previous:
+      continue
+    if current["ops_per_sec"] < previous["ops_per_sec"] * (1 - tolerance):
+      regressions.append("%s commands: %.0f ops/s, baseline %.0f" % (
+        size, current["ops_per_sec"], previous["ops_per_sec"]))
+    if current["p99_us"] > previous["p99_us"] * (1 + tolerance):
+      regressions.append("%s commands: p99 %.1fus, baseline %.1fus" % (
+        size, current["p99_us"], previous["p99_us"]))
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--sizes", type=int, nargs="+", default=[0, 100, 5000, 50000],
+                      help="custom command table sizes to benchmark")
+  parser.add_argument("--messages", type=int, default=5000, help="corpus size")
+  parser.add_argument("--repeat", type=int, default=5, help="passes over the corpus")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--backend", choices=BACKENDS, default="sqlite",
+                      help="storage backend holding the custom commands")
+  parser.add_argument("--save", metavar="PATH", help="write results as a baseline JSON")
+  parser.add_argument("--compare", metavar="PATH", help="fail if slower than this baseline")
+  parser.add_argument("--tolerance", type=float, default=0.2,
+                      help="allowed fractional regression when comparing")
+  args = parser.parse_args(argv)
+
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    for size in args.sizes:
+      storage = make_storage(os.path.join(tmp, "bench%d.db" % size), size, args.backend)
+      responses.set_storage(storage)
+      try:
+        corpus = build_corpus(args.messages, size, args.seed)
+        results[str(size)] = result = run(corpus, args.repeat)
+      finally:
+        responses.set_storage(None)
+        storage.close()
+      print("%6d commands: %10.0f ops/s  p50 %7.1fus  p99 %7.1fus  %7.0f B/call" % (
+        size, result["ops_per_sec"], result["p50_us"], result["p99_us"],
+        result["alloc_bytes_per_call"]))
+
+  if args.save:
+    with open(args.save, "w") as f:
+      json.dump({"python": platform.python_version(), "messages": args.messages,
+                 "backend": args.backend,
+                 "seed": args.seed, "results": results}, f, indent=2)
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+      print("REGRESSION: " + regression)
+    if regressions:
+      return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark for StorageManager writes under each SQLite profile.
+
+Times single command writes (each its own transaction, as from the Slack
+modal), deletes, a bulk import, full-text searches over the imported
+commands and batched audit entries against a fresh database for every
+profile in storage.PROFILES.
+
+  python3 bench_storage.py
+  python3 bench_storage.py --profiles durable balanced --writes 2000 --json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from storage import PROFILES, StorageManager
+
+USER_ID = "U0BENCH01"
+
+
+def _rate(count, seconds):
+  return count / seconds if seconds else float("inf")
+
+
+def run(path, profile, writes, imports):
+  """Time each kind of write against a new database at path.
+
+  Returns:
+    Dict of operations per second for add, delete, import, search and audit
+  """
+  storage = StorageManager(path, profile=profile)
+  try:
+    start = time.perf_counter()
+    for i in range(writes):
+      storage.add_command("bench %d" % i, "response %d" % i, USER_ID)
+    add = _rate(writes, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(writes):
+      storage.delete_command("bench %d" % i, USER_ID)
+    delete = _rate(writes, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    storage.import_commands((("imported %d" % i, "response %d" % i) for i in range(imports)),
+                            USER_ID)
+    imported = _rate(imports, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(writes):
+      storage.search_commands("response %d" % (i % 10))
+    search = _rate(writes, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(writes):
+      storage.log_audit("create", "audit %d" % i, USER_ID, "response")
+    storage.flush()
+    audit = _rate(writes, time.perf_counter() - start)
+  finally:
+    storage.close()
+
+  return {"add_per_sec": add, "delete_per_sec": delete, "import_per_sec": imported,
+          "search_per_sec": search, "audit_per_sec": audit}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--profiles", nargs="+", choices=list(PROFILES), default=list(PROFILES))
+  parser.add_argument("--writes", type=int, default=1000,
+                      help="single adds, deletes, searches and audit entries per profile")
+  parser.add_argument("--imports", type=int, default=50000, help="commands per bulk import")
+  parser.add_argument("--json", action="store_true", help="print the results as JSON")
+  args = parser.parse_args(argv)
+
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    for profile in args.profiles:
+      results[profile] = result = run(os.path.join(tmp, "%s.db" % profile), profile,
+                                      args.writes, args.imports)
+      if not args.json:
+        print("%-9s add %8.0f/s  delete %8.0f/s  import %9.0f/s  search %7.0f/s  "
+              "audit %9.0f/s" % (
+          profile, result["add_per_sec"], result["delete_per_sec"], result["import_per_sec"],
+          result["search_per_sec"], result["audit_per_sec"]))
+
+  if args.json:
+    print(json.dumps(results, indent=2))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Import and export custom commands as JSON Lines or CSV.
+
+JSON Lines files hold one object per line with "trigger" and "response"
+keys, and optionally "created_by". CSV files have a header row with the
+same column names. Both are read and written a row at a time.
+
+  python3 commands_io.py export commands.jsonl
+  python3 commands_io.py import commands.csv --user U0123ABCD --on-conflict overwrite
+"""
+
+import argparse
+import contextlib
+import csv
+import json
+import logging
+import sys
+
+from storage import CONFLICT_POLICIES, CommandConflictError, StorageManager
+
+FORMATS = ("jsonl", "csv")
+EXPORT_FIELDS = ["trigger", "response", "created_by", "created_at"]
+
+
+def guess_format(path):
+  """Pick a format from a file name; JSON Lines unless it ends in .csv."""
+  return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def read_jsonl(f):
+  """Yield (trigger, response, created_by) from JSON Lines."""
+  for number, line in enumerate(f, 1):
+    if not line.strip():
+      continue
+    try:
+      row = json.loads(line)
+      yield row["trigger"], row["response"], row.get("created_by")
+    except (ValueError, KeyError, TypeError) as e:
+      logging.warning("Skipping line %d: %s", number, e)
+
+
+def read_csv(f):
+  """Yield (trigger, response, created_by) from CSV with a header row."""
+  for row in csv.DictReader(f):
+    if row.get("trigger") is None or row.get("response") is None:
+      logging.warning("Skipping row without trigger and response: %r", row)
+      continue
+    yield row["trigger"], row["response"], row.get("created_by")
+
+
+def write_jsonl(records, f):
+  """Write CommandRecords as JSON Lines; returns how many were written."""
+  count = 0
+  for record in records:
+    f.write(json.dumps(record._asdict(), ensure_ascii=False) + "\n")
+    count += 1
+  return count
+
+
+def write_csv(records, f):
+  """Write CommandRecords as CSV with a header row; returns how many were written."""
+  writer = csv.writer(f)
+  writer.writerow(EXPORT_FIELDS)
+  count = 0
+  for record in records:
+    writer.writerow(record)
+    count += 1
+  return count
+
+
+READERS = {"jsonl": read_jsonl, "csv": read_csv}
+WRITERS = {"jsonl": write_jsonl, "csv": write_csv}
+
+
+def _open(path, mode):
+  if path == "-":
+    return contextlib.nullcontext(sys.stdin if "r" in mode else sys.stdout)
+  return open(path, mode, encoding="utf-8", newline="")
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--db", default="screambot.db", help="database path")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  export_parser = subparsers.add_parser("export", help="write every command to a file")
+  export_parser.add_argument("path", help="output file, or - for stdout")
+  export_parser.add_argument("--format", choices=FORMATS)
+
+  import_parser = subparsers.add_parser("import", help="add commands from a file")
+  import_parser.add_argument("path", help="input file, or - for stdin")
+  import_parser.add_argument("--format", choices=FORMATS)
+  import_parser.add_argument("--user", required=True, help="Slack user ID doing the import")
+  import_parser.add_argument("--on-conflict", choices=CONFLICT_POLICIES, default="skip")
+  import_parser.add_argument("--chunk-size", type=int, default=1000)
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO)
+  file_format = args.format or guess_format(args.path)
+  storage = StorageManager(args.db)
+  try:
+    if args.command == "export":
+      with _open(args.path, "w") as f:
+        count = WRITERS[file_format](storage.iter_commands(), f)
+      logging.info("Exported %d commands", count)
+      return 0
+
+    with _open(args.path, "r") as f:
+      try:
+        counts = storage.import_commands(READERS[file_format](f), args.user,
+                                         on_conflict=args.on_conflict,
+                                         chunk_size=args.chunk_size)
+      except CommandConflictError as e:
+        logging.error("Nothing imported: %s", e)
+        return 1
+    print(", ".join("%d %s" % (count, name) for name, count in counts.items()))
+    return 0
+  finally:
+    storage.close()
+
+
+if __name__ == "__main__":
+  sys.exit(main())
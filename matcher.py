@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Precompiled lookup structures for matching commands to responses."""
+
+import collections
+import functools
+import itertools
+import math
+import re
+import string
+import threading
+from typing import Iterable, Iterator, Optional, Tuple
+
+# Key under which a trie node stores the value for the key ending there.
+# Characters are always one-character strings, so None can't collide.
+_VALUE = None
+
+
+class ResponseTemplate:
+  """A response with $what placeholders, parsed once.
+
+  Rendering gives the same result as
+  string.Template(template).safe_substitute(what=...), but is just a join of
+  the precomputed literal chunks. Responses without $what render to the
+  constant string.
+  """
+
+  __slots__ = ("template", "placeholders", "_chunks")
+
+  def __init__(self, template: str):
+    self.template = template
+    self.placeholders = set()
+    chunks = []
+    literal = []
+    position = 0
+    for mo in string.Template.pattern.finditer(template):
+      literal.append(template[position:mo.start()])
+      position = mo.end()
+      named = mo.group("named") or mo.group("braced")
+      if named is not None:
+        self.placeholders.add(named)
+      if named == "what":
+        chunks.append("".join(literal))
+        literal = []
+      elif mo.group("escaped") is not None:
+        literal.append(string.Template.delimiter)
+      else:
+        # Other names and invalid placeholders are left as they are.
+        literal.append(mo.group())
+    literal.append(template[position:])
+    chunks.append("".join(literal))
+    self._chunks = tuple(chunks)
+
+  def render(self, what: str = "") -> str:
+    """Fill in $what."""
+    if len(self._chunks) == 1:
+      return self._chunks[0]
+    return what.join(self._chunks)
+
+  __call__ = render
+
+  def __repr__(self):
+    return "ResponseTemplate(%r)" % self.template
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(template: str) -> ResponseTemplate:
+  """Return a compiled template, shared between callers with the same text."""
+  return ResponseTemplate(template)
+
+
+class PrefixTrie:
+  """Character trie mapping string keys to values.
+
+  Nodes are plain dicts keyed by character, which keeps lookups to one dict
+  access per character of input. Updates copy the nodes along the changed
+  path instead of modifying them, so copy() is O(1) and a copy is never
+  affected by later updates to the original.
+  """
+
+  def __init__(self, items: Iterable[Tuple[str, object]] = ()):
+    """
+    Args:
+      items: (key, value) pairs to start with
+    """
+    self._root = {}
+    self._size = 0
+    # Nothing else can see these nodes yet, so build them in place.
+    for key, value in items:
+      node = self._root
+      for char in key:
+        node = node.setdefault(char, {})
+      if _VALUE not in node:
+        self._size += 1
+      node[_VALUE] = value
+
+  def __len__(self) -> int:
+    return self._size
+
+  def copy(self) -> "PrefixTrie":
+    """Return a trie with the same contents, sharing unchanged nodes."""
+    trie = PrefixTrie()
+    trie._root = self._root
+    trie._size = self._size
+    return trie
+
+  def insert(self, key: str, value):
+    """Store value under key, replacing any existing value."""
+    root = node = dict(self._root)
+    for char in key:
+      child = node.get(char)
+      child = dict(child) if child is not None else {}
+      node[char] = child
+      node = child
+    if _VALUE not in node:
+      self._size += 1
+    node[_VALUE] = value
+    self._root = root
+
+  def remove(self, key: str) -> bool:
+    """Remove key, pruning nodes that no longer lead anywhere.
+
+    Returns:
+      True if the key was present, False otherwise
+    """
+    node = self._root
+    for char in key:
+      node = node.get(char)
+      if node is None:
+        return False
+    if _VALUE not in node:
+      return False
+
+    path = [dict(self._root)]
+    for char in key:
+      child = dict(path[-1][char])
+      path[-1][char] = child
+      path.append(child)
+    del path[-1][_VALUE]
+    self._size -= 1
+
+    # Walk back up, dropping empty nodes.
+    for depth in range(len(key), 0, -1):
+      if path[depth]:
+        break
+      del path[depth - 1][key[depth - 1]]
+    self._root = path[0]
+    return True
+
+  def prefixes(self, text: str) -> Iterator[Tuple[int, object]]:
+    """Yield (length, value) for every stored key that is a prefix of text.
+
+    Results come shortest first, from a single walk down the trie.
+    """
+    node = self._root
+    if _VALUE in node:
+      yield 0, node[_VALUE]
+    for depth, char in enumerate(text, 1):
+      node = node.get(char)
+      if node is None:
+        return
+      if _VALUE in node:
+        yield depth, node[_VALUE]
+
+
+# Source of CommandIndex.version numbers, never reused within a process.
+_index_versions = itertools.count(1)
+
+
+class CommandIndex:
+  """In-memory index of custom commands.
+
+  Exact triggers are answered from a dict; template triggers (a trigger
+  followed by more text) from a prefix trie, where the longest matching
+  trigger wins.
+
+  Readers on other threads should be handed a copy() and never see it
+  change; writers update their own copy and publish it.
+
+  version is different for every index, and changes whenever the index
+  does, so answers worked out from one can be cached under it.
+  """
+
+  def __init__(self, commands: Iterable[Tuple[str, str]] = ()):
+    """
+    Args:
+      commands: (trigger, response) pairs to start with
+    """
+    self._exact = {trigger.lower(): ResponseTemplate(response)
+                   for trigger, response in commands}
+    self._prefixes = PrefixTrie(self._exact.items())
+    self.version = next(_index_versions)
+
+  def __setstate__(self, state):
+    # Versions from another process mean nothing here.
+    self.__dict__.update(state)
+    self.version = next(_index_versions)
+
+  def copy(self) -> "CommandIndex":
+    """Return an index with the same commands that can be updated separately."""
+    index = CommandIndex()
+    index._exact = dict(self._exact)
+    index._prefixes = self._prefixes.copy()
+    return index
+
+  def __len__(self) -> int:
+    return len(self._exact)
+
+  def __contains__(self, trigger: str) -> bool:
+    return trigger.lower() in self._exact
+
+  def items(self) -> Iterator[Tuple[str, str]]:
+    """(trigger, response) for every command, with triggers lowercased."""
+    return ((trigger, template.template) for trigger, template in self._exact.items())
+
+  def add(self, trigger: str, response: str):
+    """Add or replace a command, compiling its response template."""
+    trigger = trigger.lower()
+    template = ResponseTemplate(response)
+    self._exact[trigger] = template
+    self._prefixes.insert(trigger, template)
+    self.version = next(_index_versions)
+
+  def remove(self, trigger: str) -> bool:
+    """Remove a command.
+
+    Returns:
+      True if the command was indexed, False otherwise
+    """
+    trigger = trigger.lower()
+    if self._exact.pop(trigger, None) is None:
+      return False
+    self._prefixes.remove(trigger)
+    self.version = next(_index_versions)
+    return True
+
+  def match(self, command: str) -> Optional[str]:
+    """Find the response for a command.
+
+    Args:
+      command: The command text, with "screambot" already removed
+
+    Returns:
+      The response, with $what filled in for template matches, or None
+    """
+    found = self.lookup(command)
+    return found[1] if found else None
+
+  def lookup(self, command: str) -> Optional[Tuple[str, str]]:
+    """Like match, but also says which trigger matched.
+
+    Returns:
+      (trigger, response) or None
+    """
+    lowered = command.lower()
+    template = self._exact.get(lowered)
+    if template is not None:
+      # Exact matches are sent as written, without substitution.
+      return lowered, template.template
+
+    # Longest trigger that has non-whitespace text after it.
+    best = None
+    for length, template in self._prefixes.prefixes(lowered):
+      remainder = command[length:].lstrip()
+      if remainder:
+        best = (length, remainder, template)
+    if best is None:
+      return None
+    length, remainder, template = best
+    return lowered[:length], template.render(remainder)
+
+
+class SubstringMatcher:
+  """Aho-Corasick automaton over an ordered set of substring rules.
+
+  Finds which rules occur anywhere in a text in one pass over the text. When
+  several rules occur, the one that came first in the rules mapping wins, so
+  precedence follows dict insertion order.
+  """
+
+  def __init__(self, rules):
+    """
+    Args:
+      rules: Mapping of substring to value; keys are matched case-insensitively
+    """
+    self._keys = []
+    self._values = []
+    # Per state: outgoing edges, failure link, and the best (lowest) rule
+    # number that ends at this state or any of its suffixes.
+    self._goto = [{}]
+    self._fail = [0]
+    self._best = [None]
+
+    for key, value in rules.items():
+      self._add(key.lower(), len(self._keys))
+      self._keys.append(key)
+      self._values.append(value)
+    self._link()
+
+  def _add(self, pattern, order):
+    state = 0
+    for char in pattern:
+      next_state = self._goto[state].get(char)
+      if next_state is None:
+        next_state = len(self._goto)
+        self._goto.append({})
+        self._fail.append(0)
+        self._best.append(None)
+        self._goto[state][char] = next_state
+      state = next_state
+    if self._best[state] is None or order < self._best[state]:
+      self._best[state] = order
+
+  def _link(self):
+    """Compute failure links breadth-first and fold outputs along them."""
+    queue = list(self._goto[0].values())
+    for state in queue:
+      for char, child in self._goto[state].items():
+        fallback = self._fail[state]
+        while fallback and char not in self._goto[fallback]:
+          fallback = self._fail[fallback]
+        self._fail[child] = self._goto[fallback].get(char, 0)
+        inherited = self._best[self._fail[child]]
+        if inherited is not None and (self._best[child] is None or
+                                      inherited < self._best[child]):
+          self._best[child] = inherited
+        queue.append(child)
+
+  def match(self, text: str):
+    """Find the highest-precedence rule occurring in text.
+
+    Args:
+      text: Text to search; should already be lowercased
+
+    Returns:
+      (key, value) of the winning rule, or None if no rule occurs
+    """
+    goto = self._goto
+    fail = self._fail
+    best_at = self._best
+    best = None
+    state = 0
+    for char in text:
+      while state and char not in goto[state]:
+        state = fail[state]
+      state = goto[state].get(char, 0)
+      found = best_at[state]
+      if found is not None and (best is None or found < best):
+        best = found
+        if best == 0:
+          break
+    if best is None:
+      return None
+    return self._keys[best], self._values[best]
+
+
+class StarterDispatcher:
+  """Single prefix trie over several ordered tables of starter commands.
+
+  Tables are given in precedence order. Within a table, the first key in
+  dict order that prefixes the command wins, as with a linear scan.
+  """
+
+  def __init__(self, tables):
+    """
+    Args:
+      tables: Mapping of table name to a mapping of starter text to
+        handler, in precedence order
+    """
+    self._names = list(tables)
+    entries = {}
+    for table_rank, table in enumerate(tables.values()):
+      for key_rank, (key, value) in enumerate(table.items()):
+        entries.setdefault(key.lower(), []).append((table_rank, key_rank, key, value))
+    self._trie = PrefixTrie()
+    for key, matches in entries.items():
+      self._trie.insert(key, tuple(matches))
+
+  def match(self, command: str):
+    """Find starters that prefix command, in one walk down the trie.
+
+    Args:
+      command: The command text (case-insensitive)
+
+    Returns:
+      List of (table name, key, handler, remainder) tuples, at most one per
+      table, in table precedence order. remainder is the command after the
+      key.
+    """
+    best = {}
+    for _, matches in self._trie.prefixes(command.lower()):
+      for table_rank, key_rank, key, value in matches:
+        current = best.get(table_rank)
+        if current is None or key_rank < current[0]:
+          best[table_rank] = (key_rank, key, value)
+    return [(self._names[table_rank], key, value, command[len(key):])
+            for table_rank, (_, key, value) in sorted(best.items())]
+
+
+class LRUCache:
+  """Bounded least-recently-used cache with hit/miss/eviction counters."""
+
+  def __init__(self, maxsize: int = 1024):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._data = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self) -> int:
+    return len(self._data)
+
+  def get(self, key, default=None):
+    """Return the cached value for key, marking it recently used."""
+    with self._lock:
+      try:
+        value = self._data[key]
+      except KeyError:
+        self.misses += 1
+        return default
+      self._data.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    """Cache value under key, evicting the least recently used entry if full."""
+    if self.maxsize <= 0:
+      return
+    with self._lock:
+      self._data[key] = value
+      self._data.move_to_end(key)
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+        self.evictions += 1
+
+  def clear(self):
+    """Drop every entry. Counters are kept."""
+    with self._lock:
+      self._data.clear()
+
+  def stats(self) -> dict:
+    """Counters and current size, for monitoring."""
+    return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "size": len(self._data), "maxsize": self.maxsize}
+
+
+def search_terms(text: str) -> list:
+  """The words in a search, lowercased."""
+  return re.findall(r"\w+", text.lower())
+
+
+def terms_match(terms, *texts) -> bool:
+  """Whether every term starts a word in texts, as in an FTS5 prefix query."""
+  words = search_terms(" ".join(text or "" for text in texts))
+  return all(any(word.startswith(term) for word in words) for term in terms)
+
+
+def _trigrams(text):
+  """Character trigrams of text, padded so short words still have some."""
+  padded = "  %s " % text
+  return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class SuggestionIndex:
+  """Trigram inverted index for finding triggers similar to some text.
+
+  Similarity is the Jaccard index of the two trigram sets. Only the rarest
+  trigrams of the query are used to find candidates: anything similar
+  enough must share at least one of them, so common trigrams, which have
+  long posting lists, are rarely scanned. When many triggers are nearly
+  identical, at most max_candidates of them are compared, which bounds
+  lookup time at the cost of sometimes missing the very best suggestion.
+
+  Safe to update from one thread while others look things up.
+  """
+
+  def __init__(self, triggers: Iterable[str] = (), threshold: float = 0.4,
+               max_candidates: int = 200):
+    """
+    Args:
+      triggers: Triggers to start with
+      threshold: Minimum similarity, from 0 to 1, for a suggestion
+      max_candidates: Most triggers to compare against per lookup
+    """
+    self.threshold = threshold
+    self.max_candidates = max_candidates
+    self._grams = {}     # trigger -> its trigrams
+    self._postings = {}  # trigram -> set of triggers containing it
+    self._lock = threading.Lock()
+    for trigger in triggers:
+      self.add(trigger)
+
+  def __len__(self) -> int:
+    return len(self._grams)
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    del state["_lock"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def add(self, trigger: str):
+    """Index a trigger. Adding one that's already there does nothing."""
+    trigger = trigger.lower().strip()
+    with self._lock:
+      if trigger in self._grams:
+        return
+      grams = _trigrams(trigger)
+      self._grams[trigger] = grams
+      for gram in grams:
+        self._postings.setdefault(gram, set()).add(trigger)
+
+  def remove(self, trigger: str):
+    """Stop suggesting a trigger."""
+    trigger = trigger.lower().strip()
+    with self._lock:
+      grams = self._grams.pop(trigger, None)
+      for gram in grams or ():
+        posting = self._postings[gram]
+        posting.discard(trigger)
+        if not posting:
+          del self._postings[gram]
+
+  def suggest(self, text: str, limit: int = 3):
+    """Find the indexed triggers most similar to text.
+
+    Returns:
+      Up to limit (trigger, similarity) pairs, most similar first
+    """
+    query = _trigrams(text.lower().strip())
+    # Overlap needed to reach the threshold even against an identical set.
+    needed = max(1, int(math.ceil(self.threshold * len(query))))
+    # Similar sets can't be too different in size.
+    smallest = self.threshold * len(query)
+    largest = len(query) / self.threshold
+    with self._lock:
+      postings = sorted((self._postings.get(gram, ()) for gram in query), key=len)
+      candidates = set()
+      for posting in postings[:len(query) - needed + 1]:
+        room = self.max_candidates - len(candidates)
+        if len(posting) > room:
+          candidates.update(itertools.islice(posting, room))
+          break
+        candidates.update(posting)
+
+      scored = []
+      for trigger in candidates:
+        grams = self._grams[trigger]
+        if not smallest <= len(grams) <= largest:
+          continue
+        shared = len(query & grams)
+        score = shared / (len(query) + len(grams) - shared)
+        if score >= self.threshold:
+          scored.append((trigger, score))
+    scored.sort(key=lambda item: (-item[1], item[0]))
+    return scored[:limit]
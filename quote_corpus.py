@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Large quote collections, read from disk on demand.
+
+A corpus directory holds one UTF-8 file per category, named
+<category>.txt, with one quote per line. The first time a category is used,
+the offset of every quote is written to <category>.txt.idx next to it
+(or kept in memory, if that directory is read-only). After that, both
+files are memory-mapped, and picking a random quote reads
+one offset and one line. Nothing is read at startup and the quotes never
+sit in Python memory, however big the files are.
+"""
+
+import logging
+import mmap
+import os
+import random
+import struct
+import threading
+from typing import Optional
+
+# Index file layout: header, then one little-endian uint64 offset per quote.
+_MAGIC = b"SBQI"
+_VERSION = 1
+_HEADER = struct.Struct("<4sIQqQ")  # magic, version, source size, source mtime_ns, count
+_OFFSET = struct.Struct("<Q")
+
+
+def _map(path):
+  """Memory-map a whole file read-only, or return None if it's empty."""
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return None
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class QuoteCorpus:
+  """One category file and its offset index."""
+
+  def __init__(self, path: str):
+    self.path = path
+    self.index_path = path + ".idx"
+    stat = os.stat(path)
+    self._data = _map(path)
+    self._index = self._open_index(stat.st_size, stat.st_mtime_ns)
+    self._count = _HEADER.unpack_from(self._index)[4] if self._index else 0
+
+  def __len__(self) -> int:
+    return self._count
+
+  def _open_index(self, size, mtime_ns):
+    """Map the saved index, rebuilding it first if the source has changed.
+
+    If the index can't be saved, say because the directory is read-only,
+    the rebuilt one is kept in memory instead.
+    """
+    index = None
+    try:
+      index = _map(self.index_path)
+      if index is not None:
+        magic, version, indexed_size, indexed_mtime, _ = _HEADER.unpack_from(index)
+        if (magic, version, indexed_size, indexed_mtime) == (_MAGIC, _VERSION, size, mtime_ns):
+          return index
+    except (OSError, struct.error):
+      pass
+    if index is not None:
+      index.close()
+    built = self._build_index(size, mtime_ns)
+    try:
+      self._save_index(built)
+      return _map(self.index_path)
+    except OSError as e:
+      logging.warning("Can't save quote index %s, keeping it in memory: %s", self.index_path, e)
+      return built
+
+  def _build_index(self, size, mtime_ns) -> bytes:
+    """Scan the source for line starts; returns the index file's contents."""
+    logging.info("Indexing quotes in %s", self.path)
+    offsets = bytearray()
+    count = 0
+    data = self._data
+    position = 0
+    while data is not None and position < len(data):
+      end = data.find(b"\n", position)
+      if end < 0:
+        end = len(data)
+      if data[position:end].strip():
+        offsets += _OFFSET.pack(position)
+        count += 1
+      position = end + 1
+    return _HEADER.pack(_MAGIC, _VERSION, size, mtime_ns, count) + bytes(offsets)
+
+  def _save_index(self, index: bytes):
+    """Write the index file, replacing any old one in one step."""
+    tmp_path = "%s.%d.tmp" % (self.index_path, os.getpid())
+    try:
+      with open(tmp_path, "wb") as out:
+        out.write(index)
+      os.replace(tmp_path, self.index_path)
+    except OSError:
+      try:
+        os.remove(tmp_path)
+      except OSError:
+        pass
+      raise
+
+  def quote(self, number: int) -> str:
+    """Return quote number (0-based)."""
+    start = _OFFSET.unpack_from(self._index, _HEADER.size + number * _OFFSET.size)[0]
+    end = self._data.find(b"\n", start)
+    if end < 0:
+      end = len(self._data)
+    return self._data[start:end].decode("utf-8").rstrip("\r")
+
+  def random_quote(self, rng=random) -> Optional[str]:
+    """Return a random quote, or None if the file has none."""
+    if not self._count:
+      return None
+    return self.quote(rng.randrange(self._count))
+
+  def close(self):
+    for mapped in (self._data, self._index):
+      # An index that couldn't be saved is plain bytes.
+      if isinstance(mapped, mmap.mmap):
+        mapped.close()
+
+
+class QuoteLibrary:
+  """All the category files in a directory, opened the first time they're used."""
+
+  def __init__(self, directory: str):
+    self.directory = directory
+    self._corpora = {}
+    self._lock = threading.Lock()
+
+  def categories(self):
+    """List the categories that have a file."""
+    return sorted(name[:-len(".txt")] for name in os.listdir(self.directory)
+                  if name.endswith(".txt"))
+
+  def corpus(self, category: str) -> Optional[QuoteCorpus]:
+    """Return the corpus for a category, or None if there's no file for it."""
+    corpus = self._corpora.get(category)
+    if corpus is not None:
+      return corpus
+    if os.sep in category or category.startswith("."):
+      return None
+    path = os.path.join(self.directory, category + ".txt")
+    with self._lock:
+      corpus = self._corpora.get(category)
+      if corpus is None and os.path.isfile(path):
+        corpus = self._corpora[category] = QuoteCorpus(path)
+    return corpus
+
+  def random_quote(self, category: str) -> Optional[str]:
+    """Return a random quote from a category, or None if it has none."""
+    corpus = self.corpus(category)
+    return corpus.random_quote() if corpus is not None else None
+
+  def close(self):
+    with self._lock:
+      for corpus in self._corpora.values():
+        corpus.close()
+      self._corpora.clear()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Replay a Slack workspace export through screambot, without Slack.
+
+An export is a directory with users.json, channels.json and one directory
+per channel holding a JSON file of messages per day. Every message goes
+through app.handle_event, the same path as live traffic, with a say() that
+only counts. Day files are read one at a time, so exports of any size work.
+
+Custom commands are copied from the database into memory first, so the
+replay never writes to it: replayed matches would otherwise count toward
+the real trigger usage.
+
+  python3 replay.py path/to/export --bot-id U0123ABCD --db screambot.db
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import app
+import responses
+import storage
+from tracing import CallbackSink
+
+
+class CountingSay:
+  """Stands in for Bolt's say(); counts instead of sending."""
+
+  def __init__(self):
+    self.count = 0
+
+  def __call__(self, text=None, **kwargs):
+    self.count += 1
+
+
+class _CountingClient:
+  """Stands in for the Slack web client used by the custom command UI."""
+
+  def __init__(self):
+    self.calls = collections.Counter()
+
+  def __getattr__(self, method):
+    def call(**kwargs):
+      self.calls[method] += 1
+      return {"ok": True}
+    return call
+
+
+class ReplayApp:
+  """Stands in for the Bolt App passed to app.handle_event."""
+
+  def __init__(self):
+    self.client = _CountingClient()
+
+
+def _load_json(path, default):
+  if not os.path.exists(path):
+    return default
+  with open(path, encoding="utf-8") as f:
+    return json.load(f)
+
+
+def find_bot_id(export_dir):
+  """Find screambot's user ID in the export's users.json, or None."""
+  for member in _load_json(os.path.join(export_dir, "users.json"), []):
+    if member.get("is_bot") and member.get("name") == "screambot":
+      return member["id"]
+  return None
+
+
+def replay_storage(db_path):
+  """A throwaway MemoryStorage with a copy of the custom commands in db_path.
+
+  The database is opened read-only, and is only read if it exists.
+  """
+  backend = storage.MemoryStorage()
+  if os.path.exists(db_path):
+    conn = sqlite3.connect("file:%s?mode=ro" % db_path, uri=True)
+    try:
+      backend.import_commands(
+        conn.execute("SELECT trigger, response, created_by FROM custom_commands"), "replay")
+    finally:
+      conn.close()
+  return backend
+
+
+def iter_events(export_dir, channels=None):
+  """Yield message events from an export, one day file at a time.
+
+  Args:
+    export_dir: Path to the unpacked export
+    channels: Optional collection of channel names to limit the replay to
+  """
+  channel_ids = {channel["name"]: channel["id"]
+                 for channel in _load_json(os.path.join(export_dir, "channels.json"), [])}
+  for name in sorted(os.listdir(export_dir)):
+    channel_dir = os.path.join(export_dir, name)
+    if not os.path.isdir(channel_dir) or (channels and name not in channels):
+      continue
+    for day in sorted(os.listdir(channel_dir)):
+      if not day.endswith(".json"):
+        continue
+      for event in _load_json(os.path.join(channel_dir, day), []):
+        if event.get("type", "message") != "message":
+          continue
+        event.setdefault("channel", channel_ids.get(name, name))
+        yield event
+
+
+def replay(events, bot_user_id):
+  """Run events through app.handle_event.
+
+  Returns:
+    Dict of counts and timings for the run
+  """
+  say = CountingSay()
+  replay_app = ReplayApp()
+  tables = collections.Counter()
+
+  def count_match(trace):
+    tables[trace.table] += 1
+
+  total = handled = 0
+  responses.set_tracer(CallbackSink(count_match))
+  start = time.perf_counter()
+  try:
+    for event in events:
+      total += 1
+      if app.handle_event(event, say, bot_user_id, replay_app):
+        handled += 1
+  finally:
+    responses.set_tracer(None)
+  elapsed = time.perf_counter() - start
+
+  return {
+    "events": total,
+    "handled": handled,
+    "matched": sum(tables.values()),
+    "said": say.count,
+    "ui": replay_app.client.calls["chat_postMessage"],
+    "seconds": elapsed,
+    "tables": dict(tables),
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("export_dir", help="unpacked Slack export directory")
+  parser.add_argument("--bot-id", help="screambot's user ID (default: from users.json)")
+  parser.add_argument("--channels", nargs="+", help="only replay these channels")
+  parser.add_argument("--db", default="screambot.db",
+                      help="database to copy custom commands from; never written to")
+  parser.add_argument("--json", action="store_true", help="print the report as JSON")
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.WARNING)
+  bot_user_id = args.bot_id or find_bot_id(args.export_dir)
+  if not bot_user_id:
+    parser.error("couldn't find screambot in users.json; pass --bot-id")
+
+  app.user_cache = app.build_user_cache(
+    _load_json(os.path.join(args.export_dir, "users.json"), []))
+  backend = replay_storage(args.db)
+  # The custom command UI gets its storage from storage.get_storage().
+  storage.set_storage(backend)
+  responses.set_storage(backend)
+  try:
+    report = replay(iter_events(args.export_dir, args.channels), bot_user_id)
+  finally:
+    responses.set_storage(None)
+    storage.set_storage(None)
+    backend.close()
+
+  if args.json:
+    print(json.dumps(report, indent=2))
+    return 0
+
+  events = report["events"] or 1
+  print("%d events in %.2fs: %.0f events/sec" % (
+    report["events"], report["seconds"], report["events"] / (report["seconds"] or 1e-9)))
+  print("%d handled, %d reached the matcher (%.2f%%), %d replies, %d UI posts" % (
+    report["handled"], report["matched"], 100.0 * report["matched"] / events,
+    report["said"], report["ui"]))
+  for table, count in sorted(report["tables"].items(), key=lambda item: -item[1]):
+    print("  %-20s %d" % (table, count))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,19 +1,102 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import collections
+import concurrent.futures
+import itertools
 import random
 import re
 import string
 
+from matcher import (CommandIndex, LRUCache, StarterDispatcher, SubstringMatcher,
+                     SuggestionIndex, compile_template, search_terms, terms_match)
+from tracing import Trace
+
 # Global storage reference (set by app.py)
 _storage = None
 
+# Gets a tracing.Trace for every direct command, if set.
+_tracer = None
+
+# Optional quote_corpus.QuoteLibrary with more quotes than the quotes dict.
+_quote_library = None
+
+def escape_slack_markup(text):
+  """Escape Slack markup characters to prevent injection.
+
+  Args:
+    text: User-provided string that may contain Slack markup
+
+  Returns:
+    Escaped string safe for display
+  """
+  if not text:
+    return text
+  # Escape special Slack markup characters
+  text = str(text).replace('&', '&amp;')
+  text = text.replace('<', '&lt;')
+  text = text.replace('>', '&gt;')
+  return text
+
+
 def set_storage(storage):
   """Set the storage manager (called from app.py)."""
   global _storage
   _storage = storage
 
+def set_quote_library(library):
+  """Use a quote_corpus.QuoteLibrary for random quotes, or None for just the built-ins."""
+  global _quote_library
+  _quote_library = library
+
+def set_tracer(sink):
+  """Trace every direct command into sink, or stop tracing if None.
+
+  sink is any object with a record(trace) method; see tracing.py.
+  """
+  global _tracer
+  _tracer = sink
+
+# How a direct command was answered: the table that matched ("custom",
+# "standalone", "starter", "contain", "unknown", ...), the key within it,
+# the response, and whether the same command always gets that response.
+Match = collections.namedtuple("Match", ["table", "key", "response", "cacheable"],
+                               defaults=[True])
+
+# Tables whose usage is counted under another's name, so that a trigger
+# has one count however it was matched.
+_USAGE_KINDS = {"standalone_stripped": "standalone"}
+
+# Recent deterministic matches, keyed on the version of the custom command
+# index they were made against and the parsed command. Matches made
+# against older indexes are never looked up again and age out.
+_response_cache = LRUCache(maxsize=1024)
+
+
+def uncacheable(handler):
+  """Mark a command handler whose response can change between calls.
+
+  Responses from these handlers (random picks, for example) are never
+  served from the response cache.
+  """
+  handler.cacheable = False
+  return handler
+
+
+def set_response_cache_size(maxsize):
+  """Resize the response cache, emptying it. 0 turns caching off."""
+  global _response_cache
+  _response_cache = LRUCache(maxsize)
+
+
+def response_cache_stats():
+  """Return hits, misses, evictions and size of the response cache."""
+  return _response_cache.stats()
+
 COMMAND_REGEX = r"^<@([WU][^>]*)>[:,]? (.+)"
+_COMMAND_PATTERN = re.compile(COMMAND_REGEX)
+_EMOJI_PATTERN = re.compile(r":[\w_-]+:")
+_REMOVE_PUNCTUATION = str.maketrans('', '', string.punctuation)
 MAX_INPUT_LENGTH = 2000  # Slack's message limit
 
 # It's a command to @screambot and this is the entire thing.
@@ -61,7 +144,7 @@ STARTER_COMMANDS_LONG = {
   "react to ": "EXCUSE ME HI we need to talk about $what. How's everyone feeling about that?",
   "save me from ": ":fire: pew :fire:pew :fire: I have exploded all the $what. :fire: You're welcome. :fire:",
   "sigh about ": "Yeah, $what is not the best, is it? :tea:?",
-  "what can you ": lambda _: help_message(),
+  "what can you ": uncacheable(lambda _: help_message()),
 }
 
 STARTER_COMMANDS = {
@@ -70,7 +153,8 @@ STARTER_COMMANDS = {
   "celebrate ": ":sparkles: :raised_hands: :raised_hands: hurray for $what!! :tada: :tada: :sparkles:",
   "cheer ": ":sparkles: :raised_hands: :raised_hands: hurray $what!! :tada: :tada: :sparkles:",
   # "destroy CITY" - destroys the specified city (also in CONTAIN_COMMANDS with different behavior)
-  "destroy ": lambda city: rage(city=city),
+  # Not cached: with no city, it picks one at random.
+  "destroy ": uncacheable(lambda city: rage(city=city)),
   "flip": "(╯°□°）╯︵ ┻━┻)",
   "fuck ": "$what needs to fuck off right now :rage:",
   "hug ": ":virtualhug: for $what",
@@ -79,7 +163,7 @@ STARTER_COMMANDS = {
   "love ": "$what is pretty much the best thing.",
   "scream ": lambda what: what.upper(),
   "tableflip": "(╯°□°）╯︵ ┻━┻)",
-  "help": lambda _: help_message(),
+  "help": uncacheable(lambda _: help_message()),
 }
 
 # Behave exactly as starter commands but aren't in the "what can you do" list.
@@ -90,12 +174,12 @@ STARTER_COMMANDS_EE = {
   "i love you": "It's mutual, I promise you.",
   "&lt;3": "Right back at you <3",
   "good bot": ":heart:",
-  "hello": lambda _: hi(),
-  "howdy": lambda _: hi(),
-  "hi": lambda _: hi(),
-  "what's up": lambda _: hi(),
-  "hey": lambda _: hi(),
-  "ello": lambda _: hi(),
+  "hello": uncacheable(lambda _: hi()),
+  "howdy": uncacheable(lambda _: hi()),
+  "hi": uncacheable(lambda _: hi()),
+  "what's up": uncacheable(lambda _: hi()),
+  "hey": uncacheable(lambda _: hi()),
+  "ello": uncacheable(lambda _: hi()),
 }
 
 # It's a direct command to @screambot and it contains this text.
@@ -113,26 +197,47 @@ CONTAIN_COMMANDS = {
   "can you even": "I literally can't even.",
   "work": "WERK!",
   "industry": ":poop: :fire:",
-  "patriarchy": lambda _: random_quote("feminism"),
-  "feminism": lambda _: random_quote("feminism"),
-  "tech": lambda _: random_quote("tech"),
-  "inspire": lambda _: random_quote("tech"),
-  "inspiration": lambda _: random_quote("tech"),
-  "rage": lambda _: rage(city=None, rage_level=random.random()),
+  "patriarchy": uncacheable(lambda _: random_quote("feminism")),
+  "feminism": uncacheable(lambda _: random_quote("feminism")),
+  "tech": uncacheable(lambda _: random_quote("tech")),
+  "inspire": uncacheable(lambda _: random_quote("tech")),
+  "inspiration": uncacheable(lambda _: random_quote("tech")),
+  "rage": uncacheable(lambda _: rage(city=None, rage_level=random.random())),
   # "...destroy..." - random city with random rage level (also in STARTER_COMMANDS with different behavior)
-  "destroy": lambda _: rage(city=None, rage_level=random.random()),
+  "destroy": uncacheable(lambda _: rage(city=None, rage_level=random.random())),
   "&lt;3": ":heart:",
   "food": ":pizza:",
   "systemd": "systemd is strange and mysterious. Bring back init scripts!",
   "systemctl": "systemctl is strange and mysterious. Bring back init scripts!",
   "tea": "Always here for afternoontea :tea: :female-technologist:",
-  "why": lambda _: why(),
+  "why": uncacheable(lambda _: why()),
   "thank": "Any time.",
   "love": ":heart_eyes:",
   "good": ":heart_eyes:",
   "sedgwick": "Don't get me started! Sedgwick's servers should all melt permanently. Preferably without backups.",
 }
 
+def _compile_handlers(table):
+  """Replace string templates in a command table with compiled templates."""
+  return {key: value if callable(value) else compile_template(value)
+          for key, value in table.items()}
+
+# Compiled once so a command is checked against every starter in one walk.
+# Table order matters: multiword commands come first.
+_STARTER_DISPATCHER = StarterDispatcher({
+  "starter_long": _compile_handlers(STARTER_COMMANDS_LONG),
+  "starter_ee": _compile_handlers(STARTER_COMMANDS_EE),
+  "starter": _compile_handlers(STARTER_COMMANDS),
+})
+
+# Compiled once so a message is scanned for every rule in a single pass.
+_CONTAIN_MATCHER = SubstringMatcher(_compile_handlers(CONTAIN_COMMANDS))
+
+# Built-in commands to suggest when someone asks for one we don't know.
+# Easter eggs stay hidden, and contain commands aren't really commands.
+_BUILTIN_SUGGESTIONS = SuggestionIndex(
+  list(STANDALONE_COMMANDS) + [key.strip() for key in STARTER_COMMANDS])
+
 quotes = {
   "feminism": [
     """"I am deliberate and afraid of nothing." -- Audre Lorde""",
@@ -208,7 +313,11 @@ def hi(testing=False):
 
 
 def random_quote(key):
-  """Returns a quote from the quotes dict."""
+  """Returns a quote from the quote library if it has the key, else the quotes dict."""
+  if _quote_library is not None:
+    quote = _quote_library.random_quote(key)
+    if quote is not None:
+      return quote
   if key in quotes:
     return random.choice(quotes[key])
   else:
@@ -230,24 +339,29 @@ def help_message():
          "Commands: " + "; ".join(sorted(commands)))
 
 
+def _apply(value, what):
+  """Run a command handler, which is a callable or a $what template."""
+  if callable(value):
+    return value(what)
+  else:
+    return compile_template(value).render(what)
+
+
 def check_starters(command, starts):
+  lowered = command.lower()
   for text in starts.keys():
-    if command.lower().startswith(text.lower()):
+    if lowered.startswith(text.lower()):
       thing = command[len(text):] # Everything but the starter words
-      value = starts[text.lower()]
-
-      # Check if it's callable (function/lambda)
-      if callable(value):
-        return value(thing)
-      else:
-        # It's a string template
-        return string.Template(value).safe_substitute(what=thing)
+      return _apply(starts[text.lower()], thing)
   return None  # No match found
 
 
-def _should_respond(message, bot_id):
+def _should_respond(message, bot_id, bot_id_lower=None):
   """Check if screambot should respond to this message."""
-  return bot_id.lower() in message.lower() or "screambot" in message.lower()
+  if bot_id_lower is None:
+    bot_id_lower = bot_id.lower()
+  message_lower = message.lower()
+  return bot_id_lower in message_lower or "screambot" in message_lower
 
 
 def _parse_message(message, bot_id):
@@ -260,7 +374,7 @@ def _parse_message(message, bot_id):
     The extracted command text (with "screambot" removed), or None.
   """
   # Handle commands starting with a username like <@WABC123>.
-  matches = re.search(COMMAND_REGEX, message)
+  matches = _COMMAND_PATTERN.search(message)
   if matches:
     user = matches.group(1)
     if user != bot_id:
@@ -283,71 +397,175 @@ def _parse_message(message, bot_id):
   return None
 
 
-def _handle_direct_command(command, speaker, user_id=None):
-  """Handle a direct command to screambot."""
+def _handle_direct_command(command, speaker, user_id=None, custom_commands=None,
+                           count_usage=True):
+  """Handle a direct command to screambot.
+
+  custom_commands is the CommandIndex to match against; by default, the
+  storage manager's current one. If count_usage is set, the match counts
+  toward its trigger's usage.
+  """
+  trace = Trace(command) if _tracer is not None else None
+
+  if custom_commands is None and _storage:
+    custom_commands = _storage.command_snapshot()
+  version = custom_commands.version if custom_commands is not None else None
+
+  key = (version, command, bool(user_id))
+  match = _response_cache.get(key)
+  if trace is not None:
+    trace.mark("cache")
+  if match is None:
+    match = _match_direct_command(command, speaker, user_id, custom_commands, trace)
+    if match.cacheable:
+      _response_cache.put(key, match)
+
+  if count_usage and _storage and match.key is not None:
+    _storage.record_usage(_USAGE_KINDS.get(match.table, match.table), match.key)
+  if trace is not None:
+    trace.table, trace.key = match.table, match.key
+    _tracer.record(trace)
+  return match.response
+
+
+def _match_direct_command(command, speaker, user_id, custom_commands, trace=None):
+  """Work out how to answer a direct command. Returns a Match.
+
+  If trace is set, each stage is marked on it as it finishes.
+  """
   # Validate input length to prevent memory exhaustion
   if len(command) > MAX_INPUT_LENGTH:
-    return "That's too much for me to handle!"
+    return Match("too_long", None, "That's too much for me to handle!", False)
 
   # Check for "custom" command - triggers Slack UI
   if command.lower() == "custom":
-    return "__OPEN_MANAGE_COMMANDS_UI__"
+    return Match("custom_ui", "custom", "__OPEN_MANAGE_COMMANDS_UI__")
+
+  # "custom search <text>" - too many commands to browse in the UI.
+  words = command.split(None, 2)
+  if [word.lower() for word in words[:2]] == ["custom", "search"]:
+    text = words[2].strip() if len(words) > 2 else ""
+    return Match("custom_search", _CUSTOM_SEARCH, _search_commands(text), False)
 
   # Check custom commands FIRST (before built-in commands)
-  if _storage and user_id:
-    # Get all custom commands
-    all_custom_commands = _storage.list_all_commands()
-
-    # First, try exact matches
-    for cmd in all_custom_commands:
-      if command.lower() == cmd['trigger']:
-        return cmd['response']
-
-    # Second, try prefix matches (for templates)
-    for cmd in all_custom_commands:
-      trigger = cmd['trigger']
-      # Check if command starts with trigger and has non-whitespace after it
-      if command.lower().startswith(trigger):
-        remainder = command[len(trigger):].lstrip()
-        if remainder:  # There's non-whitespace text after the trigger
-          # Extract the "what" part and substitute
-          return string.Template(cmd['response']).safe_substitute(what=remainder)
+  if custom_commands is not None and user_id:
+    # Exact matches first, then the longest trigger with text after it,
+    # which is used as a template with that text as $what.
+    found = custom_commands.lookup(command)
+    if trace is not None:
+      trace.mark("custom")
+    if found is not None:
+      return Match("custom", *found)
 
   # A complete command like "hug" or "freak out".
-  if command in STANDALONE_COMMANDS:
-    return STANDALONE_COMMANDS[command]
+  response = STANDALONE_COMMANDS.get(command)
+  if trace is not None:
+    trace.mark("standalone")
+  if response is not None:
+    return Match("standalone", command, response)
 
   # Try with stripped punctuation.
-  remove_punctuation = str.maketrans('', '', string.punctuation)
-  stripped = command.translate(remove_punctuation)
-  if stripped in STANDALONE_COMMANDS:
-    return STANDALONE_COMMANDS[stripped]
+  stripped = command.translate(_REMOVE_PUNCTUATION)
+  response = STANDALONE_COMMANDS.get(stripped)
+  if trace is not None:
+    trace.mark("standalone_stripped")
+  if response is not None:
+    return Match("standalone_stripped", stripped, response)
 
   # A single emoji.
-  if re.match(":[\w_-]+:", command):
-    return command + command + command + "!"
-
-  # Starter commands.
-  for command_set in [STARTER_COMMANDS_LONG, STARTER_COMMANDS_EE, STARTER_COMMANDS]:
-    response = check_starters(command, command_set)
+  emoji = _EMOJI_PATTERN.match(command)
+  if trace is not None:
+    trace.mark("emoji")
+  if emoji:
+    return Match("emoji", None, command + command + command + "!")
+
+  # Starter commands, best match from each table in precedence order.
+  match = None
+  for table, key, handler, thing in _STARTER_DISPATCHER.match(command):
+    response = handler(thing)
     if response:
-      return response
-
-  # Contain commands.
-  for text in CONTAIN_COMMANDS.keys():
-    if text.lower() in command.lower():
-      value = CONTAIN_COMMANDS[text.lower()]
-      if callable(value):
-        return value(command.lower())
-      else:
-        return string.Template(value).safe_substitute(what=command.lower())
-
-  # Unknown command.
-  return ("Sorry, %s, I don't know how to %s yet. You can tell me how by typing "
-          "`screambot custom`. Feel free to DM me if you prefer to try it out in a DM "
-          "instead of in a channel." % (speaker, command))
-
-
+      match = Match(table, key, response, getattr(handler, "cacheable", True))
+      break
+  if trace is not None:
+    trace.mark("starters")
+  if match:
+    return match
+
+  # Contain commands. Earlier entries in CONTAIN_COMMANDS take precedence.
+  lowered = command.lower()
+  found = _CONTAIN_MATCHER.match(lowered)
+  if found:
+    key, handler = found
+    match = Match("contain", key, handler(lowered), getattr(handler, "cacheable", True))
+  if trace is not None:
+    trace.mark("contain")
+  if match:
+    return match
+
+  # Unknown command. Not cached, since it names the speaker.
+  suggestions = _suggest(command, custom_commands is not None and user_id)
+  hint = (" Did you mean %s?" % " or ".join("`%s`" % _escape_listed(s) for s in suggestions)
+          if suggestions else "")
+  return Match("unknown", None,
+               "Sorry, %s, I don't know how to %s yet.%s You can tell me how by typing "
+               "`screambot custom`. Feel free to DM me if you prefer to try it out in a DM "
+               "instead of in a channel." % (speaker, command, hint), False)
+
+
+_CUSTOM_SEARCH = "custom search"
+
+
+def _escape_listed(text):
+  """Escape user-written text for a list of several commands.
+
+  Like the management UI, so a search can't post <!channel> and the like.
+  Backticks become quotes too: Slack can't escape them, and one in a
+  trigger would run a code span into the next command.
+  """
+  return escape_slack_markup(text).replace("`", "'")
+
+
+def _search_commands(text, limit=10):
+  """List the custom commands whose triggers or responses mention text."""
+  if not text:
+    return "What should I look for? Try `screambot custom search pizza`."
+  commands = _custom_commands()
+  if not commands:
+    return "I don't have any custom commands to search."
+  found, more = commands.search_commands(text, limit)
+  if not found:
+    return "No custom commands match \"%s\"." % _escape_listed(text)
+  lines = ["Custom commands matching \"%s\":" % _escape_listed(text)]
+  lines += ["*\"%s\"* → \"%s\"" % (_escape_listed(command["trigger"]),
+                                  _escape_listed(command["response"]))
+            for command in found]
+  if more:
+    lines.append("...and more. Add words to narrow it down.")
+  return "\n".join(lines)
+
+
+def _suggest(command, include_custom, limit=2):
+  """Return up to limit known triggers that look like command."""
+  scored = _BUILTIN_SUGGESTIONS.suggest(command, limit)
+  commands = _custom_commands()
+  if include_custom and commands:
+    scored += commands.suggest_commands(command, limit)
+  scored.sort(key=lambda item: (-item[1], item[0]))
+  suggestions = []
+  for trigger, _ in scored:
+    if trigger not in suggestions:
+      suggestions.append(trigger)
+  return suggestions[:limit]
+
+
+def known_rules():
+  """List every built-in rule as a (table, key) pair, as used in traces."""
+  rules = [("standalone", key) for key in STANDALONE_COMMANDS]
+  rules += [("starter_long", key) for key in STARTER_COMMANDS_LONG]
+  rules += [("starter_ee", key) for key in STARTER_COMMANDS_EE]
+  rules += [("starter", key) for key in STARTER_COMMANDS]
+  rules += [("contain", key) for key in CONTAIN_COMMANDS]
+  return rules
 
 
 def create_response(message, bot_id, speaker=None, user_id=None):
@@ -361,15 +579,123 @@ def create_response(message, bot_id, speaker=None, user_id=None):
   Returns:
     (str) A string to respond with or None.
   """
+  return _respond(message, bot_id, bot_id.lower(), speaker, user_id, None, True)
+
+
+def _respond(message, bot_id, bot_id_lower, speaker, user_id, custom_commands, count_usage):
+  """create_response, with per-call setup already done by the caller."""
   # Only trigger on sentences containing "screambot" or @screambot's UID.
-  if not _should_respond(message, bot_id):
+  if not _should_respond(message, bot_id, bot_id_lower):
     return None
 
   # Parse the message to extract the command.
   command = _parse_message(message, bot_id)
 
   if command:
-    return _handle_direct_command(command, speaker, user_id)
+    return _handle_direct_command(command, speaker, user_id, custom_commands, count_usage)
   else:
     return "Want me to do something, %s? Try 'screambot help'." % speaker
 
+
+def _custom_commands():
+  """Where suggestions and searches come from: storage, or in a batch
+  worker process, the batch's snapshot."""
+  return _storage if _storage is not None else _batch_commands
+
+
+def create_responses(messages, bot_id, speakers=None, processes=None, chunk_size=1000,
+                     mp_context=None):
+  """Return responses for many messages, e.g. for backfills and replays.
+
+  Every message is matched against the same snapshot of custom commands,
+  taken when the batch starts. Matches don't count toward trigger usage,
+  in this process or in worker processes: backfills and replays aren't
+  real traffic.
+
+  Args:
+    messages: Iterable of (message, user_id) pairs. Read lazily.
+    bot_id: (str) Screambot's userid.
+    speakers: (dict) Optional map of user ID to the name to respond with.
+    processes: (int) If set, split the batch across this many processes.
+    chunk_size: (int) Messages per unit of work sent to a process.
+    mp_context: How to start the processes, as for ProcessPoolExecutor.
+  Yields:
+    (str) The response to each message, or None, in input order.
+  """
+  speakers = speakers or {}
+  custom_commands = _storage.command_snapshot() if _storage else CommandIndex()
+
+  if not processes:
+    yield from _respond_all(messages, bot_id, speakers, custom_commands)
+    return
+
+  messages = iter(messages)
+  with concurrent.futures.ProcessPoolExecutor(
+      processes, mp_context=mp_context, initializer=_init_batch_worker,
+      initargs=(bot_id, speakers, custom_commands)) as pool:
+    # Keep a bounded number of chunks in flight so huge inputs stream.
+    pending = collections.deque()
+    while True:
+      chunk = list(itertools.islice(messages, chunk_size))
+      if chunk:
+        pending.append(pool.submit(_run_batch_chunk, chunk))
+      if pending and (not chunk or len(pending) >= processes * 2):
+        yield from pending.popleft().result()
+      if not chunk and not pending:
+        return
+
+
+def _respond_all(messages, bot_id, speakers, custom_commands):
+  bot_id_lower = bot_id.lower()
+  for message, user_id in messages:
+    yield _respond(message, bot_id, bot_id_lower, speakers.get(user_id), user_id,
+                   custom_commands, False)
+
+
+class _SnapshotCommands:
+  """Suggestions and searches over the custom commands in one CommandIndex.
+
+  Answers what _suggest and _search_commands ask of storage, the way
+  MemoryStorage does, for batch workers that only have the snapshot.
+  """
+
+  def __init__(self, custom_commands):
+    self._commands = sorted(custom_commands.items())
+    self._suggestions = SuggestionIndex(trigger for trigger, _ in self._commands)
+
+  def suggest_commands(self, text, limit=3):
+    return self._suggestions.suggest(text, limit)
+
+  def search_commands(self, query, limit=20, cursor=None):
+    terms = search_terms(query)
+    if not terms:
+      return [], None
+    found = []
+    for trigger, response in self._commands:
+      if cursor is not None and trigger <= cursor:
+        continue
+      if terms_match(terms, trigger, response):
+        if len(found) == limit:
+          return found, found[-1]["trigger"]
+        found.append({"trigger": trigger, "response": response})
+    return found, None
+
+
+# Set in each worker process by _init_batch_worker.
+_batch_worker_args = None
+_batch_commands = None
+
+def _init_batch_worker(bot_id, speakers, custom_commands):
+  global _batch_worker_args, _batch_commands
+  _batch_worker_args = (bot_id, speakers, custom_commands)
+  # A forked worker inherits the parent's storage, whose SQLite connections
+  # can't be used across a fork; a spawned one has none. Either way, answer
+  # from the batch's snapshot.
+  set_storage(None)
+  _batch_commands = _SnapshotCommands(custom_commands)
+
+
+def _run_batch_chunk(chunk):
+  bot_id, speakers, custom_commands = _batch_worker_args
+  return list(_respond_all(chunk, bot_id, speakers, custom_commands))
+
@@ -1,107 +1,1397 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import collections
+import functools
+import gc
+import hashlib
+import io
+import itertools
 import sqlite3
 import threading
 import logging
+import os
+import pickle
+import queue
+import sys
+import time
+from concurrent.futures import Future
 from contextlib import contextmanager
-from typing import List, Dict, Optional
-from datetime import datetime
+from typing import Iterable, Iterator, List, Dict, Optional, Protocol
+from datetime import datetime, timezone
+
+import matcher
+from matcher import CommandIndex, SuggestionIndex, search_terms, terms_match
+
+# What import_commands does with a trigger that already exists.
+CONFLICT_POLICIES = ("skip", "overwrite", "fail")
+
+
+class CommandConflictError(ValueError):
+  """An import hit an existing trigger with the "fail" conflict policy."""
+
+
+def validate_command(trigger: str, response: str) -> Optional[str]:
+  """Check a trigger and response against the limits the modal enforces.
+
+  Returns:
+    A description of the problem, or None if they're fine
+  """
+  if not isinstance(trigger, str) or not isinstance(response, str):
+    return f"Trigger and response must be text, not {type(trigger).__name__} " \
+           f"and {type(response).__name__}"
+  if not trigger or len(trigger) < 2 or len(trigger) > 100:
+    return f"Invalid trigger length: {len(trigger) if trigger else 0}"
+  if not response or len(response) > 500:
+    return f"Invalid response length: {len(response) if response else 0}"
+  return None
+
+
+# Named sets of PRAGMAs applied to every connection, in order. All use WAL
+# so readers never block the writer; they trade durability for speed:
+#   durable:  fsync on every commit; survives power loss.
+#   balanced: fsync at checkpoints only; a power cut can lose the last few
+#             commits but never corrupts the database.
+#   fast:     no fsync at all; for benchmarks and throwaway databases.
+PROFILES = {
+  "durable": [
+    ("journal_mode", "WAL"),
+    ("synchronous", "FULL"),
+    ("busy_timeout", 5000),
+    ("cache_size", -2000),
+    ("temp_store", "DEFAULT"),
+    ("mmap_size", 0),
+  ],
+  "balanced": [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", 5000),
+    ("cache_size", -16000),
+    ("temp_store", "MEMORY"),
+    ("mmap_size", 64 * 1024 * 1024),
+  ],
+  "fast": [
+    ("journal_mode", "WAL"),
+    ("synchronous", "OFF"),
+    ("busy_timeout", 5000),
+    ("cache_size", -64000),
+    ("temp_store", "MEMORY"),
+    ("mmap_size", 256 * 1024 * 1024),
+  ],
+}
+DEFAULT_PROFILE = "balanced"
+
+
+# Columns get_audit_page can filter on, each with its own index.
+AUDIT_FILTERS = ("trigger", "user_id", "action")
+
+
+# One row of custom_commands, as cached in a CommandSnapshot.
+CommandRecord = collections.namedtuple(
+  "CommandRecord", ["trigger", "response", "created_by", "created_at"])
+
+
+class CommandSnapshot:
+  """Immutable view of the custom_commands table.
+
+  Writers never change a snapshot; they build a new one with a higher
+  generation and swap it in, so readers need no locks.
+  """
+
+  __slots__ = ("generation", "commands", "index", "_sorted")
+
+  def __init__(self, generation: int, commands: Dict[str, CommandRecord],
+               index: Optional[CommandIndex] = None):
+    self.generation = generation
+    self.commands = commands
+    self.index = index if index is not None else CommandIndex(
+      (record.trigger, record.response) for record in commands.values())
+    self._sorted = None
+
+  @classmethod
+  def from_records(cls, generation: int, records: Iterable[CommandRecord]) -> "CommandSnapshot":
+    return cls(generation, {record.trigger: record for record in records})
+
+  def with_command(self, record: CommandRecord, generation: int) -> "CommandSnapshot":
+    """Return a snapshot at generation, with record added or replaced."""
+    commands = dict(self.commands)
+    commands[record.trigger] = record
+    index = self.index.copy()
+    index.add(record.trigger, record.response)
+    return CommandSnapshot(generation, commands, index)
+
+  def without_command(self, trigger: str, generation: int) -> "CommandSnapshot":
+    """Return a snapshot at generation, with trigger removed."""
+    commands = dict(self.commands)
+    commands.pop(trigger, None)
+    index = self.index.copy()
+    index.remove(trigger)
+    return CommandSnapshot(generation, commands, index)
+
+  def sorted_commands(self) -> tuple:
+    """All records ordered by trigger, computed once per snapshot."""
+    if self._sorted is None:
+      self._sorted = tuple(sorted(self.commands.values()))
+    return self._sorted
+
+
+class _Operation:
+  """A write waiting for the writer thread, and where its result goes."""
+
+  __slots__ = ("function", "future", "on_commit")
+
+  def __init__(self, function, future, on_commit):
+    self.function = function
+    self.future = future
+    self.on_commit = on_commit
+
+
+class DatabaseWriter:
+  """The one thread that writes to the database.
+
+  Every write is queued and run, in order, on this thread's connection, so
+  threads in this process never compete for SQLite's write lock. Whatever
+  is waiting when the thread picks up work runs in one transaction, each
+  operation inside its own savepoint so that one failing doesn't undo the
+  others, and the whole lot costs one commit.
+
+  Audit entries from log() are fire-and-forget. When only those are
+  waiting, the thread holds on for up to flush_interval seconds or until
+  batch_size have piled up, then writes them with one write_entries call.
+  """
+
+  # What log() does when the queue is full.
+  FULL_POLICIES = ("block", "drop")
+
+  _STOP = object()
+
+  def __init__(self, connect, write_entries, maxsize: int = 1000, batch_size: int = 100,
+               flush_interval: float = 0.5, when_full: str = "block"):
+    """
+    Args:
+      connect: Called once, with no arguments, to open the write connection.
+        That happens on the writer thread, before the first write.
+      write_entries: Called with the connection and a list of log() entries
+      maxsize: Most writes waiting at once
+      batch_size: Most writes to put in one transaction
+      flush_interval: Longest a log() entry waits before being written, in seconds
+      when_full: "block" makes log() wait for room; "drop" discards the entry
+    """
+    if when_full not in self.FULL_POLICIES:
+      raise ValueError(f"when_full must be one of {self.FULL_POLICIES}, not {when_full!r}")
+    self._write_entries = write_entries
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.when_full = when_full
+    self.written = 0
+    self.dropped = 0
+    self._queue = queue.Queue(maxsize)
+    # Held while checking _closed and queueing, so nothing is queued
+    # behind _STOP. The writer thread never takes it, so a put that waits
+    # for room can't hold up the writer making that room.
+    self._lock = threading.Lock()
+    self._closed = False
+    # log() entries queued but not yet written.
+    self._pending = 0
+    self._pending_lock = threading.Lock()
+    # Not opened until there's something to write.
+    self._connect = connect
+    self._conn = None
+    self._thread = threading.Thread(target=self._run, name="database-writer", daemon=True)
+    self._thread.start()
+
+  def submit(self, function, on_commit=None) -> Future:
+    """Queue function(connection) to run on the writer thread.
+
+    Args:
+      function: Does the writing; what it returns is the future's result
+      on_commit: Called with that result on the writer thread once the
+        transaction has committed, before the future completes
+
+    Returns:
+      A Future for function's result, or for the exception it raised
+    """
+    future = Future()
+    with self._lock:
+      if self._closed:
+        raise sqlite3.ProgrammingError("Database writer is closed")
+      self._queue.put(_Operation(function, future, on_commit))
+    return future
+
+  def execute(self, function, on_commit=None):
+    """Run function(connection) on the writer thread and wait for its result."""
+    return self.submit(function, on_commit).result()
+
+  def log(self, entry):
+    """Queue an entry for write_entries, without waiting for it."""
+    with self._lock:
+      if self._closed:
+        self.dropped += 1
+        logging.error(f"Database writer is closed, dropped entry: {entry!r}")
+        return
+      # Counted first, so the writer never sees it written before it's pending.
+      with self._pending_lock:
+        self._pending += 1
+      try:
+        self._queue.put(entry, block=self.when_full == "block")
+      except queue.Full:
+        with self._pending_lock:
+          self._pending -= 1
+        self.dropped += 1
+        logging.warning(f"Write queue full, dropped entry: {entry!r}")
+
+  def flush(self):
+    """Wait until every log() entry queued so far has been written.
+
+    Does nothing when none are waiting, so reads that flush first don't
+    cost a write transaction. submit()ted writes have their own futures.
+    """
+    if self._pending and not self._closed:
+      self.execute(lambda conn: None)
+
+  def close(self):
+    """Write everything still queued and stop the writer thread."""
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+      self._queue.put(self._STOP)
+    self._thread.join()
+    if self._conn is not None:
+      self._conn.close()
+
+  def _run(self):
+    while True:
+      batch = [self._queue.get()]
+      urgent = isinstance(batch[0], _Operation)
+      deadline = time.monotonic() + self.flush_interval
+      while len(batch) < self.batch_size and batch[-1] is not self._STOP:
+        try:
+          # Someone is waiting on a result: take only what's already queued.
+          if urgent:
+            item = self._queue.get_nowait()
+          else:
+            item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+          break
+        batch.append(item)
+        urgent = urgent or isinstance(item, _Operation)
+      stop = batch[-1] is self._STOP
+      if stop:
+        batch.pop()
+      if batch:
+        self._write(batch)
+        with self._pending_lock:
+          self._pending -= sum(not isinstance(item, _Operation) for item in batch)
+      if stop:
+        return
+
+  def _write(self, batch):
+    operations = [item for item in batch if isinstance(item, _Operation)]
+    entries = [item for item in batch if not isinstance(item, _Operation)]
+    if self._conn is None:
+      try:
+        self._conn = self._connect()
+      except Exception as e:
+        logging.error(f"Can't open the database for writing: {e}")
+        self.dropped += len(entries)
+        for operation in operations:
+          if operation.future.set_running_or_notify_cancel():
+            operation.future.set_exception(e)
+        return
+    conn = self._conn
+    done = []
+    try:
+      conn.execute("BEGIN IMMEDIATE")
+      for operation in operations:
+        if not operation.future.set_running_or_notify_cancel():
+          continue
+        conn.execute("SAVEPOINT operation")
+        try:
+          result = operation.function(conn)
+        except Exception as e:
+          conn.execute("ROLLBACK TO operation")
+          conn.execute("RELEASE operation")
+          operation.future.set_exception(e)
+          continue
+        conn.execute("RELEASE operation")
+        done.append((operation, result))
+      if entries:
+        self._write_entries(conn, entries)
+      conn.commit()
+    except Exception as e:
+      if conn.in_transaction:
+        conn.rollback()
+      logging.error(f"Database write failed: {e}")
+      self.dropped += len(entries)
+      for operation, _ in done:
+        operation.future.set_exception(e)
+      return
+
+    self.written += len(entries)
+    for operation, result in done:
+      try:
+        if operation.on_commit is not None:
+          operation.on_commit(result)
+      except Exception as e:
+        logging.error(f"Failed to apply a committed write: {e}")
+      operation.future.set_result(result)
+
+
+class ConnectionPool:
+  """A bounded set of SQLite connections shared by all threads.
+
+  Threads check a connection out, use it, and return it. At most max_size
+  are open at once; a thread that finds them all checked out waits up to
+  timeout seconds. Connections left idle for idle_timeout seconds are
+  closed the next time the pool is used.
+  """
+
+  def __init__(self, connect, max_size: int = 8, idle_timeout: float = 60.0,
+               timeout: float = 30.0):
+    """
+    Args:
+      connect: Called with no arguments to open a new connection
+      max_size: Most connections open at once
+      idle_timeout: Seconds an unused connection is kept open
+      timeout: Seconds to wait for a connection before raising TimeoutError
+    """
+    if max_size < 1:
+      raise ValueError("max_size must be at least 1")
+    self._connect = connect
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self.timeout = timeout
+    self._lock = threading.Condition()
+    # Most recently returned last, so the oldest are reaped first.
+    self._idle = collections.deque()  # of (connection, returned at)
+    self._open = 0
+    self._closed = False
+
+  @property
+  def open_count(self) -> int:
+    """Connections open, whether idle or checked out."""
+    return self._open
+
+  @property
+  def idle_count(self) -> int:
+    """Connections open and waiting to be checked out."""
+    return len(self._idle)
+
+  def stats(self) -> Dict[str, int]:
+    with self._lock:
+      return {"open": self._open, "idle": len(self._idle),
+              "in_use": self._open - len(self._idle), "max_size": self.max_size}
+
+  def checkout(self) -> sqlite3.Connection:
+    """Take a connection, opening one if none is idle and there's room."""
+    deadline = time.monotonic() + self.timeout
+    with self._lock:
+      while True:
+        if self._closed:
+          raise sqlite3.ProgrammingError("Connection pool is closed")
+        self._reap()
+        if self._idle:
+          return self._idle.pop()[0]
+        if self._open < self.max_size:
+          self._open += 1
+          break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          raise TimeoutError(f"No database connection free after {self.timeout}s")
+        self._lock.wait(remaining)
+    try:
+      return self._connect()
+    except Exception:
+      with self._lock:
+        self._open -= 1
+        self._lock.notify()
+      raise
+
+  def checkin(self, conn: sqlite3.Connection):
+    """Give back a connection from checkout()."""
+    if conn.in_transaction:
+      conn.rollback()
+    with self._lock:
+      if self._closed:
+        self._open -= 1
+        conn.close()
+      else:
+        self._idle.append((conn, time.monotonic()))
+        self._reap()
+      self._lock.notify()
+
+  @contextmanager
+  def connection(self):
+    """Context manager that checks a connection out and back in."""
+    conn = self.checkout()
+    try:
+      yield conn
+    finally:
+      self.checkin(conn)
+
+  def _reap(self):
+    """Close connections idle for longer than idle_timeout. Needs _lock."""
+    cutoff = time.monotonic() - self.idle_timeout
+    while self._idle and self._idle[0][1] < cutoff:
+      self._idle.popleft()[0].close()
+      self._open -= 1
+
+  def reap(self):
+    """Close connections idle for longer than idle_timeout now."""
+    with self._lock:
+      self._reap()
+
+  def close(self):
+    """Close idle connections now, and the rest as they're returned."""
+    with self._lock:
+      self._closed = True
+      while self._idle:
+        self._idle.pop()[0].close()
+        self._open -= 1
+      self._lock.notify_all()
+
+
+class UsageCounter:
+  """Hit counts and last-used times per (kind, trigger), kept in memory.
+
+  record() is called for every matched message, so it only bumps a
+  counter; drain() hands over everything counted since the last drain, to
+  be written in one batch.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # (kind, trigger) -> [hits, last used, in seconds since the epoch]
+    self._counts = {}
+
+  def __len__(self) -> int:
+    return len(self._counts)
+
+  def record(self, kind: str, trigger: str, when: Optional[float] = None):
+    """Count one use of trigger, which kind says how it was matched."""
+    when = time.time() if when is None else when
+    with self._lock:
+      counts = self._counts.get((kind, trigger))
+      if counts is None:
+        self._counts[(kind, trigger)] = [1, when]
+      else:
+        counts[0] += 1
+        counts[1] = max(counts[1], when)
+
+  def pending(self) -> List[tuple]:
+    """What's been counted, as (kind, trigger, hits, last_used) rows."""
+    with self._lock:
+      items = list(self._counts.items())
+    return [(kind, trigger, hits, _timestamp(when)) for (kind, trigger), (hits, when) in items]
+
+  def drain(self) -> List[tuple]:
+    """Like pending, but also starts counting again from zero."""
+    with self._lock:
+      items, self._counts = self._counts, {}
+    return [(kind, trigger, hits, _timestamp(when))
+            for (kind, trigger), (hits, when) in items.items()]
+
+
+def _create_tables(conn):
+  """Schema version 1: the original tables, plus the change counter."""
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS custom_commands (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      trigger TEXT NOT NULL UNIQUE,
+      response TEXT NOT NULL,
+      created_by TEXT NOT NULL,
+      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+      updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+  """)
+  conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_trigger
+    ON custom_commands(trigger)
+  """)
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS audit_log (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      action TEXT NOT NULL,
+      trigger TEXT NOT NULL,
+      response TEXT,
+      user_id TEXT NOT NULL,
+      timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+  """)
+
+  # Change counter for custom_commands, bumped by triggers so that
+  # writes from every process (or by hand) are counted.
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS change_counter (
+      name TEXT PRIMARY KEY,
+      value INTEGER NOT NULL
+    )
+  """)
+  conn.execute("""
+    INSERT OR IGNORE INTO change_counter (name, value)
+    VALUES ('custom_commands', 0)
+  """)
+  for event in ("INSERT", "UPDATE", "DELETE"):
+    conn.execute(f"""
+      CREATE TRIGGER IF NOT EXISTS custom_commands_{event.lower()}_counter
+      AFTER {event} ON custom_commands
+      BEGIN
+        UPDATE change_counter SET value = value + 1
+        WHERE name = 'custom_commands';
+      END
+    """)
+
+
+# Schema version 2: indexes for paging through the audit log by key.
+#
+# Audit log pages are read newest first by (timestamp, id). idx_audit_page
+# covers every column, so unfiltered pages never touch the table; the
+# filter indexes lead with the filtered column and keep the same order.
+
+def _add_audit_page_index(conn):
+  conn.execute("DROP INDEX IF EXISTS idx_audit_timestamp")
+  conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_audit_page
+    ON audit_log(timestamp DESC, id DESC, action, trigger, user_id, response)
+  """)
+
+
+def _add_audit_filter_index(conn, column):
+  # Before version 2, idx_audit_trigger was on the trigger alone.
+  old = conn.execute("""
+    SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?
+  """, (f"idx_audit_{column}",)).fetchone()
+  if old is not None and "timestamp" not in old[0]:
+    conn.execute(f"DROP INDEX idx_audit_{column}")
+  conn.execute(f"""
+    CREATE INDEX IF NOT EXISTS idx_audit_{column}
+    ON audit_log({column}, timestamp DESC, id DESC)
+  """)
+
+
+def _create_trigger_usage(conn):
+  """Schema version 3: hit counts for every trigger, custom or built in.
+
+  kind is the table the trigger matched in, as in responses.known_rules(),
+  or "custom". last_used is a UTC timestamp like CURRENT_TIMESTAMP.
+  """
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS trigger_usage (
+      kind TEXT NOT NULL,
+      trigger TEXT NOT NULL,
+      hits INTEGER NOT NULL DEFAULT 0,
+      last_used TIMESTAMP,
+      PRIMARY KEY (kind, trigger)
+    ) WITHOUT ROWID
+  """)
+  conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_usage_hits
+    ON trigger_usage(kind, hits DESC)
+  """)
+
+
+def _add_database_id(conn):
+  """Schema version 4: a random ID that tells this database from any other.
+
+  Snapshot files are only valid for the database they were saved from.
+  """
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS database_info (
+      name TEXT PRIMARY KEY,
+      value TEXT NOT NULL
+    )
+  """)
+  conn.execute("""
+    INSERT OR IGNORE INTO database_info (name, value)
+    VALUES ('id', lower(hex(randomblob(16))))
+  """)
+
+
+# The FTS5 tables for full-text search, and the table each one indexes.
+SEARCH_TABLES = {"commands_search": "custom_commands", "audit_search": "audit_log"}
+
+# Rows indexed per write transaction when filling in a new search table;
+# about 11ms each.
+SEARCH_BACKFILL_CHUNK = 5000
+
+
+def _create_search_indexes(conn):
+  """Schema version 5: full-text search over commands and the audit log.
+
+  The FTS5 tables index custom_commands and audit_log where they are,
+  without a second copy of the text, and triggers keep them up to date.
+  The audit log is only ever added to, so it needs no update trigger.
+
+  Rows that were already there are indexed afterwards, a chunk at a time,
+  by _backfill_search_chunk; search_backfill holds the ids still to do.
+  Until then the delete and update triggers leave those rows alone, since
+  deleting a row that isn't in an external content table corrupts it.
+  """
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS search_backfill (
+      name TEXT PRIMARY KEY,
+      next_id INTEGER NOT NULL,
+      last_id INTEGER NOT NULL
+    )
+  """)
+  for table, source in SEARCH_TABLES.items():
+    conn.execute(f"""
+      CREATE VIRTUAL TABLE IF NOT EXISTS {table}
+      USING fts5(trigger, response, content='{source}', content_rowid='id')
+    """)
+    conn.execute(f"""
+      INSERT OR IGNORE INTO search_backfill (name, next_id, last_id)
+      SELECT '{table}', MIN(id), MAX(id) FROM {source} HAVING COUNT(*) > 0
+    """)
+    # Ids are never reused, so new rows are always after the backfill.
+    conn.execute(f"""
+      CREATE TRIGGER IF NOT EXISTS {source}_insert_search
+      AFTER INSERT ON {source}
+      BEGIN
+        INSERT INTO {table} (rowid, trigger, response)
+        VALUES (new.id, new.trigger, new.response);
+      END
+    """)
+    conn.execute(f"""
+      CREATE TRIGGER IF NOT EXISTS {source}_delete_search
+      AFTER DELETE ON {source}
+      WHEN {_search_indexed(table, "old.id")}
+      BEGIN
+        INSERT INTO {table} ({table}, rowid, trigger, response)
+        VALUES ('delete', old.id, old.trigger, old.response);
+      END
+    """)
+  conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS custom_commands_update_search
+    AFTER UPDATE OF trigger, response ON custom_commands
+    WHEN {_search_indexed("commands_search", "old.id")}
+    BEGIN
+      INSERT INTO commands_search (commands_search, rowid, trigger, response)
+      VALUES ('delete', old.id, old.trigger, old.response);
+      INSERT INTO commands_search (rowid, trigger, response)
+      VALUES (new.id, new.trigger, new.response);
+    END
+  """)
+
+
+def _search_indexed(table: str, row_id: str) -> str:
+  """SQL that's true if the row is in the search table, not waiting for backfill."""
+  return f"""NOT EXISTS (
+    SELECT 1 FROM search_backfill
+    WHERE name = '{table}' AND {row_id} BETWEEN next_id AND last_id
+  )"""
+
+
+def _backfill_search_chunk(conn, chunk_size: int = SEARCH_BACKFILL_CHUNK) -> bool:
+  """Index the next chunk of rows that were there before a search table.
+
+  Returns:
+    False if there was nothing left to index
+  """
+  row = conn.execute("SELECT name, next_id, last_id FROM search_backfill LIMIT 1").fetchone()
+  if row is None:
+    return False
+  table, next_id, last_id = row
+  end = min(next_id + chunk_size - 1, last_id)
+  conn.execute(f"""
+    INSERT INTO {table} (rowid, trigger, response)
+    SELECT id, trigger, response FROM {SEARCH_TABLES[table]}
+    WHERE id BETWEEN ? AND ?
+  """, (next_id, end))
+  if end < last_id:
+    conn.execute("UPDATE search_backfill SET next_id = ? WHERE name = ?", (end + 1, table))
+  else:
+    conn.execute("DELETE FROM search_backfill WHERE name = ?", (table,))
+  return True
+
+
+# Schema changes in order; the database's PRAGMA user_version says how many
+# have been applied. Only ever append. Databases from before versioning
+# are at 0.
+#
+# Each migration is a list of steps, and each step runs in its own write
+# transaction, so other processes' writes wait for one step at a time,
+# never a whole migration. Keep every step well inside busy_timeout: DDL
+# is instant, but SQLite builds an index in one go, so give each index on
+# a big table a step of its own, and fill anything else in batches (see
+# _create_search_indexes). user_version only moves on after a migration's
+# last step, so every step must tolerate finding its work already done.
+MIGRATIONS = [
+  [_create_tables],
+  [_add_audit_page_index] +
+  [functools.partial(_add_audit_filter_index, column=column) for column in AUDIT_FILTERS],
+  [_create_trigger_usage],
+  [_add_database_id],
+  [_create_search_indexes],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def _migrate_step(conn, version: int, step: int) -> int:
+  """Apply one step of the migration from version; returns the resulting version.
+
+  Does nothing if the database has moved on from version since.
+  """
+  current = conn.execute("PRAGMA user_version").fetchone()[0]
+  if current != version:
+    return current
+  MIGRATIONS[version][step](conn)
+  if step == len(MIGRATIONS[version]) - 1:
+    version += 1
+    conn.execute(f"PRAGMA user_version = {version}")
+  return version
+
+
+class StorageBackend(Protocol):
+  """What responses.py, app.py and the tools need from command storage.
+
+  StorageManager keeps everything in SQLite; MemoryStorage keeps it in
+  Python objects. create_storage() picks one.
+  """
+
+  # Change feed: generation goes up with every change to the commands,
+  # and snapshot() is an unchanging view at one generation.
+  @property
+  def generation(self) -> int: ...
+  def snapshot(self) -> CommandSnapshot: ...
+  def command_snapshot(self) -> CommandIndex: ...
+
+  # Commands
+  def add_command_async(self, trigger: str, response: str, created_by: str) -> Future: ...
+  def add_command(self, trigger: str, response: str, created_by: str) -> Optional[str]: ...
+  def delete_command_async(self, trigger: str, deleted_by: str) -> Future: ...
+  def delete_command(self, trigger: str, deleted_by: str) -> bool: ...
+  def import_commands(self, commands: Iterable, imported_by: str, on_conflict: str = "skip",
+                      chunk_size: int = 1000) -> Dict[str, int]: ...
+  def iter_commands(self) -> Iterator[CommandRecord]: ...
+  def get_command(self, trigger: str) -> Optional[str]: ...
+  def get_command_creator(self, trigger: str) -> Optional[str]: ...
+  def match_command(self, command: str) -> Optional[str]: ...
+  def suggest_commands(self, text: str, limit: int = 3) -> List[tuple]: ...
+  def list_all_commands(self) -> List[Dict]: ...
+  def search_commands(self, query: str, limit: int = 20, cursor=None) -> tuple: ...
+
+  # Audit log
+  def log_audit(self, action: str, trigger: str, user_id: str, response: str = None): ...
+  def flush(self): ...
+  def get_audit_log(self, limit: int = 100) -> List[Dict]: ...
+  def get_audit_page(self, limit: int = 100, after: Optional[tuple] = None,
+                     **filters) -> tuple: ...
+  def iter_audit_log(self, page_size: int = 1000, **filters) -> Iterator[Dict]: ...
+  def search_audit_log(self, query: str, limit: int = 100, cursor=None) -> tuple: ...
+  def wait_for_search_index(self, timeout: Optional[float] = None) -> bool: ...
+
+  # Trigger usage
+  def record_usage(self, kind: str, trigger: str): ...
+  def flush_usage(self) -> int: ...
+  def get_usage(self, kind: Optional[str] = None, limit: Optional[int] = 100) -> List[Dict]: ...
+
+  def close(self): ...
+
+
+@contextmanager
+def _collector_paused():
+  """Turn off the cyclic garbage collector for a while.
+
+  Pickling and unpickling snapshots allocate a great many objects, none of
+  them garbage, and the collector would only slow that down.
+  """
+  collecting = gc.isenabled()
+  gc.disable()
+  try:
+    yield
+  finally:
+    if collecting:
+      gc.enable()
+
+
+def _fts_query(terms: List[str]) -> str:
+  """An FTS5 query for rows with words starting with every one of terms.
+
+  Each term is quoted, so nothing in a search is read as FTS5 syntax.
+  """
+  return " ".join(f'"{term}"*' for term in terms)
+
+
+# Bumped whenever what save_snapshot writes changes shape, so that older
+# files are rebuilt instead of misread.
+SNAPSHOT_FORMAT = 2
+
+
+@functools.lru_cache(maxsize=None)
+def _code_fingerprint() -> str:
+  """A hash of the code behind the classes in a snapshot.
+
+  A snapshot saved by other code may not have the attributes this code
+  expects, even if SNAPSHOT_FORMAT wasn't bumped, so it's rebuilt.
+  """
+  digest = hashlib.sha256()
+  for module in (matcher, sys.modules[__name__]):
+    try:
+      with open(module.__file__, "rb") as f:
+        digest.update(f.read())
+    except (OSError, TypeError) as e:
+      logging.warning(f"Can't read {module.__name__} source for the snapshot key: {e}")
+  return digest.hexdigest()
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+  """Unpickles only the classes save_snapshot writes.
+
+  Anyone who can write the snapshot file could otherwise run any code they
+  liked when it's loaded. The containers in a snapshot are all built into
+  the pickle protocol, so no other globals are needed.
+  """
+
+  ALLOWED = {
+    ("storage", "CommandRecord"),
+    ("matcher", "CommandIndex"),
+    ("matcher", "PrefixTrie"),
+    ("matcher", "ResponseTemplate"),
+    ("matcher", "SuggestionIndex"),
+  }
+
+  def find_class(self, module, name):
+    if (module, name) not in self.ALLOWED:
+      raise pickle.UnpicklingError(f"{module}.{name} isn't allowed in a snapshot")
+    return super().find_class(module, name)
+
+# How many in-memory databases have been named so far.
+_memory_databases = 0
+
+# Numbers each import's staging table.
+_imports = itertools.count(1)
+
 
 class StorageManager:
-  """Thread-safe SQLite storage for screambot custom commands."""
+  """Thread-safe SQLite storage for screambot custom commands.
+
+  Commands are read from an in-memory snapshot. Several processes can share
+  one database: every change to custom_commands, from any process, bumps a
+  counter that SQL triggers maintain, and each StorageManager reloads its
+  snapshot when it sees the counter move.
 
-  def __init__(self, db_path: str = "screambot.db"):
+  Within a process, every write goes through one DatabaseWriter thread,
+  and reads use a pool of query_only connections, so writes never block
+  message matching.
+  """
+
+  def __init__(self, db_path: str = "screambot.db", coherence_interval: float = 1.0,
+               audit_queue_size: int = 1000, audit_when_full: str = "block",
+               profile: Optional[str] = None, pool_size: int = 8,
+               pool_idle_timeout: float = 60.0, usage_flush_interval: float = 60.0,
+               snapshot_path: Optional[str] = None, snapshot_save_interval: float = 60.0,
+               maintenance_interval: float = 5.0):
+    """
+    Args:
+      db_path: Path to the SQLite database, or ":memory:" for a private
+        database that lives as long as this StorageManager
+      coherence_interval: Seconds between checks for changes made by other
+        processes. 0 checks on every read; None never checks.
+      audit_queue_size: Most writes waiting for the writer thread
+      audit_when_full: What log_audit does when the write queue is full;
+        see DatabaseWriter
+      profile: Name of the PRAGMA set in PROFILES to use. Defaults to the
+        SCREAMBOT_DB_PROFILE environment variable, then "balanced".
+      pool_size: Most read connections open at once
+      pool_idle_timeout: Seconds before an unused connection is closed
+      usage_flush_interval: Most seconds that trigger usage counts are kept
+        in memory before being written
+      snapshot_path: File to save the commands and their match structures
+        to, and to start from next time if the database hasn't changed
+        since. None, or a ":memory:" database, never saves one.
+      snapshot_save_interval: Least seconds between saves of the snapshot
+        file after commands change. It's saved on close too.
+      maintenance_interval: Seconds between rounds of background upkeep,
+        like writing usage counts or the snapshot file when they're due and
+        closing idle read connections
+    """
     self.db_path = db_path
-    self._local = threading.local()
-    self._init_db()
+    if db_path == ":memory:":
+      # Every connection to plain :memory: gets its own empty database, so
+      # open a named one in the memdb VFS instead. Unlike cache=shared, its
+      # connections lock the usual way, so busy_timeout works. It goes away
+      # when the last connection closes.
+      global _memory_databases
+      _memory_databases += 1
+      self._uri = f"file:/screambot-{os.getpid()}-{_memory_databases}?vfs=memdb"
+    else:
+      self._uri = None
+    self.profile = profile or os.environ.get("SCREAMBOT_DB_PROFILE") or DEFAULT_PROFILE
+    if self.profile not in PROFILES:
+      raise ValueError(f"Unknown database profile {self.profile!r}; "
+                       f"choose from {', '.join(PROFILES)}")
+    # All writes go through one thread; everything else reads on a pool
+    # of query_only connections.
+    self._writer = DatabaseWriter(lambda: self._connect(read_only=False), self._write_audit,
+                                  maxsize=audit_queue_size, when_full=audit_when_full)
+    self._pool = ConnectionPool(self._connect, max_size=pool_size,
+                                idle_timeout=pool_idle_timeout)
+    self._migrate()
+    with self._pool.connection() as conn:
+      self.pragmas = self._read_pragmas(conn)
+    logging.info(f"Database profile {self.profile}: {self.pragmas}")
+    # Serializes snapshot swaps between the writer thread and reloads.
+    self._write_lock = threading.Lock()
+    self.snapshot_path = snapshot_path if self._uri is None else None
+    self.snapshot_save_interval = snapshot_save_interval
+    self._saved_generation = None
+    self._snapshot_saved = time.monotonic()
+    with self._read_transaction() as conn:
+      self._database_id = self._read_database_id(conn)
+    if not self._warm_start():
+      self._snapshot = self._load_snapshot()
+      self._suggestions = SuggestionIndex(self._snapshot.commands)
+      if self.snapshot_path:
+        self.save_snapshot()
+
+    # A connection of our own for PRAGMA data_version, which changes when
+    # any other connection commits to the database.
+    self.coherence_interval = coherence_interval
+    self._watch_lock = threading.Lock()
+    self._watch_conn = self._connect()
+    self._data_version = self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+    self._next_check = 0.0
+
+    # Trigger usage is counted in memory and written in batches.
+    self.usage_flush_interval = usage_flush_interval
+    self._usage = UsageCounter()
+    self._usage_flushed = time.monotonic()
+
+    # Rows from before search was added are indexed in the background.
+    self._backfill_stop = threading.Event()
+    self._backfill_thread = None
+    if self._search_backfill_pending():
+      self._backfill_thread = threading.Thread(target=self._backfill_search,
+                                               name="search-backfill", daemon=True)
+      self._backfill_thread.start()
+
+    # Upkeep that shouldn't wait for the next request; see _maintain.
+    self.maintenance_interval = maintenance_interval
+    self._maintenance_stop = threading.Event()
+    self._maintenance_thread = threading.Thread(target=self._maintain,
+                                                name="storage-maintenance", daemon=True)
+    self._maintenance_thread.start()
+
+  def _connect(self, read_only: bool = True) -> sqlite3.Connection:
+    """Open a connection with the profile's PRAGMAs applied.
 
-  def _get_connection(self) -> sqlite3.Connection:
-    """Get thread-local database connection."""
-    if not hasattr(self._local, 'conn'):
+    Args:
+      read_only: Set query_only, so only the writer thread can write
+    """
+    if self._uri:
+      conn = sqlite3.connect(self._uri, uri=True, check_same_thread=False, isolation_level=None)
+    else:
       conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
-      conn.row_factory = sqlite3.Row
-      # Enable WAL mode for better concurrency
-      conn.execute('PRAGMA journal_mode=WAL')
-      self._local.conn = conn
-    return self._local.conn
+    conn.row_factory = sqlite3.Row
+    for name, value in PROFILES[self.profile]:
+      # The journal mode is saved in the database; only the writer sets it.
+      if name != "journal_mode" or not read_only:
+        conn.execute(f"PRAGMA {name}={value}")
+    if read_only:
+      conn.execute("PRAGMA query_only=1")
+    return conn
+
+  def _read_pragmas(self, conn) -> Dict[str, object]:
+    """The values SQLite actually uses for the profile's PRAGMAs."""
+    # A connection only notices another switching the journal mode when it
+    # next reads the database.
+    conn.execute("PRAGMA user_version").fetchone()
+    pragmas = {}
+    for name, _ in PROFILES[self.profile]:
+      # Some, like mmap_size, report nothing for in-memory databases.
+      row = conn.execute(f"PRAGMA {name}").fetchone()
+      pragmas[name] = row[0] if row else None
+    return pragmas
+
+  def connection_stats(self) -> Dict[str, int]:
+    """Gauges for the connection pool: open, idle, in_use and max_size."""
+    return self._pool.stats()
 
   @contextmanager
-  def _transaction(self):
-    """Context manager for database transactions."""
-    conn = self._get_connection()
+  def _read_transaction(self):
+    """Context manager for a consistent read on a pooled connection."""
+    with self._pool.connection() as conn:
+      conn.execute("BEGIN")
+      try:
+        yield conn
+      finally:
+        conn.commit()
+
+  def _write(self, function, on_commit=None) -> Future:
+    """Run function(connection) on the writer thread; see DatabaseWriter.submit."""
+    return self._writer.submit(function, on_commit)
+
+  def _schema_version(self) -> int:
+    with self._pool.connection() as conn:
+      return conn.execute("PRAGMA user_version").fetchone()[0]
+
+  def _migrate(self):
+    """Bring the schema up to SCHEMA_VERSION, one step per transaction.
+
+    Each step re-reads user_version inside its write transaction, so
+    processes starting together don't apply a migration twice. A database
+    that's already current isn't written to at all.
+    """
+    version = self._schema_version()
+    if version > SCHEMA_VERSION:
+      logging.warning(f"Database schema version {version} is newer than this code "
+                      f"({SCHEMA_VERSION})")
+      return
+    while version < SCHEMA_VERSION:
+      for step in range(len(MIGRATIONS[version])):
+        reached = self._writer.execute(
+          functools.partial(_migrate_step, version=version, step=step))
+        if reached != version:
+          break
+      version = reached
+      logging.info(f"Migrated database to schema version {version}")
+    logging.info(f"Database at {self.db_path} is at schema version {version}")
+    # The writer sets the profile's journal mode when it connects, so only
+    # wake it if the database isn't in that mode yet.
+    journal_mode = dict(PROFILES[self.profile]).get("journal_mode")
+    with self._pool.connection() as conn:
+      current = self._read_pragmas(conn)["journal_mode"]
+    if journal_mode and current.lower() != journal_mode.lower():
+      self._writer.execute(lambda conn: None)
+
+  def _search_backfill_pending(self) -> bool:
+    with self._pool.connection() as conn:
+      return conn.execute("SELECT 1 FROM search_backfill LIMIT 1").fetchone() is not None
+
+  def _backfill_search(self):
+    """Index old rows in the search tables, one chunk per write transaction.
+
+    Other writes queue between chunks, so none waits for more than one.
+    """
+    logging.info("Indexing existing rows for search")
+    while not self._backfill_stop.is_set():
+      try:
+        if not self._writer.execute(_backfill_search_chunk):
+          logging.info("Search index is complete")
+          return
+      except Exception as e:
+        logging.error(f"Can't index existing rows for search: {e}")
+        return
+
+  def wait_for_search_index(self, timeout: Optional[float] = None) -> bool:
+    """Wait for rows from before search was added to be indexed.
+
+    Returns:
+      True if they have been, False if timeout ran out first
+    """
+    if self._backfill_thread is not None:
+      self._backfill_thread.join(timeout)
+      return not self._backfill_thread.is_alive()
+    return True
+
+  def _read_database_id(self, conn) -> str:
+    return conn.execute("SELECT value FROM database_info WHERE name = 'id'").fetchone()[0]
+
+  def _change_counter(self, conn) -> int:
+    return conn.execute("""
+      SELECT value FROM change_counter WHERE name = 'custom_commands'
+    """).fetchone()[0]
+
+  def _load_snapshot(self) -> CommandSnapshot:
+    """Read every command and the change counter in one read transaction."""
+    with self._read_transaction() as conn:
+      generation = self._change_counter(conn)
+      cursor = conn.execute("""
+        SELECT trigger, response, created_by, created_at
+        FROM custom_commands
+      """)
+      return CommandSnapshot.from_records(generation, (CommandRecord(*row) for row in cursor))
+
+  def _warm_start(self) -> bool:
+    """Start from the snapshot file, if it matches the database.
+
+    The file is read in one go, and its match structures are used as they
+    are instead of being rebuilt from every row.
+
+    Returns:
+      True if the snapshot and suggestion index came from the file
+    """
+    if not self.snapshot_path:
+      return False
     try:
-      yield conn
-      conn.commit()
+      with open(self.snapshot_path, "rb") as f:
+        data = io.BytesIO(f.read())
+    except FileNotFoundError:
+      return False
+    except OSError as e:
+      logging.warning(f"Can't read snapshot file {self.snapshot_path}: {e}")
+      return False
+
+    with self._read_transaction() as conn:
+      generation = self._change_counter(conn)
+    try:
+      with _collector_paused():
+        # One unpickler per dump: each numbers its memo from zero.
+        key = _SnapshotUnpickler(data).load()
+        if key != (SNAPSHOT_FORMAT, _code_fingerprint(), self._database_id, generation):
+          logging.info(f"Snapshot file {self.snapshot_path} is stale, rebuilding")
+          return False
+        commands, index, suggestions = _SnapshotUnpickler(data).load()
     except Exception as e:
-      conn.rollback()
-      logging.error(f"Database transaction failed: {e}")
-      raise
+      logging.warning(f"Can't load snapshot file {self.snapshot_path}: {e}")
+      return False
+    self._snapshot = CommandSnapshot(generation, commands, index)
+    self._suggestions = suggestions
+    self._saved_generation = generation
+    logging.info(f"Loaded {len(commands)} custom commands from {self.snapshot_path}")
+    return True
 
-  def _init_db(self):
-    """Initialize database schema."""
-    with self._transaction() as conn:
-      # Custom commands table
-      conn.execute("""
-        CREATE TABLE IF NOT EXISTS custom_commands (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          trigger TEXT NOT NULL UNIQUE,
-          response TEXT NOT NULL,
-          created_by TEXT NOT NULL,
-          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-          updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-      """)
+  def save_snapshot(self):
+    """Save the current commands and match structures to snapshot_path.
 
-      conn.execute("""
-        CREATE INDEX IF NOT EXISTS idx_trigger
-        ON custom_commands(trigger)
-      """)
+    The file is replaced in one step, so a reader never sees half of it.
+    """
+    with self._write_lock:
+      snapshot = self._snapshot
+      if snapshot.generation == self._saved_generation:
+        return
+      temporary = f"{self.snapshot_path}.{os.getpid()}.tmp"
+      try:
+        with open(temporary, "wb") as f, _collector_paused():
+          pickle.dump((SNAPSHOT_FORMAT, _code_fingerprint(), self._database_id,
+                       snapshot.generation), f, pickle.HIGHEST_PROTOCOL)
+          pickle.dump((snapshot.commands, snapshot.index, self._suggestions), f,
+                      pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.snapshot_path)
+      except OSError as e:
+        logging.warning(f"Can't save snapshot file {self.snapshot_path}: {e}")
+        return
+      finally:
+        self._snapshot_saved = time.monotonic()
+      self._saved_generation = snapshot.generation
+    logging.info(f"Saved custom commands at generation {snapshot.generation} "
+                 f"to {self.snapshot_path}")
 
-      # Audit log table
-      conn.execute("""
-        CREATE TABLE IF NOT EXISTS audit_log (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          action TEXT NOT NULL,
-          trigger TEXT NOT NULL,
-          response TEXT,
-          user_id TEXT NOT NULL,
-          timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-      """)
+  def _reload(self):
+    """Replace the snapshot with a fresh one, if the database is newer.
 
-      conn.execute("""
-        CREATE INDEX IF NOT EXISTS idx_audit_timestamp
-        ON audit_log(timestamp DESC)
-      """)
+    The caller must hold _write_lock.
+    """
+    old = self._snapshot
+    new = self._load_snapshot()
+    if new.generation <= old.generation:
+      return
+    self._snapshot = new
+    for trigger in old.commands.keys() - new.commands.keys():
+      self._suggestions.remove(trigger)
+    for trigger in new.commands.keys() - old.commands.keys():
+      self._suggestions.add(trigger)
+    logging.info(f"Reloaded custom commands at generation {new.generation}")
 
-      conn.execute("""
-        CREATE INDEX IF NOT EXISTS idx_audit_trigger
-        ON audit_log(trigger)
-      """)
+  def _current(self) -> CommandSnapshot:
+    """Get the snapshot, first reloading it if another process changed commands."""
+    if self.coherence_interval is not None:
+      now = time.monotonic()
+      # Only one thread checks at a time; the rest use what's there.
+      if now >= self._next_check and self._watch_lock.acquire(blocking=False):
+        try:
+          self._next_check = now + self.coherence_interval
+          data_version = self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+          if data_version != self._data_version:
+            self._data_version = data_version
+            if self._change_counter(self._watch_conn) != self._snapshot.generation:
+              with self._write_lock:
+                self._reload()
+        finally:
+          self._watch_lock.release()
+    return self._snapshot
 
-    logging.info(f"Database initialized at {self.db_path}")
+  def _publish(self, generation, change):
+    """Publish a committed write, which took the counter to generation.
+
+    The caller must hold _write_lock. If this was the only change since the
+    current snapshot, change(snapshot) builds the next one; if another
+    process has written too, everything is reloaded instead.
+    """
+    if generation == self._snapshot.generation + 1:
+      self._snapshot = change(self._snapshot)
+    else:
+      self._reload()
+
+  @property
+  def generation(self) -> int:
+    """Number that goes up every time the custom commands change."""
+    return self._current().generation
+
+  def snapshot(self) -> CommandSnapshot:
+    """Get a consistent, unchanging view of all custom commands."""
+    return self._current()
 
   def log_audit(self, action: str, trigger: str, user_id: str, response: str = None):
     """Log an action to the audit log.
 
+    The entry is written in the background, batched with others; see
+    DatabaseWriter.log.
+
     Args:
       action: "create", "update", or "delete"
       trigger: The command trigger
       user_id: Slack user ID who performed the action
       response: The response (for create/update actions)
     """
-    try:
-      with self._transaction() as conn:
-        conn.execute("""
-          INSERT INTO audit_log (action, trigger, response, user_id)
-          VALUES (?, ?, ?, ?)
-        """, (action, trigger, response, user_id))
-    except Exception as e:
-      logging.error(f"Failed to log audit entry: {e}")
+    self._writer.log((action, trigger, response, user_id))
+
+  def flush(self):
+    """Wait until every audit entry logged so far has been written."""
+    self._writer.flush()
+
+  def _write_audit(self, conn, entries):
+    """Insert queued audit entries; runs on the writer thread."""
+    conn.executemany("""
+      INSERT INTO audit_log (action, trigger, response, user_id)
+      VALUES (?, ?, ?, ?)
+    """, entries)
+
+  def record_usage(self, kind: str, trigger: str):
+    """Count one use of a trigger.
+
+    Counts are kept in memory and written together, at most
+    usage_flush_interval seconds apart, so this never waits for the database.
+
+    Args:
+      kind: Where the trigger matched: "custom", or a built-in table name
+      trigger: The trigger that matched
+    """
+    self._usage.record(kind, trigger)
+    self._flush_usage_if_due()
+
+  def _flush_usage_if_due(self):
+    """Queue a write of the usage counts if they've waited long enough."""
+    now = time.monotonic()
+    if self.usage_flush_interval is not None and len(self._usage) and \
+        now - self._usage_flushed >= self.usage_flush_interval:
+      self._usage_flushed = now
+      try:
+        self._write(self._write_usage).add_done_callback(self._usage_written)
+      except sqlite3.ProgrammingError:
+        pass  # Closing; close() has written what there was.
+
+  def _save_snapshot_if_due(self):
+    """Save the snapshot file if commands changed and it's been long enough."""
+    if not self.snapshot_path or self._snapshot.generation == self._saved_generation:
+      return
+    if time.monotonic() - self._snapshot_saved >= self.snapshot_save_interval:
+      self.save_snapshot()
+
+  def _maintain(self):
+    """Background upkeep, every maintenance_interval seconds until close().
+
+    Without it, an idle bot would hold usage counts and idle read
+    connections until the next request, however long that took, and a
+    bot that's never closed cleanly would warm-start from an ever older
+    snapshot file.
+    """
+    while not self._maintenance_stop.wait(self.maintenance_interval):
+      try:
+        self._flush_usage_if_due()
+        self._save_snapshot_if_due()
+        self._pool.reap()
+      except Exception as e:
+        logging.error(f"Storage upkeep failed: {e}")
+
+  def _write_usage(self, conn) -> int:
+    """Add the counts gathered since the last write; runs on the writer thread."""
+    rows = self._usage.drain()
+    conn.executemany("""
+      INSERT INTO trigger_usage (kind, trigger, hits, last_used)
+      VALUES (?, ?, ?, ?)
+      ON CONFLICT(kind, trigger) DO UPDATE
+      SET hits = hits + excluded.hits,
+          last_used = max(last_used, excluded.last_used)
+    """, rows)
+    return len(rows)
+
+  @staticmethod
+  def _usage_written(future):
+    if future.exception() is not None:
+      logging.error(f"Failed to write trigger usage: {future.exception()}")
+
+  def flush_usage(self) -> int:
+    """Write the usage counted so far now; returns how many triggers it covered."""
+    return self._writer.execute(self._write_usage)
+
+  def get_usage(self, kind: Optional[str] = None, limit: Optional[int] = 100) -> List[Dict]:
+    """Usage counts, most used first, including any not yet written.
+
+    Args:
+      kind: Only triggers of this kind, like "custom"; by default, all of them
+      limit: Most triggers to return, or None for all of them
+
+    Returns:
+      List of dicts with keys: kind, trigger, hits, last_used
+    """
+    self.flush_usage()
+    where = "WHERE kind = ?" if kind is not None else ""
+    params = (kind,) if kind is not None else ()
+    with self._pool.connection() as conn:
+      cursor = conn.execute(f"""
+        SELECT kind, trigger, hits, last_used
+        FROM trigger_usage
+        {where}
+        ORDER BY hits DESC, last_used DESC, trigger
+        LIMIT ?
+      """, params + (-1 if limit is None else limit,))
+      return [dict(row) for row in cursor]
+
+  def add_command_async(self, trigger: str, response: str, created_by: str) -> Future:
+    """Queue an add or update of a custom command; see add_command.
+
+    Returns:
+      A Future for "create" or "update", or for None if the command isn't valid
+    """
+    # Validate inputs for defense in depth
+    problem = validate_command(trigger, response)
+    if problem:
+      logging.error(problem)
+      future = Future()
+      future.set_result(None)
+      return future
+
+    trigger = trigger.lower()
+    written = {}
+
+    def write(conn):
+      # The writer thread is the only writer, so the row can't appear or
+      # vanish between the check and the upsert.
+      existing = conn.execute("""
+        SELECT 1 FROM custom_commands WHERE trigger = ?
+      """, (trigger,)).fetchone()
+      action = "update" if existing else "create"
+      row = conn.execute("""
+        INSERT INTO custom_commands (trigger, response, created_by)
+        VALUES (?, ?, ?)
+        ON CONFLICT(trigger) DO UPDATE
+        SET response = excluded.response, updated_at = CURRENT_TIMESTAMP
+        RETURNING trigger, response, created_by, created_at
+      """, (trigger, response, created_by)).fetchone()
+      conn.execute("""
+        INSERT INTO audit_log (action, trigger, response, user_id)
+        VALUES (?, ?, ?, ?)
+      """, (action, trigger, response, created_by))
+      written["record"] = CommandRecord(*row)
+      written["generation"] = self._change_counter(conn)
+      return action
 
-  def add_command(self, trigger: str, response: str, created_by: str) -> bool:
-    """Add or update a custom command.
+    def publish(action):
+      record, generation = written["record"], written["generation"]
+      with self._write_lock:
+        self._publish(generation, lambda snapshot: snapshot.with_command(record, generation))
+        self._suggestions.add(trigger)
+
+    return self._write(write, publish)
+
+  def add_command(self, trigger: str, response: str, created_by: str) -> Optional[str]:
+    """Add or update a custom command, and wait for it to be written.
+
+    The existence check, the write and the audit entry all happen in one
+    transaction, so concurrent writers can't both record a "create".
 
     Args:
       trigger: The text that triggers the command (lowercased)
@@ -109,35 +1399,137 @@ class StorageManager:
       created_by: Slack user ID of creator
 
     Returns:
-      True if successful, False otherwise
+      "create" or "update" depending on what happened, None on failure
     """
     try:
-      # Validate inputs for defense in depth
-      if not trigger or len(trigger) < 2 or len(trigger) > 100:
-        logging.error(f"Invalid trigger length: {len(trigger) if trigger else 0}")
-        return False
-      if not response or len(response) > 500:
-        logging.error(f"Invalid response length: {len(response) if response else 0}")
-        return False
+      return self.add_command_async(trigger, response, created_by).result()
+    except Exception as e:
+      logging.error(f"Failed to add custom command: {e}")
+      return None
 
-      # Check if command already exists
-      existing = self.get_command_creator(trigger)
-      action = "update" if existing else "create"
+  def import_commands(self, commands: Iterable, imported_by: str, on_conflict: str = "skip",
+                      chunk_size: int = 1000) -> Dict[str, int]:
+    """Add many commands at once, all or nothing.
+
+    Commands are read and checked on the calling thread and staged a
+    chunk at a time in a temporary table, each chunk in a write
+    transaction of its own. One last transaction merges them into
+    custom_commands, so other writers never wait for the input to be read,
+    and nothing is imported unless everything can be. Invalid commands
+    are logged and left out.
+
+    Args:
+      commands: Iterable of (trigger, response) or (trigger, response,
+        created_by) tuples; created_by defaults to imported_by
+      imported_by: Slack user ID recorded in the audit log
+      on_conflict: For triggers that already exist, "skip" leaves them
+        alone, "overwrite" replaces their response and "fail" raises
+        CommandConflictError and imports nothing
+      chunk_size: Commands staged per write transaction
 
-      with self._transaction() as conn:
-        conn.execute("""
-          INSERT INTO custom_commands (trigger, response, created_by)
+    Returns:
+      Dict of counts: created, updated, skipped, invalid
+    """
+    if on_conflict not in CONFLICT_POLICIES:
+      raise ValueError(f"on_conflict must be one of {CONFLICT_POLICIES}, not {on_conflict!r}")
+    counts = {"created": 0, "updated": 0, "skipped": 0, "invalid": 0}
+    # Temporary tables belong to the writer's connection, which every
+    # import shares.
+    staging = f"temp.import_{next(_imports)}"
+    self._writer.execute(lambda conn: conn.execute(f"""
+      CREATE TABLE {staging} (
+        trigger TEXT PRIMARY KEY,
+        response TEXT NOT NULL,
+        created_by TEXT NOT NULL,
+        existing INTEGER NOT NULL DEFAULT 0
+      )
+    """))
+    try:
+      iterator = iter(commands)
+      while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+          break
+        rows = []
+        for command in chunk:
+          trigger, response = command[0], command[1]
+          problem = validate_command(trigger, response)
+          if problem:
+            logging.warning(f"Not importing {trigger!r}: {problem}")
+            counts["invalid"] += 1
+            continue
+          created_by = command[2] if len(command) > 2 and command[2] else imported_by
+          rows.append((trigger.lower(), response, created_by))
+        if not rows:
+          continue
+        # A trigger repeated in the input: the last one wins.
+        self._writer.execute(lambda conn: conn.executemany(f"""
+          INSERT OR REPLACE INTO {staging} (trigger, response, created_by)
           VALUES (?, ?, ?)
-          ON CONFLICT(trigger) DO UPDATE
-          SET response = ?, updated_at = CURRENT_TIMESTAMP
-        """, (trigger.lower(), response, created_by, response))
+        """, rows))
 
-      # Log to audit
-      self.log_audit(action, trigger.lower(), created_by, response)
-      return True
-    except Exception as e:
-      logging.error(f"Failed to add custom command: {e}")
-      return False
+      def publish(generation):
+        if generation != self._snapshot.generation:
+          with self._write_lock:
+            self._reload()
+
+      self._writer.execute(
+        functools.partial(self._merge_import, staging=staging, imported_by=imported_by,
+                          on_conflict=on_conflict, counts=counts), publish)
+    finally:
+      self._writer.execute(lambda conn: conn.execute(f"DROP TABLE IF EXISTS {staging}"))
+    logging.info(f"Imported commands: {counts}")
+    return counts
+
+  def _merge_import(self, conn, staging, imported_by, on_conflict, counts) -> int:
+    """Move staged commands into custom_commands; returns the change counter."""
+    conn.execute(f"""
+      UPDATE {staging} SET existing = 1
+      WHERE trigger IN (SELECT trigger FROM custom_commands)
+    """)
+    existing = conn.execute(f"SELECT COUNT(*) FROM {staging} WHERE existing").fetchone()[0]
+    if existing and on_conflict == "fail":
+      triggers = [row[0] for row in conn.execute(
+        f"SELECT trigger FROM {staging} WHERE existing ORDER BY trigger LIMIT 20")]
+      more = f" and {existing - len(triggers)} more" if existing > len(triggers) else ""
+      raise CommandConflictError(f"Triggers already exist: {', '.join(triggers)}{more}")
+    if on_conflict == "skip":
+      counts["skipped"] += existing
+      conn.execute(f"DELETE FROM {staging} WHERE existing")
+      existing = 0
+
+    # WHERE true tells the parser ON CONFLICT isn't part of a join.
+    conn.execute(f"""
+      INSERT INTO custom_commands (trigger, response, created_by)
+      SELECT trigger, response, created_by FROM {staging} WHERE true
+      ON CONFLICT(trigger) DO UPDATE
+      SET response = excluded.response, updated_at = CURRENT_TIMESTAMP
+    """)
+    conn.execute(f"""
+      INSERT INTO audit_log (action, trigger, response, user_id)
+      SELECT CASE WHEN existing THEN 'update' ELSE 'create' END, trigger, response, ?
+      FROM {staging}
+      ORDER BY rowid
+    """, (imported_by,))
+    total = conn.execute(f"SELECT COUNT(*) FROM {staging}").fetchone()[0]
+    counts["updated"] += existing
+    counts["created"] += total - existing
+    return self._change_counter(conn)
+
+  def iter_commands(self) -> Iterator[CommandRecord]:
+    """Yield every stored command, ordered by trigger, straight from the database.
+
+    Rows are read from a cursor as they're consumed, so exporting a big
+    table doesn't build a list of it.
+    """
+    with self._pool.connection() as conn:
+      cursor = conn.execute("""
+        SELECT trigger, response, created_by, created_at
+        FROM custom_commands
+        ORDER BY trigger
+      """)
+      for row in cursor:
+        yield CommandRecord(*row)
 
   def get_command(self, trigger: str) -> Optional[str]:
     """Get the response for a trigger.
@@ -148,14 +1540,44 @@ class StorageManager:
     Returns:
       Response string if found, None otherwise
     """
-    conn = self._get_connection()
-    cursor = conn.execute("""
-      SELECT response FROM custom_commands
-      WHERE trigger = ?
-    """, (trigger.lower(),))
+    record = self._current().commands.get(trigger.lower())
+    return record.response if record else None
+
+  def match_command(self, command: str) -> Optional[str]:
+    """Match a command against the custom commands, without touching SQLite.
+
+    Exact triggers win; otherwise the longest trigger that prefixes the
+    command is used as a template, with the rest of the command as $what.
+
+    Args:
+      command: The command text (case-insensitive)
+
+    Returns:
+      Response string if a command matched, None otherwise
+    """
+    return self._current().index.match(command)
+
+  def command_snapshot(self) -> CommandIndex:
+    """Get the current custom command index.
+
+    The returned index never changes, even if commands are added or
+    deleted later, so a batch of messages can be matched against one
+    consistent view.
+    """
+    return self._current().index
+
+  def suggest_commands(self, text: str, limit: int = 3) -> List[tuple]:
+    """Find custom triggers that look like text, for "did you mean".
+
+    Args:
+      text: What the user typed
+      limit: Maximum number of suggestions
 
-    row = cursor.fetchone()
-    return row['response'] if row else None
+    Returns:
+      List of (trigger, similarity) pairs, most similar first
+    """
+    self._current()
+    return self._suggestions.suggest(text, limit)
 
   def list_all_commands(self) -> List[Dict]:
     """List all custom commands.
@@ -163,17 +1585,44 @@ class StorageManager:
     Returns:
       List of dicts with keys: trigger, response, created_by, created_at
     """
-    conn = self._get_connection()
-    cursor = conn.execute("""
-      SELECT trigger, response, created_by, created_at
-      FROM custom_commands
-      ORDER BY trigger
-    """)
+    return [record._asdict() for record in self._current().sorted_commands()]
+
+  def delete_command_async(self, trigger: str, deleted_by: str) -> Future:
+    """Queue the deletion of a custom command; see delete_command.
 
-    return [dict(row) for row in cursor.fetchall()]
+    Returns:
+      A Future for True if the command was deleted, False if not found
+    """
+    trigger = trigger.lower()
+    written = {}
+
+    def write(conn):
+      row = conn.execute("""
+        DELETE FROM custom_commands
+        WHERE trigger = ?
+        RETURNING response
+      """, (trigger,)).fetchone()
+      if not row:
+        return False
+      conn.execute("""
+        INSERT INTO audit_log (action, trigger, response, user_id)
+        VALUES ('delete', ?, ?, ?)
+      """, (trigger, row['response'], deleted_by))
+      written["generation"] = self._change_counter(conn)
+      return True
+
+    def publish(deleted):
+      if not deleted:
+        return
+      generation = written["generation"]
+      with self._write_lock:
+        self._publish(generation, lambda snapshot: snapshot.without_command(trigger, generation))
+        self._suggestions.remove(trigger)
+
+    return self._write(write, publish)
 
   def delete_command(self, trigger: str, deleted_by: str) -> bool:
-    """Delete a custom command.
+    """Delete a custom command, and audit it in the same transaction.
 
     Args:
       trigger: The trigger text (case-insensitive)
@@ -183,31 +1632,7 @@ class StorageManager:
       True if command was deleted, False if not found
     """
     try:
-      # Get the command before deleting for audit log
-      conn = self._get_connection()
-      cursor = conn.execute("""
-        SELECT response FROM custom_commands
-        WHERE trigger = ?
-      """, (trigger.lower(),))
-      row = cursor.fetchone()
-
-      if not row:
-        return False
-
-      response = row['response']
-
-      with self._transaction() as conn:
-        cursor = conn.execute("""
-          DELETE FROM custom_commands
-          WHERE trigger = ?
-        """, (trigger.lower(),))
-
-        if cursor.rowcount > 0:
-          # Log deletion to audit
-          self.log_audit("delete", trigger.lower(), deleted_by, response)
-          return True
-
-      return False
+      return self.delete_command_async(trigger, deleted_by).result()
     except Exception as e:
       logging.error(f"Failed to delete custom command: {e}")
       return False
@@ -221,14 +1646,8 @@ class StorageManager:
     Returns:
       User ID if found, None otherwise
     """
-    conn = self._get_connection()
-    cursor = conn.execute("""
-      SELECT created_by FROM custom_commands
-      WHERE trigger = ?
-    """, (trigger.lower(),))
-
-    row = cursor.fetchone()
-    return row['created_by'] if row else None
+    record = self._current().commands.get(trigger.lower())
+    return record.created_by if record else None
 
   def get_audit_log(self, limit: int = 100) -> List[Dict]:
     """Get recent audit log entries.
@@ -239,27 +1658,421 @@ class StorageManager:
     Returns:
       List of dicts with audit log entries
     """
-    conn = self._get_connection()
-    cursor = conn.execute("""
-      SELECT action, trigger, response, user_id, timestamp
-      FROM audit_log
-      ORDER BY timestamp DESC, id DESC
-      LIMIT ?
-    """, (limit,))
+    return self.get_audit_page(limit)[0]
+
+  def get_audit_page(self, limit: int = 100, after: Optional[tuple] = None,
+                     **filters) -> tuple:
+    """Get one page of audit log entries, newest first.
+
+    Pages are found by key rather than OFFSET, so reading page 1000 costs
+    the same as reading page 1.
+
+    Args:
+      limit: Maximum number of entries to return
+      after: The cursor returned with the previous page, or None for the
+        first page
+      **filters: Only entries whose trigger, user_id or action equal the
+        given values
+
+    Returns:
+      (entries, cursor): a list of dicts with audit log entries, and the
+      cursor for the next page, or None if this was the last one
+    """
+    unknown = set(filters) - set(AUDIT_FILTERS)
+    if unknown:
+      raise TypeError(f"Can't filter the audit log by {', '.join(sorted(unknown))}")
+    conditions = [f"{column} = ?" for column in filters]
+    params = list(filters.values())
+    if after is not None:
+      conditions.append("(timestamp, id) < (?, ?)")
+      params.extend(after)
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
 
-    return [dict(row) for row in cursor.fetchall()]
+    self._writer.flush()
+    with self._pool.connection() as conn:
+      cursor = conn.execute(f"""
+        SELECT id, action, trigger, response, user_id, timestamp
+        FROM audit_log
+        {where}
+        ORDER BY timestamp DESC, id DESC
+        LIMIT ?
+      """, params + [limit])
+      entries = [dict(row) for row in cursor.fetchall()]
+    if len(entries) < limit:
+      return entries, None
+    return entries, (entries[-1]["timestamp"], entries[-1]["id"])
+
+  def iter_audit_log(self, page_size: int = 1000, **filters) -> Iterator[Dict]:
+    """Yield every audit log entry, newest first, a page at a time.
+
+    Args:
+      page_size: Entries to read per query
+      **filters: As for get_audit_page
+    """
+    cursor = None
+    while True:
+      entries, cursor = self.get_audit_page(page_size, cursor, **filters)
+      yield from entries
+      if cursor is None:
+        return
+
+  def search_commands(self, query: str, limit: int = 20, cursor=None) -> tuple:
+    """Find custom commands by the words in their triggers and responses.
+
+    Every word in query has to start a word in the trigger or response, so
+    "pan" finds "panic". Results are ordered by trigger, as in
+    list_all_commands and every other backend, rather than ranked.
+    Commands from before search was added are only found once they've
+    been indexed; see wait_for_search_index.
+
+    Args:
+      query: Words to look for; punctuation is ignored
+      limit: Most commands to return
+      cursor: The cursor returned with the previous page, or None for the
+        first page
+
+    Returns:
+      (commands, cursor): a list of dicts with keys trigger, response,
+      created_by and created_at, and the cursor for the next page, or None
+      if this was the last one
+    """
+    terms = search_terms(query)
+    if not terms:
+      return [], None
+    with self._pool.connection() as conn:
+      # One more than a page, to tell whether there's another.
+      rows = conn.execute("""
+        SELECT c.trigger, c.response, c.created_by, c.created_at
+        FROM commands_search
+        JOIN custom_commands AS c ON c.id = commands_search.rowid
+        WHERE commands_search MATCH ? AND c.trigger > ?
+        ORDER BY c.trigger
+        LIMIT ?
+      """, (_fts_query(terms), cursor or "", limit + 1)).fetchall()
+    commands = [CommandRecord(*row)._asdict() for row in rows[:limit]]
+    if len(rows) <= limit:
+      return commands, None
+    return commands, commands[-1]["trigger"]
+
+  def search_audit_log(self, query: str, limit: int = 100, cursor=None) -> tuple:
+    """Find audit log entries by the words in their triggers and responses.
+
+    Words are matched as for search_commands; entries come newest first.
+
+    Args:
+      query: Words to look for; punctuation is ignored
+      limit: Most entries to return
+      cursor: The cursor returned with the previous page, or None for the
+        first page
+
+    Returns:
+      (entries, cursor): a list of dicts like get_audit_page's, and the
+      cursor for the next page, or None if this was the last one
+    """
+    terms = search_terms(query)
+    if not terms:
+      return [], None
+    after = "AND audit_search.rowid < ?" if cursor is not None else ""
+    params = (_fts_query(terms),) + ((cursor,) if cursor is not None else ())
+
+    self.flush()
+    with self._pool.connection() as conn:
+      rows = conn.execute(f"""
+        SELECT a.id, a.action, a.trigger, a.response, a.user_id, a.timestamp
+        FROM audit_search
+        JOIN audit_log AS a ON a.id = audit_search.rowid
+        WHERE audit_search MATCH ? {after}
+        ORDER BY audit_search.rowid DESC
+        LIMIT ?
+      """, params + (limit + 1,)).fetchall()
+    entries = [dict(row) for row in rows[:limit]]
+    if len(rows) <= limit:
+      return entries, None
+    return entries, entries[-1]["id"]
 
   def close(self):
-    """Close database connections."""
-    if hasattr(self._local, 'conn'):
-      self._local.conn.close()
+    """Finish queued writes and close database connections."""
+    self._maintenance_stop.set()
+    self._maintenance_thread.join()
+    self.usage_flush_interval = None
+    self._backfill_stop.set()
+    if self._backfill_thread is not None:
+      self._backfill_thread.join()
+    if len(self._usage):
+      self._write(self._write_usage)
+    self._writer.close()
+    if self.snapshot_path:
+      self.save_snapshot()
+    self._pool.close()
+    with self._watch_lock:
+      self.coherence_interval = None
+      self._watch_conn.close()
+
+class MemoryStorage:
+  """Custom commands and audit log kept in memory, for tests and benchmarks.
+
+  Behaves like StorageManager without touching disk. Reads never lock:
+  every change builds a new CommandSnapshot and swaps it in. Writers take
+  a lock among themselves.
+  """
+
+  def __init__(self):
+    self._write_lock = threading.Lock()
+    self._snapshot = CommandSnapshot(0, {})
+    self._suggestions = SuggestionIndex()
+    # Oldest first; an entry's id is its position plus one.
+    self._audit = []
+    self._usage = UsageCounter()
+
+  @property
+  def generation(self) -> int:
+    return self._snapshot.generation
+
+  def snapshot(self) -> CommandSnapshot:
+    return self._snapshot
+
+  def command_snapshot(self) -> CommandIndex:
+    return self._snapshot.index
+
+  def _log(self, action, trigger, response, user_id):
+    """Append an audit entry. The caller must hold _write_lock."""
+    self._audit.append({
+      "id": len(self._audit) + 1, "action": action, "trigger": trigger, "response": response,
+      "user_id": user_id, "timestamp": _timestamp()})
+
+  @staticmethod
+  def _done(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+  def add_command_async(self, trigger: str, response: str, created_by: str) -> Future:
+    return self._done(self.add_command(trigger, response, created_by))
+
+  def add_command(self, trigger: str, response: str, created_by: str) -> Optional[str]:
+    problem = validate_command(trigger, response)
+    if problem:
+      logging.error(problem)
+      return None
+    trigger = trigger.lower()
+    with self._write_lock:
+      snapshot = self._snapshot
+      existing = snapshot.commands.get(trigger)
+      action = "update" if existing else "create"
+      record = (existing._replace(response=response) if existing else
+                CommandRecord(trigger, response, created_by, _timestamp()))
+      self._snapshot = snapshot.with_command(record, snapshot.generation + 1)
+      self._suggestions.add(trigger)
+      self._log(action, trigger, response, created_by)
+    return action
+
+  def delete_command_async(self, trigger: str, deleted_by: str) -> Future:
+    return self._done(self.delete_command(trigger, deleted_by))
+
+  def delete_command(self, trigger: str, deleted_by: str) -> bool:
+    trigger = trigger.lower()
+    with self._write_lock:
+      snapshot = self._snapshot
+      record = snapshot.commands.get(trigger)
+      if record is None:
+        return False
+      self._snapshot = snapshot.without_command(trigger, snapshot.generation + 1)
+      self._suggestions.remove(trigger)
+      self._log("delete", trigger, record.response, deleted_by)
+    return True
+
+  def import_commands(self, commands: Iterable, imported_by: str, on_conflict: str = "skip",
+                      chunk_size: int = 1000) -> Dict[str, int]:
+    """Add many commands at once, all or nothing; see StorageManager.import_commands."""
+    if on_conflict not in CONFLICT_POLICIES:
+      raise ValueError(f"on_conflict must be one of {CONFLICT_POLICIES}, not {on_conflict!r}")
+    counts = {"created": 0, "updated": 0, "skipped": 0, "invalid": 0}
+    with self._write_lock:
+      snapshot = self._snapshot
+      records = dict(snapshot.commands)
+      entries = []
+      for command in commands:
+        trigger, response = command[0], command[1]
+        problem = validate_command(trigger, response)
+        if problem:
+          logging.warning(f"Not importing {trigger!r}: {problem}")
+          counts["invalid"] += 1
+          continue
+        trigger = trigger.lower()
+        created_by = command[2] if len(command) > 2 and command[2] else imported_by
+        existing = records.get(trigger)
+        if existing and on_conflict == "fail":
+          raise CommandConflictError(f"Triggers already exist: {trigger}")
+        if existing and on_conflict == "skip":
+          counts["skipped"] += 1
+          continue
+        records[trigger] = (existing._replace(response=response) if existing else
+                            CommandRecord(trigger, response, created_by, _timestamp()))
+        counts["updated" if existing else "created"] += 1
+        entries.append(("update" if existing else "create", trigger, response, imported_by))
+      if entries:
+        self._snapshot = CommandSnapshot(snapshot.generation + len(entries), records)
+        for _, trigger, _, _ in entries:
+          self._suggestions.add(trigger)
+        for entry in entries:
+          self._log(*entry)
+    return counts
+
+  def iter_commands(self) -> Iterator[CommandRecord]:
+    return iter(self._snapshot.sorted_commands())
+
+  def get_command(self, trigger: str) -> Optional[str]:
+    record = self._snapshot.commands.get(trigger.lower())
+    return record.response if record else None
+
+  def get_command_creator(self, trigger: str) -> Optional[str]:
+    record = self._snapshot.commands.get(trigger.lower())
+    return record.created_by if record else None
+
+  def match_command(self, command: str) -> Optional[str]:
+    return self._snapshot.index.match(command)
+
+  def suggest_commands(self, text: str, limit: int = 3) -> List[tuple]:
+    return self._suggestions.suggest(text, limit)
+
+  def list_all_commands(self) -> List[Dict]:
+    return [record._asdict() for record in self._snapshot.sorted_commands()]
+
+  def log_audit(self, action: str, trigger: str, user_id: str, response: str = None):
+    with self._write_lock:
+      self._log(action, trigger, response, user_id)
+
+  def flush(self):
+    pass  # Nothing is ever waiting to be written.
+
+  def get_audit_log(self, limit: int = 100) -> List[Dict]:
+    return self.get_audit_page(limit)[0]
+
+  def get_audit_page(self, limit: int = 100, after: Optional[tuple] = None,
+                     **filters) -> tuple:
+    """One page of audit entries, newest first; see StorageManager.get_audit_page."""
+    unknown = set(filters) - set(AUDIT_FILTERS)
+    if unknown:
+      raise TypeError(f"Can't filter the audit log by {', '.join(sorted(unknown))}")
+    entries = []
+    # Appended in time order, so newest first is just backwards.
+    for entry in reversed(self._audit):
+      if after is not None and (entry["timestamp"], entry["id"]) >= tuple(after):
+        continue
+      if all(entry[column] == value for column, value in filters.items()):
+        entries.append(dict(entry))
+        if len(entries) == limit:
+          return entries, (entry["timestamp"], entry["id"])
+    return entries, None
+
+  def iter_audit_log(self, page_size: int = 1000, **filters) -> Iterator[Dict]:
+    cursor = None
+    while True:
+      entries, cursor = self.get_audit_page(page_size, cursor, **filters)
+      yield from entries
+      if cursor is None:
+        return
+
+  def search_commands(self, query: str, limit: int = 20, cursor=None) -> tuple:
+    """Find commands by their words, ordered by trigger; see StorageManager.search_commands."""
+    terms = search_terms(query)
+    if not terms:
+      return [], None
+    commands = []
+    for record in self._snapshot.sorted_commands():
+      if cursor is not None and record.trigger <= cursor:
+        continue
+      if terms_match(terms, record.trigger, record.response):
+        if len(commands) == limit:
+          return commands, commands[-1]["trigger"]
+        commands.append(record._asdict())
+    return commands, None
+
+  def search_audit_log(self, query: str, limit: int = 100, cursor=None) -> tuple:
+    terms = search_terms(query)
+    if not terms:
+      return [], None
+    entries = []
+    for entry in reversed(self._audit):
+      if cursor is not None and entry["id"] >= cursor:
+        continue
+      if terms_match(terms, entry["trigger"], entry["response"]):
+        if len(entries) == limit:
+          return entries, entries[-1]["id"]
+        entries.append(dict(entry))
+    return entries, None
+
+  def wait_for_search_index(self, timeout: Optional[float] = None) -> bool:
+    return True
+
+  def record_usage(self, kind: str, trigger: str):
+    self._usage.record(kind, trigger)
+
+  def flush_usage(self) -> int:
+    return 0
+
+  def get_usage(self, kind: Optional[str] = None, limit: Optional[int] = 100) -> List[Dict]:
+    rows = [row for row in self._usage.pending() if kind is None or row[0] == kind]
+    rows.sort(key=lambda row: row[1])
+    rows.sort(key=lambda row: (row[2], row[3]), reverse=True)
+    return [dict(zip(("kind", "trigger", "hits", "last_used"), row)) for row in rows[:limit]]
+
+  def close(self):
+    pass
+
+
+def _timestamp(when: Optional[float] = None) -> str:
+  """A UTC time, formatted like SQLite's CURRENT_TIMESTAMP.
+
+  Args:
+    when: Seconds since the epoch; defaults to now
+  """
+  when = time.time() if when is None else when
+  return datetime.fromtimestamp(when, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Names create_storage() accepts, and that SCREAMBOT_STORAGE can be set to.
+BACKENDS = ("sqlite", "sqlite-memory", "memory")
+
+
+def create_storage(backend: Optional[str] = None, db_path: str = "screambot.db",
+                   **kwargs) -> StorageBackend:
+  """Open the configured storage backend.
+
+  Args:
+    backend: "sqlite" for a database file, "sqlite-memory" for a private
+      in-memory SQLite database, or "memory" for MemoryStorage. Defaults
+      to the SCREAMBOT_STORAGE environment variable, then "sqlite".
+    db_path: Database file for the "sqlite" backend
+    **kwargs: Passed to StorageManager for the SQLite backends
+  """
+  backend = backend or os.environ.get("SCREAMBOT_STORAGE") or "sqlite"
+  if backend == "sqlite":
+    return StorageManager(db_path, **kwargs)
+  if backend == "sqlite-memory":
+    return StorageManager(":memory:", **kwargs)
+  if backend == "memory":
+    return MemoryStorage()
+  raise ValueError(f"Unknown storage backend {backend!r}; choose from {', '.join(BACKENDS)}")
+
 
 # Global singleton
 _storage = None
 
-def get_storage() -> StorageManager:
-  """Get or create the global storage manager."""
+def get_storage() -> StorageBackend:
+  """Get or create the global storage, as configured by SCREAMBOT_STORAGE.
+
+  SQLite storage warm-starts from the snapshot file named by
+  SCREAMBOT_SNAPSHOT, screambot.db.snapshot by default; set it empty for none.
+  """
   global _storage
   if _storage is None:
-    _storage = StorageManager()
+    _storage = create_storage(
+      snapshot_path=os.environ.get("SCREAMBOT_SNAPSHOT", "screambot.db.snapshot") or None)
   return _storage
+
+
+def set_storage(backend: Optional[StorageBackend]):
+  """Make get_storage() return backend, or create one again if None."""
+  global _storage
+  _storage = backend
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import unittest
+
+import commands_io
+from storage import StorageManager
+
+
+class TestCommandsIO(unittest.TestCase):
+
+  def setUp(self):
+    self.test_db = "test_commands_io.db"
+    if os.path.exists(self.test_db):
+      os.remove(self.test_db)
+    self.storage = StorageManager(self.test_db)
+
+  def tearDown(self):
+    self.storage.close()
+    if os.path.exists(self.test_db):
+      os.remove(self.test_db)
+
+  def round_trip(self, file_format):
+    self.storage.add_command("panic", "breathe, \"slowly\"", "U123")
+    self.storage.add_command("hug", "hugs $what\nand more", "U456")
+    out = io.StringIO()
+    self.assertEqual(commands_io.WRITERS[file_format](self.storage.iter_commands(), out), 2)
+    return list(commands_io.READERS[file_format](io.StringIO(out.getvalue())))
+
+  def test_jsonl_round_trip(self):
+    self.assertEqual(self.round_trip("jsonl"), [
+      ("hug", "hugs $what\nand more", "U456"), ("panic", "breathe, \"slowly\"", "U123")])
+
+  def test_csv_round_trip(self):
+    self.assertEqual(self.round_trip("csv"), [
+      ("hug", "hugs $what\nand more", "U456"), ("panic", "breathe, \"slowly\"", "U123")])
+
+  def test_read_jsonl_skips_bad_lines(self):
+    lines = io.StringIO('{"trigger": "panic", "response": "breathe"}\nnot json\n\n{"trigger": "x"}\n')
+    self.assertEqual(list(commands_io.read_jsonl(lines)), [("panic", "breathe", None)])
+
+  def test_guess_format(self):
+    self.assertEqual(commands_io.guess_format("commands.CSV"), "csv")
+    self.assertEqual(commands_io.guess_format("commands.jsonl"), "jsonl")
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import string
+import unittest
+from matcher import (CommandIndex, PrefixTrie, ResponseTemplate, SubstringMatcher,
+                     SuggestionIndex)
+
+class TestResponseTemplate(unittest.TestCase):
+
+  def test_matches_safe_substitute(self):
+    templates = ["I hate $what SO MUCH.", "${what}!", "$what and $what", "no placeholder",
+                 "costs $$5 for $what", "$who wants $what", "trailing $", "$ what", "${what",
+                 "$whatever", ""]
+    for text in templates:
+      for what in ["cats", "", "$what", "a $b"]:
+        self.assertEqual(ResponseTemplate(text).render(what),
+                         string.Template(text).safe_substitute(what=what), (text, what))
+
+  def test_placeholders(self):
+    self.assertEqual(ResponseTemplate("$who loves ${what}").placeholders, {"who", "what"})
+    self.assertEqual(ResponseTemplate("plain").placeholders, set())
+
+  def test_constant_render(self):
+    template = ResponseTemplate("plain")
+    self.assertIs(template.render("ignored"), template.render("other"))
+
+
+class TestPrefixTrie(unittest.TestCase):
+
+  def test_prefixes_shortest_first(self):
+    trie = PrefixTrie()
+    trie.insert("lo", 1)
+    trie.insert("love", 2)
+    trie.insert("lovely", 3)
+    self.assertEqual(list(trie.prefixes("lovely day")), [(2, 1), (4, 2), (6, 3)])
+    self.assertEqual(list(trie.prefixes("hate")), [])
+
+  def test_remove_prunes(self):
+    trie = PrefixTrie()
+    trie.insert("love", 1)
+    trie.insert("lovely", 2)
+    self.assertTrue(trie.remove("lovely"))
+    self.assertFalse(trie.remove("lovely"))
+    self.assertFalse(trie.remove("lov"))
+    self.assertEqual(list(trie.prefixes("lovely")), [(4, 1)])
+    self.assertEqual(len(trie), 1)
+
+  def test_copy_is_unaffected_by_updates(self):
+    trie = PrefixTrie([("love", 1)])
+    snapshot = trie.copy()
+    trie.insert("lovely", 2)
+    trie.insert("love", 3)
+    trie.remove("love")
+    self.assertEqual(list(snapshot.prefixes("lovely")), [(4, 1)])
+    self.assertEqual(list(trie.prefixes("lovely")), [(6, 2)])
+
+
+class TestCommandIndex(unittest.TestCase):
+
+  def test_version_changes_with_contents(self):
+    index = CommandIndex([("hug", "squeeze")])
+    copy = index.copy()
+    self.assertNotEqual(copy.version, index.version)
+    version = copy.version
+    copy.add("cry", "sob")
+    self.assertNotEqual(copy.version, version)
+    version = copy.version
+    copy.remove("cry")
+    self.assertNotEqual(copy.version, version)
+
+  def test_exact_beats_prefix(self):
+    index = CommandIndex([("hug", "exact"), ("hu", "prefix $what")])
+    self.assertEqual(index.match("hug"), "exact")
+    self.assertEqual(index.match("hu there"), "prefix there")
+
+  def test_exact_match_is_not_substituted(self):
+    index = CommandIndex([("love", "I love $what")])
+    self.assertEqual(index.match("love"), "I love $what")
+    self.assertEqual(index.match("love cats"), "I love cats")
+
+  def test_whitespace_remainder_is_not_a_template_match(self):
+    index = CommandIndex([("panic", "breathe $what")])
+    self.assertIsNone(index.match("panic   "))
+
+  def test_copy(self):
+    index = CommandIndex([("panic", "breathe")])
+    snapshot = index.copy()
+    index.add("panic", "scream")
+    index.add("calm", "ok")
+    self.assertEqual(snapshot.match("panic"), "breathe")
+    self.assertIsNone(snapshot.match("calm"))
+    self.assertEqual(index.match("panic"), "scream")
+
+  def test_remove(self):
+    index = CommandIndex([("panic", "breathe")])
+    self.assertTrue(index.remove("PANIC"))
+    self.assertFalse(index.remove("panic"))
+    self.assertIsNone(index.match("panic"))
+    self.assertEqual(len(index), 0)
+
+
+class TestSubstringMatcher(unittest.TestCase):
+
+  def test_dict_order_wins_over_position(self):
+    matcher = SubstringMatcher({"tea": 1, "ai": 2, "steak": 3})
+    self.assertEqual(matcher.match("i said steak"), ("tea", 1))
+    self.assertEqual(matcher.match("said"), ("ai", 2))
+    self.assertIsNone(matcher.match("nothing here"))
+
+  def test_overlapping_patterns_via_failure_links(self):
+    matcher = SubstringMatcher({"she": 1, "he": 2, "hers": 3})
+    self.assertEqual(matcher.match("ushers"), ("she", 1))
+    self.assertEqual(matcher.match("hers"), ("he", 2))
+    matcher = SubstringMatcher({"hers": 1, "she": 2})
+    self.assertEqual(matcher.match("ushers"), ("hers", 1))
+
+  def test_agrees_with_naive_scan(self):
+    import responses
+    rules = responses.CONTAIN_COMMANDS
+    matcher = SubstringMatcher(rules)
+    texts = ["can you destroy it", "good work", "tech industry", "why though",
+             "a birthday cookie", "sedgwick systemctl", "nothing", "thanks ai"]
+    for text in texts:
+      expected = next(((k, v) for k, v in rules.items() if k in text), None)
+      self.assertEqual(matcher.match(text), expected, text)
+
+
+class TestSuggestionIndex(unittest.TestCase):
+
+  def test_suggests_close_triggers(self):
+    index = SuggestionIndex(["hug", "tableflip", "thank you", "thanks"])
+    self.assertEqual(index.suggest("hugg"), [("hug", 0.5)])
+    self.assertEqual([t for t, _ in index.suggest("thank yuo")], ["thank you", "thanks"])
+    self.assertEqual(index.suggest("someunknownthing"), [])
+
+  def test_incremental_updates(self):
+    index = SuggestionIndex(["panic"])
+    index.add("panic room")
+    index.remove("panic")
+    self.assertEqual([t for t, _ in index.suggest("panic rooom")], ["panic room"])
+    self.assertEqual(len(index), 1)
+
+  def test_candidate_limit_still_finds_matches(self):
+    index = SuggestionIndex(["custom%d thing" % i for i in range(2000)], max_candidates=50)
+    suggestions = index.suggest("custom123 thng")
+    self.assertTrue(suggestions)
+    self.assertLessEqual(len(suggestions), 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
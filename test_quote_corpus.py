@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import responses
+from quote_corpus import QuoteCorpus, QuoteLibrary
+
+class TestQuoteCorpus(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, "tech.txt")
+    self.write("first quote\n\nsecond quote\r\nthird — quote")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def write(self, text, path=None):
+    with open(path or self.path, "w", encoding="utf-8", newline="") as f:
+      f.write(text)
+
+  def test_reads_quotes_by_offset(self):
+    corpus = QuoteCorpus(self.path)
+    self.assertEqual(len(corpus), 3)
+    self.assertEqual([corpus.quote(i) for i in range(3)],
+                     ["first quote", "second quote", "third — quote"])
+    self.assertIn(corpus.random_quote(random.Random(1)), ["first quote", "second quote", "third — quote"])
+    corpus.close()
+
+  def test_index_saved_and_reused(self):
+    QuoteCorpus(self.path).close()
+    self.assertTrue(os.path.exists(self.path + ".idx"))
+    mtime = os.stat(self.path + ".idx").st_mtime_ns
+
+    corpus = QuoteCorpus(self.path)
+    self.assertEqual(os.stat(self.path + ".idx").st_mtime_ns, mtime)
+    self.assertEqual(len(corpus), 3)
+    corpus.close()
+
+  def test_index_rebuilt_when_source_changes(self):
+    QuoteCorpus(self.path).close()
+    time.sleep(0.01)
+    self.write("only quote\n")
+    corpus = QuoteCorpus(self.path)
+    self.assertEqual(len(corpus), 1)
+    self.assertEqual(corpus.quote(0), "only quote")
+    corpus.close()
+
+  def test_index_kept_in_memory_if_it_cant_be_saved(self):
+    with mock.patch("quote_corpus.os.replace", side_effect=PermissionError("read-only")):
+      corpus = QuoteCorpus(self.path)
+    self.assertEqual(os.listdir(self.dir), ["tech.txt"])
+    self.assertEqual(len(corpus), 3)
+    self.assertEqual(corpus.quote(2), "third — quote")
+    corpus.close()
+
+  def test_truncated_index_rebuilt(self):
+    with open(self.path + ".idx", "wb") as f:
+      f.write(b"SBQI")
+    corpus = QuoteCorpus(self.path)
+    self.assertEqual(len(corpus), 3)
+    corpus.close()
+
+  def test_empty_file(self):
+    self.write("")
+    corpus = QuoteCorpus(self.path)
+    self.assertEqual(len(corpus), 0)
+    self.assertIsNone(corpus.random_quote())
+    corpus.close()
+
+  def test_library_and_random_quote(self):
+    library = QuoteLibrary(self.dir)
+    self.assertEqual(library.categories(), ["tech"])
+    self.assertIsNone(library.corpus("missing"))
+    self.assertIsNone(library.corpus("../tech"))
+
+    responses.set_quote_library(library)
+    try:
+      self.assertIn(responses.random_quote("tech"), ["first quote", "second quote", "third — quote"])
+      # Categories without a file still use the built-in quotes.
+      self.assertIn(responses.random_quote("feminism"), responses.quotes["feminism"])
+    finally:
+      responses.set_quote_library(None)
+      library.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import replay
+import responses
+import storage
+from storage import MemoryStorage, StorageManager
+
+BOT_ID = "UA1234567"
+
+
+class TestReplay(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.write("users.json", [
+      {"id": BOT_ID, "name": "screambot", "is_bot": True},
+      {"id": "U123", "name": "alice", "real_name": "Alice"},
+    ])
+    self.write("channels.json", [{"id": "C001", "name": "general"},
+                                 {"id": "C002", "name": "random"}])
+    self.write("general/2024-01-01.json", [
+      {"type": "message", "user": "U123", "text": "screambot hug"},
+      {"type": "message", "subtype": "channel_join", "user": "U123", "text": "joined"},
+      {"type": "reaction_added", "user": "U123"},
+      {"type": "message", "subtype": "message_changed",
+       "message": {"user": "U123", "text": "screambot panic"}},
+    ])
+    self.write("general/2024-01-02.json", [
+      {"type": "message", "user": "U123", "text": "just chatting"},
+      {"type": "message", "bot_id": "B1", "text": "screambot hug"},
+    ])
+    self.write("random/2024-01-01.json", [
+      {"type": "message", "user": "U123", "text": "screambot custom"},
+    ])
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def write(self, name, data):
+    path = os.path.join(self.dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+      json.dump(data, f)
+
+  @contextlib.contextmanager
+  def memory_storage(self):
+    backend = MemoryStorage()
+    storage.set_storage(backend)
+    responses.set_storage(backend)
+    try:
+      yield backend
+    finally:
+      responses.set_storage(None)
+      storage.set_storage(None)
+
+  def test_find_bot_id(self):
+    self.assertEqual(replay.find_bot_id(self.dir), BOT_ID)
+
+  def test_iter_events(self):
+    events = list(replay.iter_events(self.dir))
+    # Everything but the reaction, oldest day first, channels by name.
+    self.assertEqual(len(events), 6)
+    self.assertEqual([event["channel"] for event in events], ["C001"] * 5 + ["C002"])
+    self.assertEqual(events[2]["subtype"], "message_changed")
+
+    events = list(replay.iter_events(self.dir, channels=["random"]))
+    self.assertEqual([event["text"] for event in events], ["screambot custom"])
+
+  def test_replay_report(self):
+    with self.memory_storage() as backend:
+      backend.add_command("panic", "breathe", "U123")
+      report = replay.replay(replay.iter_events(self.dir), BOT_ID)
+    self.assertEqual(report["events"], 6)
+    # The join and the bot's own message are skipped.
+    self.assertEqual(report["handled"], 4)
+    self.assertEqual(report["matched"], 3)
+    self.assertEqual(report["said"], 2)
+    self.assertEqual(report["ui"], 1)
+    self.assertEqual(report["tables"], {"standalone": 1, "custom": 1, "custom_ui": 1})
+
+  def test_replay_storage_copies_without_writing(self):
+    db_path = os.path.join(self.dir, "screambot.db")
+    manager = StorageManager(db_path)
+    manager.add_command("panic", "breathe", "U123")
+    manager.close()
+    with open(db_path, "rb") as f:
+      before = f.read()
+
+    backend = replay.replay_storage(db_path)
+    self.assertEqual(backend.get_command("panic"), "breathe")
+    self.assertEqual(backend.get_command_creator("panic"), "U123")
+    with open(db_path, "rb") as f:
+      self.assertEqual(f.read(), before)
+
+  def test_main_with_missing_db(self):
+    db_path = os.path.join(self.dir, "missing.db")
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      self.assertEqual(replay.main([self.dir, "--db", db_path, "--json"]), 0)
+    self.assertEqual(json.loads(output.getvalue())["events"], 6)
+    self.assertFalse(os.path.exists(db_path))
+
+
+if __name__ == '__main__':
+  unittest.main()
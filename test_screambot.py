@@ -3,53 +3,78 @@
 # Run the tests with
 # python3 -m pytest
 
+import logging
+import multiprocessing
 import unittest
 import responses
+import tracing
+from matcher import CommandIndex
+
+BOT_ID = "UA1234567"
+
+RESPONSE_CASES = {
+  "<@UA1234567> hug": ":virtualhug:",
+  "<@UA1234567> hug!": ":virtualhug:",
+  "<@UA1234567> scream?": "AAAARRGGHHHHHHHHHHHHHH",
+  "<@UA1234567> scream??!?!?!": "AAAARRGGHHHHHHHHHHHHHH",
+  "<@UA1234567> hug a cat": ":virtualhug: for a cat",
+  "<@UA1234567> :love:": ":love::love::love:!",
+  "<@UA1234567>: :cat:": ":cat::cat::cat:!",
+  "<@UA1234567> can you even believe it:": "I literally can't even.",
+  "<@UA1234567> lose it about pocketless dresses": "AGH what is GOING ON with pocketless dresses? WHY is it LIKE THAT?",
+  "<@UA1234567> hate spam calls": "I hate spam calls SO MUCH. Ugh, the worst.",
+  "<@UA1234567>  hate double whitespace": "I hate double whitespace SO MUCH. Ugh, the worst.",
+  "<@UA1234567> scream the scream code is a hack, Tanya.": "THE SCREAM CODE IS A HACK, TANYA.",
+  "<@UA1234567> scream something": "SOMETHING",
+  "<@UA1234567>, scream I know about commas now": "I KNOW ABOUT COMMAS NOW",
+  "screambot scream something": "SOMETHING",
+  "screambot scream I love cats": "I LOVE CATS",
+  "<@UA1234567> scream <system> is broken": "<SYSTEM> IS BROKEN",
+  "<@UA1234567> I love you, screambot": "It's mutual, I promise you.",
+  "<@UA1234567> i love you, screambot": "It's mutual, I promise you.",
+  "<@UA1234567> blame systemd": "Grr, systemd strikes again.",
+  "<@UA1234567> destroy Mountain View": ":t-rex: RARRRRR DESTROY MOUNTAIN VIEW :t-rex:",
+  "screambot blame the rain": "Grr, the rain strikes again.",
+  "Screambot yo": "Yo.",
+  "@screambot yo": "Yo.",
+  "@Screambot yo": "Yo.",
+  "Screambot, yo": "Yo.",
+  "Screambot     yo": "Yo.",
+  "Screambot hate on mosquitoes": "You know what I really hate? What I really hate is mosquitoes.",
+  "does screambot want a botsnack?": ":cookie:",
+  "thanks, @screambot": "Any time, friend.",
+  "good work, screambot": "WERK!",
+  "&lt;3 screambot": ":heart:",
+  "<@UA1234567> someunknownthing": "Sorry, some_user, I don't know how to someunknownthing yet. You can tell me how by typing `screambot custom`. Feel free to DM me if you prefer to try it out in a DM instead of in a channel.",
+}
+
 
 class TestScreambot(unittest.TestCase):
 
   def test_response(self):
     bot_id = "UA1234567"
-    cases = {
-      "<@UA1234567> hug": ":virtualhug:",
-      "<@UA1234567> hug!": ":virtualhug:",
-      "<@UA1234567> scream?": "AAAARRGGHHHHHHHHHHHHHH",
-      "<@UA1234567> scream??!?!?!": "AAAARRGGHHHHHHHHHHHHHH",
-      "<@UA1234567> hug a cat": ":virtualhug: for a cat",
-      "<@UA1234567> :love:": ":love::love::love:!",
-      "<@UA1234567>: :cat:": ":cat::cat::cat:!",
-      "<@UA1234567> can you even believe it:": "I literally can't even.",
-      "<@UA1234567> lose it about pocketless dresses": "AGH what is GOING ON with pocketless dresses? WHY is it LIKE THAT?",
-      "<@UA1234567> hate spam calls": "I hate spam calls SO MUCH. Ugh, the worst.",
-      "<@UA1234567>  hate double whitespace": "I hate double whitespace SO MUCH. Ugh, the worst.",
-      "<@UA1234567> scream the scream code is a hack, Tanya.": "THE SCREAM CODE IS A HACK, TANYA.",
-      "<@UA1234567> scream something": "SOMETHING",
-      "<@UA1234567>, scream I know about commas now": "I KNOW ABOUT COMMAS NOW",
-      "screambot scream something": "SOMETHING",
-      "screambot scream I love cats": "I LOVE CATS",
-      "<@UA1234567> scream <system> is broken": "<SYSTEM> IS BROKEN",
-      "<@UA1234567> I love you, screambot": "It's mutual, I promise you.",
-      "<@UA1234567> i love you, screambot": "It's mutual, I promise you.",
-      "<@UA1234567> blame systemd": "Grr, systemd strikes again.",
-      "<@UA1234567> destroy Mountain View": ":t-rex: RARRRRR DESTROY MOUNTAIN VIEW :t-rex:",
-      "screambot blame the rain": "Grr, the rain strikes again.",
-      "Screambot yo": "Yo.",
-      "@screambot yo": "Yo.",
-      "@Screambot yo": "Yo.",
-      "Screambot, yo": "Yo.",
-      "Screambot     yo": "Yo.",
-      "Screambot hate on mosquitoes": "You know what I really hate? What I really hate is mosquitoes.",
-      "does screambot want a botsnack?": ":cookie:",
-      "thanks, @screambot": "Any time, friend.",
-      "good work, screambot": "WERK!",
-      "&lt;3 screambot": ":heart:",
-      "<@UA1234567> someunknownthing": "Sorry, some_user, I don't know how to someunknownthing yet. You can tell me how by typing `screambot custom`. Feel free to DM me if you prefer to try it out in a DM instead of in a channel.",
-    }
-
-    for message, expected in cases.items():
+    for message, expected in RESPONSE_CASES.items():
       response = responses.create_response(message, bot_id, "some_user")
       self.assertEqual(response, expected)
 
+  def test_create_responses_matches_create_response(self):
+    messages = [(message, "U123") for message in RESPONSE_CASES]
+    got = list(responses.create_responses(messages, BOT_ID, speakers={"U123": "some_user"}))
+    self.assertEqual(got, list(RESPONSE_CASES.values()))
+
+  def test_create_responses_in_processes(self):
+    messages = [(message, "U123") for message in RESPONSE_CASES] * 3
+    got = list(responses.create_responses(messages, BOT_ID, speakers={"U123": "some_user"},
+                                          processes=2, chunk_size=7))
+    self.assertEqual(got, list(RESPONSE_CASES.values()) * 3)
+
+  def test_unknown_command_suggests_builtin(self):
+    response = responses.create_response("screambot tableflp", BOT_ID, "some_user")
+    self.assertEqual(response,
+                     "Sorry, some_user, I don't know how to tableflp yet. Did you mean `tableflip`? "
+                     "You can tell me how by typing `screambot custom`. Feel free to DM me if you "
+                     "prefer to try it out in a DM instead of in a channel.")
+
   def test_help(self):
     bot_id = "UA1234567"
     cases = [
@@ -151,6 +176,133 @@ class TestHelperFunctions(unittest.TestCase):
     self.assertIsNone(result)
 
 
+def _linear_starter_matches(command):
+  """The original per-table scan, kept as a reference for the dispatcher."""
+  matches = []
+  for starts in [responses.STARTER_COMMANDS_LONG, responses.STARTER_COMMANDS_EE,
+                 responses.STARTER_COMMANDS]:
+    for text in starts.keys():
+      if command.lower().startswith(text.lower()):
+        matches.append((text, command[len(text):]))
+        break
+  return matches
+
+
+def _dispatcher_matches(command):
+  return [(key, thing) for _, key, _, thing in responses._STARTER_DISPATCHER.match(command)]
+
+
+class TestStarterDispatcher(unittest.TestCase):
+  """The compiled dispatcher must agree with scanning each table in turn."""
+
+  def test_matches_linear_scan(self):
+    commands = [responses._parse_message(message, BOT_ID) for message in RESPONSE_CASES]
+    commands += ["rant", "rant about mondays", "flipping out", "hi there",
+                 "what can you do?", "i love you", "is it friday", "help me"]
+    for command in commands:
+      if not command:
+        continue
+      self.assertEqual(_dispatcher_matches(command),
+                       _linear_starter_matches(command), command)
+
+  def test_mixed_case_keeps_original_remainder(self):
+    self.assertEqual(_dispatcher_matches("Blame The Rain"),
+                     _linear_starter_matches("Blame The Rain"))
+
+
+class TestResponseCache(unittest.TestCase):
+
+  def setUp(self):
+    responses.set_response_cache_size(16)
+
+  def tearDown(self):
+    responses.set_response_cache_size(1024)
+
+  def test_repeated_command_hits_cache(self):
+    for _ in range(3):
+      self.assertEqual(responses.create_response("screambot hug", BOT_ID), ":virtualhug:")
+    stats = responses.response_cache_stats()
+    self.assertEqual(stats["hits"], 2)
+    self.assertEqual(stats["misses"], 1)
+
+  def test_random_handlers_bypass_cache(self):
+    for _ in range(3):
+      self.assertIn(responses.create_response("screambot hello", BOT_ID), responses.greetings)
+    stats = responses.response_cache_stats()
+    self.assertEqual(stats["hits"], 0)
+    self.assertEqual(stats["size"], 0)
+
+  def test_unknown_command_not_cached(self):
+    responses.create_response("screambot frobnicate", BOT_ID, "alice")
+    response = responses.create_response("screambot frobnicate", BOT_ID, "bob")
+    self.assertIn("Sorry, bob,", response)
+
+  def test_matches_cached_per_index(self):
+    old = CommandIndex([("panic", "breathe")])
+    new = old.copy()
+    new.add("panic", "scream")
+    self.assertEqual(responses._handle_direct_command("panic", "alice", "U1", new), "scream")
+    # A thread still holding the old index caches its answer late.
+    self.assertEqual(responses._handle_direct_command("panic", "alice", "U1", old), "breathe")
+    self.assertEqual(responses._handle_direct_command("panic", "alice", "U1", new), "scream")
+    self.assertEqual(responses.response_cache_stats()["hits"], 1)
+
+  def test_eviction(self):
+    responses.set_response_cache_size(2)
+    for command in ["hug", "cry", "sob"]:
+      responses.create_response("screambot " + command, BOT_ID)
+    stats = responses.response_cache_stats()
+    self.assertEqual(stats["evictions"], 1)
+    self.assertEqual(stats["size"], 2)
+
+
+class TestTracing(unittest.TestCase):
+
+  def setUp(self):
+    responses.set_response_cache_size(0)
+
+  def tearDown(self):
+    responses.set_tracer(None)
+    responses.set_response_cache_size(1024)
+
+  def test_records_matched_rule(self):
+    traces = []
+    responses.set_tracer(tracing.CallbackSink(traces.append))
+    responses.create_response("screambot hug", BOT_ID)
+    responses.create_response("screambot hate rain", BOT_ID)
+    responses.create_response("screambot can you even", BOT_ID)
+    responses.create_response("nothing to see", BOT_ID)
+    self.assertEqual([(t.table, t.key) for t in traces],
+                     [("standalone", "hug"), ("starter", "hate "), ("contain", "can you even")])
+
+  def test_records_stages_in_order(self):
+    traces = []
+    responses.set_tracer(tracing.CallbackSink(traces.append))
+    responses.create_response("screambot frobnicate", BOT_ID)
+    self.assertEqual([stage for stage, _ in traces[0].stages],
+                     ["cache", "standalone", "standalone_stripped", "emoji", "starters", "contain"])
+    self.assertEqual(traces[0].table, "unknown")
+
+  def test_histogram_sink(self):
+    sink = tracing.HistogramSink()
+    responses.set_tracer(sink)
+    for _ in range(5):
+      responses.create_response("screambot hug", BOT_ID)
+    summary = sink.summary()
+    self.assertEqual(summary["standalone"]["count"], 5)
+    self.assertIsNotNone(summary["standalone"]["p99_us"])
+    self.assertEqual(sink.rule_hits[("standalone", "hug")], 5)
+    dead = sink.dead_rules(responses.known_rules())
+    self.assertIn(("standalone", "cry"), dead)
+    self.assertNotIn(("standalone", "hug"), dead)
+
+  def test_log_sink(self):
+    responses.set_tracer(tracing.LogSink(level=logging.INFO))
+    with self.assertLogs("screambot.trace", level="INFO") as logs:
+      responses.create_response("screambot hug", BOT_ID)
+    self.assertIn("table=standalone key='hug'", logs.output[0])
+
+
 class TestLambdaCommands(unittest.TestCase):
   """Test commands that use callable lambdas instead of string templates."""
 
@@ -165,6 +317,16 @@ class TestLambdaCommands(unittest.TestCase):
     self.assertIn("TOKYO", response)
     self.assertIn(":t-rex:", response)
 
+  def test_destroy_without_city_is_random(self):
+    """A bare "destroy " picks a new city every time, not one cached forever."""
+    responses.cities, cities = ["Tokyo", "Paris"], responses.cities
+    try:
+      seen = {responses.create_response("<@UA1234567> destroy ", "UA1234567")
+              for _ in range(50)}
+    finally:
+      responses.cities = cities
+    self.assertEqual(len(seen), 2)
+
   def test_help_lambda(self):
     bot_id = "UA1234567"
     response = responses.create_response("screambot help", bot_id)
@@ -261,13 +423,16 @@ class TestCustomCommands(unittest.TestCase):
   """Test custom command functionality."""
 
   def setUp(self):
-    """Set up test storage."""
+    """Set up test storage.
+
+    Uses the backend named by SCREAMBOT_STORAGE, in memory by default.
+    """
     import os
-    from storage import StorageManager
+    from storage import create_storage
     self.test_db = "test_screambot.db"
     if os.path.exists(self.test_db):
       os.remove(self.test_db)
-    storage = StorageManager(self.test_db)
+    storage = create_storage(os.environ.get("SCREAMBOT_STORAGE", "memory"), self.test_db)
     responses.set_storage(storage)
     self.storage = storage
 
@@ -307,6 +472,70 @@ class TestCustomCommands(unittest.TestCase):
     )
     self.assertEqual(response, "breathe")
 
+  def test_custom_search(self):
+    """'custom search' lists matching custom commands."""
+    bot_id = "UA1234567"
+    self.storage.add_command("panic", "breathe", "U123")
+    self.storage.add_command("pizza", "yum", "U123")
+
+    response = responses.create_response("screambot custom search breath", bot_id,
+                                         "testuser", "U123")
+    self.assertIn('*"panic"* → "breathe"', response)
+    self.assertNotIn("pizza", response)
+    response = responses.create_response("screambot custom search llama", bot_id,
+                                         "testuser", "U123")
+    self.assertEqual(response, 'No custom commands match "llama".')
+    response = responses.create_response("screambot custom search", bot_id, "testuser", "U123")
+    self.assertIn("What should I look for?", response)
+
+  def test_suggestions_escape_markup(self):
+    """A custom trigger suggested for a typo can't ping the channel."""
+    self.storage.add_command("<!channel> panic", "breathe", "U123")
+    response = responses.create_response("screambot <!channel> panik", "UA1234567",
+                                         "testuser", "U123")
+    self.assertIn("`&lt;!channel&gt; panic`", response)
+    self.assertNotIn("<!channel> panic`", response)
+
+  def test_custom_search_more(self):
+    """'...and more' only when there really are more."""
+    for i in range(10):
+      self.storage.add_command("pizza %d" % i, "yum", "U123")
+    response = responses.create_response("screambot custom search yum", "UA1234567",
+                                         "testuser", "U123")
+    self.assertNotIn("and more", response)
+    self.storage.add_command("pizza 10", "yum", "U123")
+    response = responses.create_response("screambot custom search yum", "UA1234567",
+                                         "testuser", "U123")
+    self.assertIn("and more", response)
+
+  def test_custom_search_escapes_markup(self):
+    """Search results can't ping the channel or break formatting."""
+    self.storage.add_command("alert `everyone`", "<!channel> look", "U123")
+    response = responses.create_response("screambot custom search alert", "UA1234567",
+                                         "testuser", "U123")
+    self.assertIn('*"alert \'everyone\'"* → "&lt;!channel&gt; look"', response)
+    self.assertNotIn("<!channel>", response)
+
+  def test_usage_counted(self):
+    """Every match counts toward its trigger's usage, cached or not."""
+    bot_id = "UA1234567"
+    self.storage.add_command("panic", "breathe $what", "U123")
+
+    for message in ["screambot panic", "screambot panic now", "screambot panic now",
+                    "screambot hug!", "screambot wibble"]:
+      responses.create_response(message, bot_id, "testuser", "U123")
+
+    usage = {(row["kind"], row["trigger"]): row["hits"] for row in self.storage.get_usage()}
+    self.assertEqual(usage, {("custom", "panic"): 3, ("standalone", "hug"): 1})
+
+  def test_batches_not_counted(self):
+    """create_responses is for backfills and replays, not real usage."""
+    self.storage.add_command("panic", "breathe", "U123")
+    messages = [("screambot panic", "U123"), ("screambot hug", "U123")]
+    self.assertEqual(list(responses.create_responses(messages, "UA1234567")),
+                     ["breathe", ":virtualhug:"])
+    self.assertEqual(self.storage.get_usage(), [])
+
   def test_command_case_insensitive(self):
     """Triggers should be case-insensitive."""
     bot_id = "UA1234567"
@@ -366,6 +595,11 @@ class TestCustomCommands(unittest.TestCase):
     # Should fall back to "don't know how to" message
     self.assertIn("don't know how to panic", response)
 
+  def test_unknown_command_suggests_custom_trigger(self):
+    self.storage.add_command("deadline panic", "breathe", "U123")
+    response = responses.create_response("screambot deadline panik", "UA1234567", "testuser", "U123")
+    self.assertIn("Did you mean `deadline panic`?", response)
+
   def test_nonexistent_custom_command(self):
     """Non-existent custom commands should fall through to normal handling."""
     bot_id = "UA1234567"
@@ -534,6 +768,43 @@ class TestCustomCommands(unittest.TestCase):
     )
     self.assertEqual(response2, "Take a breath!")
 
+  def test_custom_command_changes_invalidate_cache(self):
+    bot_id = "UA1234567"
+    self.storage.add_command("panic", "breathe", "U123")
+    self.assertEqual(responses.create_response("screambot panic", bot_id, "testuser", "U123"),
+                     "breathe")
+    self.storage.add_command("panic", "scream", "U123")
+    self.assertEqual(responses.create_response("screambot panic", bot_id, "testuser", "U123"),
+                     "scream")
+    self.storage.delete_command("panic", "U123")
+    self.assertIn("don't know how to panic",
+                  responses.create_response("screambot panic", bot_id, "testuser", "U123"))
+
+  def test_create_responses_uses_one_snapshot(self):
+    """Commands added during a batch don't change the rest of the batch."""
+    self.storage.add_command("panic", "breathe", "U123")
+    batch = responses.create_responses(
+      [("screambot panic", "U123"), ("screambot panic", "U123")], "UA1234567")
+
+    self.assertEqual(next(batch), "breathe")
+    self.storage.add_command("panic", "scream", "U123")
+    self.assertEqual(next(batch), "breathe")
+    self.assertEqual(responses.create_response("screambot panic", "UA1234567", "testuser", "U123"),
+                     "scream")
+
+  def test_create_responses_in_processes_uses_snapshot(self):
+    """Workers suggest and search from the batch's snapshot, however they start."""
+    self.storage.add_command("deadline panic", "breathe", "U123")
+    messages = [("screambot deadline panik", "U123"), ("screambot custom search breathe", "U123")]
+    serial = list(responses.create_responses(messages, "UA1234567", {"U123": "testuser"}))
+    self.assertIn("`deadline panic`", serial[0])
+    self.assertIn("deadline panic", serial[1])
+    for method in ("spawn", "fork"):
+      pooled = list(responses.create_responses(
+        messages, "UA1234567", {"U123": "testuser"}, processes=1,
+        mp_context=multiprocessing.get_context(method)))
+      self.assertEqual(pooled, serial, method)
+
   def test_custom_command_without_template_variable(self):
     """Test that commands work without $what in response."""
     bot_id = "UA1234567"
@@ -1,8 +1,43 @@
 #!/usr/bin/env python3
 
+import functools
+import multiprocessing
 import unittest
+from unittest import mock
 import os
-from storage import StorageManager
+import pickle
+import threading
+import time
+import sqlite3
+import storage
+from storage import (CommandConflictError, ConnectionPool, DatabaseWriter, MemoryStorage,
+                     StorageManager, create_storage)
+
+
+def _add_commands_in_child(db_path, count, ready, parent_count):
+  """Write and read commands from another process, like a second bot worker.
+
+  Exits non-zero if it reads back something wrong, or never sees all of
+  the parent's parent_count commands.
+  """
+  storage = StorageManager(db_path, coherence_interval=0)
+  ready.set()
+  for i in range(count):
+    storage.add_command("child %d" % i, "from the child", "U999")
+    if storage.get_command("child %d" % i) != "from the child":
+      raise SystemExit(1)
+  storage.delete_command("child 0", "U999")
+
+  # Keep reading until the parent has finished writing.
+  deadline = time.monotonic() + 30
+  while storage.get_command("parent %d" % (parent_count - 1)) is None:
+    if time.monotonic() > deadline:
+      raise SystemExit(2)
+    time.sleep(0.01)
+  seen = {trigger for trigger in storage.snapshot().commands if trigger.startswith("parent")}
+  storage.close()
+  if seen != {"parent %d" % i for i in range(parent_count)}:
+    raise SystemExit(3)
 
 class TestStorageManager(unittest.TestCase):
 
@@ -16,8 +51,9 @@ class TestStorageManager(unittest.TestCase):
   def tearDown(self):
     """Clean up test database."""
     self.storage.close()
-    if os.path.exists(self.test_db):
-      os.remove(self.test_db)
+    for path in (self.test_db, self.test_db + ".snapshot"):
+      if os.path.exists(path):
+        os.remove(path)
 
   def test_add_command(self):
     result = self.storage.add_command("panic", "take a breath", "U123")
@@ -26,6 +62,31 @@ class TestStorageManager(unittest.TestCase):
     response = self.storage.get_command("panic")
     self.assertEqual(response, "take a breath")
 
+  def test_add_command_reports_create_or_update(self):
+    self.assertEqual(self.storage.add_command("panic", "breathe", "U123"), "create")
+    self.assertEqual(self.storage.add_command("PANIC", "take a breath", "U456"), "update")
+    self.assertIsNone(self.storage.add_command("p", "too short", "U123"))
+
+  def test_concurrent_creates_audit_one_create(self):
+    other = StorageManager(self.test_db)
+    barrier = threading.Barrier(2)
+    results = []
+
+    def add(storage):
+      barrier.wait()
+      results.append(storage.add_command("panic", "breathe", "U123"))
+
+    threads = [threading.Thread(target=add, args=(storage,)) for storage in (self.storage, other)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    other.close()
+
+    self.assertEqual(sorted(results), ["create", "update"])
+    actions = [entry['action'] for entry in self.storage.get_audit_log()]
+    self.assertEqual(sorted(actions), ["create", "update"])
+
   def test_add_command_case_insensitive(self):
     self.storage.add_command("PANIC", "breathe", "U123")
 
@@ -166,5 +227,990 @@ class TestStorageManager(unittest.TestCase):
     audit_all = self.storage.get_audit_log(limit=100)
     self.assertEqual(len(audit_all), 5)
 
+  def test_match_command_exact(self):
+    self.storage.add_command("panic", "breathe", "U123")
+    self.assertEqual(self.storage.match_command("PANIC"), "breathe")
+    self.assertIsNone(self.storage.match_command("calm"))
+
+  def test_match_command_longest_prefix_wins(self):
+    self.storage.add_command("love", "love: $what", "U123")
+    self.storage.add_command("love it", "really love: $what", "U123")
+
+    self.assertEqual(self.storage.match_command("love cats"), "love: cats")
+    self.assertEqual(self.storage.match_command("love it so"), "really love: so")
+
+  def test_match_command_follows_updates_and_deletes(self):
+    self.storage.add_command("panic", "breathe", "U123")
+    self.storage.add_command("panic", "take a breath", "U456")
+    self.assertEqual(self.storage.match_command("panic"), "take a breath")
+
+    self.storage.delete_command("panic", "U456")
+    self.assertIsNone(self.storage.match_command("panic"))
+    self.assertIsNone(self.storage.match_command("panic now"))
+
+  def test_match_command_loads_existing_commands(self):
+    self.storage.add_command("panic", "breathe", "U123")
+    self.storage.close()
+
+    self.storage = StorageManager(self.test_db)
+    self.assertEqual(self.storage.match_command("panic"), "breathe")
+
+  def test_reads_served_from_snapshot(self):
+    self.storage.coherence_interval = None
+    self.storage.add_command("panic", "breathe", "U123")
+    snapshot = self.storage.snapshot()
+
+    # Change the table behind the cache's back: reads must not query SQLite.
+    self.storage._write(
+      lambda conn: conn.execute("UPDATE custom_commands SET response = 'changed'")).result()
+    self.assertEqual(self.storage.get_command("panic"), "breathe")
+    self.assertEqual(self.storage.list_all_commands()[0]['response'], "breathe")
+    self.assertIs(self.storage.snapshot(), snapshot)
+
+  def test_writes_bump_generation(self):
+    start = self.storage.generation
+    old = self.storage.snapshot()
+    self.storage.add_command("panic", "breathe", "U123")
+    self.storage.add_command("panic", "take a breath", "U123")
+    self.storage.delete_command("panic", "U123")
+    self.assertEqual(self.storage.generation, start + 3)
+
+    # Old snapshots never change.
+    self.assertEqual(old.commands, {})
+    self.storage.delete_command("nonexistent", "U123")
+    self.assertEqual(self.storage.generation, start + 3)
+
+  def test_suggest_commands_follows_writes(self):
+    self.storage.add_command("deadline panic", "breathe", "U123")
+    self.assertEqual(self.storage.suggest_commands("deadline panik")[0][0], "deadline panic")
+
+    self.storage.delete_command("deadline panic", "U123")
+    self.assertEqual(self.storage.suggest_commands("deadline panik"), [])
+
+  def test_sees_changes_from_other_connections(self):
+    self.storage.coherence_interval = 0
+    self.storage.add_command("panic", "breathe", "U123")
+    generation = self.storage.generation
+
+    # An UPDATE by hand bumps the change counter too.
+    self.storage._write(
+      lambda conn: conn.execute("UPDATE custom_commands SET response = 'changed'")).result()
+    self.assertEqual(self.storage.get_command("panic"), "changed")
+    self.assertEqual(self.storage.generation, generation + 1)
+
+  def test_sees_changes_from_other_processes(self):
+    self.storage.coherence_interval = 0
+    self.storage.add_command("panic", "breathe", "U123")
+
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    child = context.Process(target=_add_commands_in_child, args=(self.test_db, 50, ready, 50))
+    child.start()
+    self.assertTrue(ready.wait(30))
+
+    # Write and read while the child does the same; it waits for the
+    # last of these before it finishes, so the two always overlap.
+    overlapped = False
+    for i in range(50):
+      self.storage.add_command("parent %d" % i, "from the parent", "U123")
+      self.assertEqual(self.storage.get_command("parent %d" % i), "from the parent")
+      self.storage.match_command("child 1")
+      overlapped = overlapped or child.is_alive()
+    self.assertTrue(overlapped)
+    child.join(30)
+    self.assertEqual(child.exitcode, 0)
+
+    expected = ({"panic"} | {"parent %d" % i for i in range(50)} |
+                {"child %d" % i for i in range(1, 50)})
+    self.assertEqual(set(self.storage.snapshot().commands), expected)
+    self.assertEqual(self.storage.match_command("child 49"), "from the child")
+    self.assertEqual(self.storage.suggest_commands("chld 3")[0][0], "child 3")
+    conn = sqlite3.connect(self.test_db)
+    counter = conn.execute(
+      "SELECT value FROM change_counter WHERE name = 'custom_commands'").fetchone()[0]
+    conn.close()
+    self.assertEqual(self.storage.generation, counter)
+
+    # Local writes after a reload carry on from the shared counter.
+    self.storage.add_command("calm", "ok", "U123")
+    self.assertEqual(self.storage.generation, counter + 1)
+    self.assertEqual(self.storage.get_command("child 1"), "from the child")
+
+  def test_coherence_checks_are_throttled(self):
+    self.storage.coherence_interval = 3600
+    self.storage.get_command("warm up")
+    self.storage._write(lambda conn: conn.execute("""
+      INSERT INTO custom_commands (trigger, response, created_by)
+      VALUES ('panic', 'breathe', 'U123')
+    """)).result()
+    self.assertIsNone(self.storage.get_command("panic"))
+
+  def test_audit_pages(self):
+    # All in the same second, so only the id tells them apart.
+    for i in range(25):
+      self.storage.log_audit("create", "cmd%d" % i, "U%d" % (i % 2), "response")
+
+    seen = []
+    cursor = None
+    while True:
+      entries, cursor = self.storage.get_audit_page(10, cursor)
+      seen.extend(entry['trigger'] for entry in entries)
+      if cursor is None:
+        break
+    self.assertEqual(seen, ["cmd%d" % i for i in reversed(range(25))])
+
+  def test_audit_page_filters(self):
+    self.storage.add_command("panic", "breathe", "U123")
+    self.storage.add_command("panic", "scream", "U456")
+    self.storage.add_command("calm", "ok", "U456")
+    self.storage.delete_command("panic", "U456")
+
+    entries, cursor = self.storage.get_audit_page(10, trigger="panic")
+    self.assertEqual([entry['action'] for entry in entries], ["delete", "update", "create"])
+    self.assertIsNone(cursor)
+    entries, _ = self.storage.get_audit_page(10, user_id="U456", action="update")
+    self.assertEqual([entry['response'] for entry in entries], ["scream"])
+    with self.assertRaises(TypeError):
+      self.storage.get_audit_page(10, response="ok")
+
+  def test_iter_audit_log(self):
+    for i in range(30):
+      self.storage.log_audit("create" if i % 3 else "delete", "cmd%d" % i, "U123")
+    entries = list(self.storage.iter_audit_log(page_size=7))
+    self.assertEqual(len(entries), 30)
+    self.assertEqual(len({entry['id'] for entry in entries}), 30)
+    self.assertEqual(len(list(self.storage.iter_audit_log(page_size=4, action="delete"))), 10)
+
+  def test_audit_entries_survive_close(self):
+    for i in range(250):
+      self.storage.log_audit("create", "cmd%d" % i, "U123", "response")
+    self.storage.close()
+
+    self.storage = StorageManager(self.test_db)
+    self.assertEqual(len(self.storage.get_audit_log(limit=1000)), 250)
+
+  def test_import_commands(self):
+    counts = self.storage.import_commands(
+      [("panic", "breathe"), ("Hug", "hugs $what", "U777"), ("x", "too short"),
+       ("calm", "")], "U123", chunk_size=1)
+    self.assertEqual(counts, {"created": 2, "updated": 0, "skipped": 0, "invalid": 2})
+    self.assertEqual(self.storage.match_command("hug everyone"), "hugs everyone")
+    self.assertEqual(self.storage.get_command_creator("hug"), "U777")
+    self.assertEqual(self.storage.get_command_creator("panic"), "U123")
+    self.assertEqual(len(self.storage.get_audit_log()), 2)
+
+  def test_import_conflict_policies(self):
+    self.storage.add_command("panic", "breathe", "U123")
+
+    counts = self.storage.import_commands([("panic", "scream"), ("calm", "ok")], "U456")
+    self.assertEqual(counts["skipped"], 1)
+    self.assertEqual(self.storage.get_command("panic"), "breathe")
+
+    counts = self.storage.import_commands([("panic", "scream")], "U456", on_conflict="overwrite")
+    self.assertEqual(counts["updated"], 1)
+    self.assertEqual(self.storage.get_command("panic"), "scream")
+    self.assertEqual(self.storage.get_audit_log(limit=1)[0]['action'], "update")
+
+    with self.assertRaises(CommandConflictError):
+      self.storage.import_commands([("new one", "hi"), ("calm", "not ok")], "U456",
+                                   on_conflict="fail")
+    self.assertIsNone(self.storage.get_command("new one"))
+    self.assertEqual(self.storage.get_command("calm"), "ok")
+
+  def test_import_reads_input_outside_write_transactions(self):
+    started, resume = threading.Event(), threading.Event()
+
+    def commands():
+      yield ("panic", "breathe")
+      started.set()
+      resume.wait(10)
+      yield ("calm", "ok")
+
+    importer = threading.Thread(
+      target=self.storage.import_commands, args=(commands(), "U123"), kwargs={"chunk_size": 1})
+    importer.start()
+    self.assertTrue(started.wait(10))
+    # Other writes aren't held up while the import waits for its input.
+    self.assertEqual(self.storage.add_command_async("hug", "hugs", "U123").result(5), "create")
+    self.assertIsNone(self.storage.get_command("panic"))
+    resume.set()
+    importer.join(10)
+    self.assertEqual(self.storage.get_command("calm"), "ok")
+    self.assertEqual(self.storage.get_command("panic"), "breathe")
+
+  def test_import_conflicts_past_variable_limit(self):
+    self.storage.import_commands([("cmd%d" % i, "response") for i in range(1500)], "U123",
+                                 chunk_size=1500)
+    with self.assertRaises(CommandConflictError):
+      self.storage.import_commands([("cmd%d" % i, "other") for i in range(1500)], "U123",
+                                   chunk_size=1500, on_conflict="fail")
+    counts = self.storage.import_commands([("cmd%d" % i, "other") for i in range(1500)],
+                                          "U123", chunk_size=1500)
+    self.assertEqual(counts["skipped"], 1500)
+
+  def test_import_bumps_generation_once_published(self):
+    generation = self.storage.generation
+    self.storage.import_commands([("cmd%d" % i, "response") for i in range(50)], "U123",
+                                 chunk_size=7)
+    self.assertGreater(self.storage.generation, generation)
+    self.assertEqual(len(self.storage.list_all_commands()), 50)
+    self.assertEqual(self.storage.suggest_commands("cmd49")[0][0], "cmd49")
+
+  def test_iter_commands(self):
+    self.storage.add_command("zebra", "stripes", "U123")
+    self.storage.add_command("aardvark", "ants", "U123")
+    records = self.storage.iter_commands()
+    self.assertEqual(next(records).trigger, "aardvark")
+    self.assertEqual([record.trigger for record in records], ["zebra"])
+
+  def test_schema_version(self):
+    with self.storage._pool.connection() as conn:
+      self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0],
+                       storage.SCHEMA_VERSION)
+
+  def test_current_schema_skips_migrations(self):
+    self.storage.close()
+    with mock.patch.object(storage, "_migrate_step") as migrate_step:
+      self.storage = StorageManager(self.test_db)
+    migrate_step.assert_not_called()
+    # Nothing to write, so the writer hasn't even connected.
+    self.assertIsNone(self.storage._writer._conn)
+    self.assertEqual(self.storage.get_command("panic"), None)
+    self.storage.add_command("panic", "breathe", "U1")
+    self.assertIsNotNone(self.storage._writer._conn)
+
+  def test_interrupted_migration_resumes(self):
+    self.storage.close()
+    # Stopped partway through version 2: the page index and the trigger
+    # index are built, but the others aren't and user_version wasn't bumped.
+    conn = sqlite3.connect(self.test_db)
+    conn.executescript("""
+      DROP INDEX idx_audit_user_id;
+      DROP INDEX idx_audit_action;
+      PRAGMA user_version = 1;
+    """)
+    conn.close()
+
+    self.storage = StorageManager(self.test_db)
+    with self.storage._pool.connection() as conn:
+      self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0],
+                       storage.SCHEMA_VERSION)
+      indexes = {row[0]: row[1] for row in conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'audit_log'")}
+    for column in storage.AUDIT_FILTERS:
+      self.assertIn("timestamp", indexes[f"idx_audit_{column}"])
+    self.assertIn("idx_audit_page", indexes)
+
+  def test_migration_steps_are_idempotent(self):
+    self.storage.close()
+    conn = sqlite3.connect(self.test_db, isolation_level=None)
+    for steps in storage.MIGRATIONS:
+      for step in steps:
+        step(conn)
+    conn.close()
+    self.storage = StorageManager(self.test_db)
+    self.assertEqual(self.storage.add_command("calm", "ok", "U1"), "create")
+
+  def test_migrates_unversioned_database(self):
+    self.storage.close()
+    os.remove(self.test_db)
+    # The schema as it was before versioning.
+    conn = sqlite3.connect(self.test_db)
+    conn.executescript("""
+      CREATE TABLE custom_commands (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        trigger TEXT NOT NULL UNIQUE,
+        response TEXT NOT NULL,
+        created_by TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+      );
+      CREATE INDEX idx_trigger ON custom_commands(trigger);
+      CREATE TABLE audit_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        action TEXT NOT NULL,
+        trigger TEXT NOT NULL,
+        response TEXT,
+        user_id TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+      );
+      CREATE INDEX idx_audit_timestamp ON audit_log(timestamp DESC);
+      CREATE INDEX idx_audit_trigger ON audit_log(trigger);
+      INSERT INTO custom_commands (trigger, response, created_by) VALUES ('panic', 'breathe', 'U1');
+    """)
+    conn.close()
+
+    self.storage = StorageManager(self.test_db)
+    self.assertEqual(self.storage.get_command("panic"), "breathe")
+    with self.storage._pool.connection() as conn:
+      self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0],
+                       storage.SCHEMA_VERSION)
+      indexes = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'audit_log'")}
+    self.assertIn("idx_audit_page", indexes)
+    self.assertNotIn("idx_audit_timestamp", indexes)
+    self.assertEqual(self.storage.add_command("calm", "ok", "U1"), "create")
+
+  def test_default_profile(self):
+    self.assertEqual(self.storage.profile, "balanced")
+    self.assertEqual(self.storage.pragmas["journal_mode"], "wal")
+    self.assertEqual(self.storage.pragmas["synchronous"], 1)
+
+  def test_profile_from_environment(self):
+    os.environ["SCREAMBOT_DB_PROFILE"] = "durable"
+    try:
+      storage = StorageManager(self.test_db)
+    finally:
+      del os.environ["SCREAMBOT_DB_PROFILE"]
+    self.assertEqual(storage.profile, "durable")
+    self.assertEqual(storage.pragmas["synchronous"], 2)
+    # Every connection gets the profile, not just the first.
+    conn = storage._connect()
+    self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 2)
+    conn.close()
+    storage.close()
+
+  def test_unknown_profile(self):
+    with self.assertRaises(ValueError):
+      StorageManager(self.test_db, profile="reckless")
+
+  def test_reads_are_read_only(self):
+    with self.storage._pool.connection() as conn:
+      with self.assertRaises(sqlite3.OperationalError):
+        conn.execute("DELETE FROM custom_commands")
+
+  def test_burst_of_writes_from_many_threads(self):
+    futures = []
+
+    def submit(worker):
+      for i in range(20):
+        futures.append(self.storage.add_command_async("cmd %d %d" % (worker, i), "ok", "U123"))
+
+    threads = [threading.Thread(target=submit, args=(worker,)) for worker in range(10)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual({future.result() for future in futures}, {"create"})
+    self.assertEqual(len(self.storage.list_all_commands()), 200)
+    self.assertTrue(self.storage.delete_command_async("cmd 0 0", "U123").result())
+    self.assertEqual(self.storage.generation, 201)
+
+  def test_connections_are_pooled(self):
+    def read():
+      for _ in range(20):
+        self.storage.get_audit_log()
+
+    threads = [threading.Thread(target=read) for _ in range(20)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    stats = self.storage.connection_stats()
+    self.assertLessEqual(stats["open"], stats["max_size"])
+    self.assertEqual(stats["in_use"], 0)
+
+    self.storage.close()
+    self.assertEqual(self.storage.connection_stats()["open"], 0)
+
+  def _stored_usage(self):
+    with self.storage._pool.connection() as conn:
+      return {(row[0], row[1]): row[2] for row in conn.execute(
+        "SELECT kind, trigger, hits FROM trigger_usage")}
+
+  def test_usage_is_buffered(self):
+    for _ in range(100):
+      self.storage.record_usage("custom", "panic")
+    self.storage.record_usage("standalone", "hug")
+    self.assertEqual(self._stored_usage(), {})
+
+    with mock.patch.object(self.storage._writer, "_write_entries") as write_entries:
+      self.assertEqual(self.storage.flush_usage(), 2)
+    write_entries.assert_not_called()
+    self.assertEqual(self._stored_usage(), {("custom", "panic"): 100, ("standalone", "hug"): 1})
+
+  def test_usage_adds_up_across_flushes(self):
+    self.storage.record_usage("custom", "panic")
+    self.storage.flush_usage()
+    self.storage.record_usage("custom", "panic")
+    self.storage.record_usage("custom", "calm")
+    usage = self.storage.get_usage("custom")
+    self.assertEqual([(row["trigger"], row["hits"]) for row in usage],
+                     [("panic", 2), ("calm", 1)])
+    self.assertTrue(usage[0]["last_used"])
+    self.assertEqual(self.storage.get_usage("standalone"), [])
+
+  def test_usage_flushed_periodically(self):
+    self.storage.usage_flush_interval = 0
+    self.storage.record_usage("custom", "panic")
+    # Runs after the write record_usage queued.
+    self.storage._writer.execute(lambda conn: None)
+    self.assertEqual(self._stored_usage(), {("custom", "panic"): 1})
+
+  def test_idle_connections_closed_while_idle(self):
+    self._reopen(pool_idle_timeout=0.05, maintenance_interval=0.01)
+    self.storage.get_audit_log()
+    for _ in range(500):
+      if self.storage.connection_stats()["open"] == 0:
+        break
+      time.sleep(0.01)
+    self.assertEqual(self.storage.connection_stats()["open"], 0)
+    self.assertEqual(self.storage.get_audit_log(), [])
+
+  def test_usage_flushed_while_idle(self):
+    self._reopen(usage_flush_interval=0.05, maintenance_interval=0.01)
+    self.storage.record_usage("custom", "panic")
+    self.storage.record_usage("custom", "panic")
+    # However the two were split, nothing else comes to write the last.
+    for _ in range(500):
+      if self._stored_usage() == {("custom", "panic"): 2}:
+        break
+      time.sleep(0.01)
+    self.assertEqual(self._stored_usage(), {("custom", "panic"): 2})
+
+  def test_usage_survives_close(self):
+    self.storage.record_usage("contain", "pizza")
+    self.storage.close()
+
+    self.storage = StorageManager(self.test_db)
+    self.assertEqual(self._stored_usage(), {("contain", "pizza"): 1})
+
+  def test_search_follows_updates_and_deletes(self):
+    self.storage.add_command("panic", "breathe slowly", "U123")
+    self.storage.add_command("calm", "breathe", "U123")
+    self.assertEqual(len(self.storage.search_commands("breathe")[0]), 2)
+    self.storage.add_command("calm", "relax", "U123")
+    self.storage.delete_command("panic", "U123")
+    self.assertEqual(self.storage.search_commands("breathe"), ([], None))
+    self.assertEqual([command["trigger"] for command in self.storage.search_commands("rel")[0]],
+                     ["calm"])
+
+  def test_search_pages(self):
+    self.storage.import_commands((("cmd %d" % i, "pizza %d" % i) for i in range(25)), "U123")
+    found, cursor = self.storage.search_commands("pizza", limit=10)
+    triggers = [command["trigger"] for command in found]
+    while cursor is not None:
+      found, cursor = self.storage.search_commands("pizza", limit=10, cursor=cursor)
+      triggers += [command["trigger"] for command in found]
+    self.assertEqual(sorted(triggers), sorted("cmd %d" % i for i in range(25)))
+
+  def test_search_ignores_query_syntax(self):
+    self.storage.add_command("panic", "breathe", "U123")
+    self.assertEqual(len(self.storage.search_commands('"pan* (:')[0]), 1)
+    self.assertEqual(self.storage.search_commands("?!"), ([], None))
+
+  def test_search_indexes_existing_rows(self):
+    self.storage.add_command("panic", "breathe", "U123")
+    self.storage.close()
+    self._remove_search()
+
+    self.storage = StorageManager(self.test_db)
+    self.assertTrue(self.storage.wait_for_search_index(10))
+    self.assertEqual(len(self.storage.search_commands("breathe")[0]), 1)
+    self.assertEqual(len(self.storage.search_audit_log("breathe")[0]), 1)
+
+  def _remove_search(self):
+    """Take the database back to how it was before search."""
+    conn = sqlite3.connect(self.test_db)
+    conn.executescript("""
+      DROP TRIGGER custom_commands_insert_search;
+      DROP TRIGGER custom_commands_delete_search;
+      DROP TRIGGER custom_commands_update_search;
+      DROP TRIGGER audit_log_insert_search;
+      DROP TRIGGER audit_log_delete_search;
+      DROP TABLE commands_search;
+      DROP TABLE audit_search;
+      DROP TABLE search_backfill;
+      PRAGMA user_version = 4;
+    """)
+    conn.close()
+
+  def test_search_backfill_resumes(self):
+    for i in range(10):
+      self.storage.add_command(f"old {i}", f"response {i}", "U123")
+    self.storage.close()
+    self._remove_search()
+
+    # Index one chunk of the commands, then stop as if the bot had restarted.
+    with mock.patch.object(StorageManager, "_search_backfill_pending", return_value=False):
+      self.storage = StorageManager(self.test_db)
+    self.storage._writer.execute(functools.partial(storage._backfill_search_chunk, chunk_size=3))
+    # While old rows wait to be indexed, changing them leaves the index alone.
+    self.storage.delete_command("old 9", "U123")
+    self.storage.add_command("old 8", "changed", "U123")
+    self.storage.add_command("new", "response new", "U123")
+    found = [c["trigger"] for c in self.storage.search_commands("response")[0]]
+    self.assertEqual(found, ["new", "old 0", "old 1", "old 2"])
+    self.storage.close()
+
+    self.storage = StorageManager(self.test_db)
+    self.assertTrue(self.storage.wait_for_search_index(10))
+    found = [c["trigger"] for c in self.storage.search_commands("response")[0]]
+    self.assertEqual(found, ["new"] + [f"old {i}" for i in range(8)])
+    self.assertEqual([c["trigger"] for c in self.storage.search_commands("changed")[0]],
+                     ["old 8"])
+    self.storage.close()
+    conn = sqlite3.connect(self.test_db)
+    self.assertEqual(conn.execute("SELECT COUNT(*) FROM search_backfill").fetchone()[0], 0)
+    # Raises if the index doesn't match the commands.
+    conn.execute("INSERT INTO commands_search (commands_search) VALUES ('integrity-check')")
+    conn.close()
+    self.storage = StorageManager(self.test_db)
+
+  def _reopen(self, **kwargs):
+    self.storage.close()
+    self.storage = StorageManager(self.test_db, **kwargs)
+
+  def test_warm_start_from_snapshot(self):
+    snapshot_path = self.test_db + ".snapshot"
+    self._reopen(snapshot_path=snapshot_path)
+    self.storage.add_command("panic", "breathe $what", "U123")
+    self.storage.add_command("calm", "ok", "U123")
+    generation = self.storage.generation
+    self.storage.close()
+    self.assertTrue(os.path.exists(snapshot_path))
+
+    with mock.patch.object(StorageManager, "_load_snapshot") as load_snapshot:
+      self.storage = StorageManager(self.test_db, snapshot_path=snapshot_path)
+    load_snapshot.assert_not_called()
+    self.assertEqual(self.storage.generation, generation)
+    self.assertEqual(self.storage.match_command("panic now"), "breathe now")
+    self.assertEqual(self.storage.get_command_creator("calm"), "U123")
+    self.assertEqual(self.storage.suggest_commands("panik")[0][0], "panic")
+    self.assertEqual(self.storage.add_command("hug", "squeeze", "U123"), "create")
+    self.assertEqual(self.storage.suggest_commands("hugg")[0][0], "hug")
+
+  def test_snapshot_saved_while_running(self):
+    snapshot_path = self.test_db + ".snapshot"
+    self._reopen(snapshot_path=snapshot_path, snapshot_save_interval=0,
+                 maintenance_interval=0.01)
+    self.storage.add_command("panic", "breathe", "U123")
+    generation = self.storage.generation
+    for _ in range(500):
+      if self.storage._saved_generation == generation:
+        break
+      time.sleep(0.01)
+
+    # As if the bot were killed without closing.
+    with mock.patch.object(StorageManager, "_load_snapshot") as load_snapshot:
+      other = StorageManager(self.test_db, snapshot_path=snapshot_path)
+    load_snapshot.assert_not_called()
+    self.assertEqual(other.get_command("panic"), "breathe")
+    other.close()
+
+  def test_stale_snapshot_is_rebuilt(self):
+    snapshot_path = self.test_db + ".snapshot"
+    self._reopen(snapshot_path=snapshot_path)
+    self.storage.add_command("panic", "breathe", "U123")
+    # Changed without the snapshot being saved.
+    self._reopen()
+    self.storage.add_command("calm", "ok", "U123")
+
+    self._reopen(snapshot_path=snapshot_path)
+    self.assertEqual(self.storage.get_command("calm"), "ok")
+    self.assertEqual(self.storage.get_command("panic"), "breathe")
+
+  def test_snapshot_from_another_database_is_rebuilt(self):
+    snapshot_path = self.test_db + ".snapshot"
+    self._reopen(snapshot_path=snapshot_path)
+    self.storage.add_command("panic", "breathe", "U123")
+    self.storage.close()
+    # A new database at the same generation.
+    os.remove(self.test_db)
+    self.storage = StorageManager(self.test_db)
+    self.storage.add_command("calm", "ok", "U123")
+
+    self._reopen(snapshot_path=snapshot_path)
+    self.assertIsNone(self.storage.get_command("panic"))
+    self.assertEqual(self.storage.get_command("calm"), "ok")
+
+  def test_unreadable_snapshot_is_rebuilt(self):
+    snapshot_path = self.test_db + ".snapshot"
+    self.storage.add_command("panic", "breathe", "U123")
+    with open(snapshot_path, "wb") as f:
+      f.write(b"not a snapshot")
+
+    self._reopen(snapshot_path=snapshot_path)
+    self.assertEqual(self.storage.get_command("panic"), "breathe")
+
+  def test_snapshot_from_other_code_is_rebuilt(self):
+    snapshot_path = self.test_db + ".snapshot"
+    self._reopen(snapshot_path=snapshot_path)
+    self.storage.add_command("panic", "breathe", "U123")
+    self.storage.close()
+
+    with mock.patch.object(storage, "_code_fingerprint", return_value="changed"), \
+         mock.patch.object(StorageManager, "_load_snapshot", autospec=True,
+                           side_effect=StorageManager._load_snapshot) as load_snapshot:
+      self.storage = StorageManager(self.test_db, snapshot_path=snapshot_path)
+    load_snapshot.assert_called_once()
+
+  def test_snapshot_only_loads_its_own_classes(self):
+    snapshot_path = self.test_db + ".snapshot"
+    self.storage.add_command("panic", "breathe", "U123")
+    marker = self.test_db + ".unpickled"
+    with open(snapshot_path, "wb") as f:
+      pickle.dump(_Unpickled(marker), f)
+
+    self._reopen(snapshot_path=snapshot_path)
+    self.assertFalse(os.path.exists(marker))
+    self.assertEqual(self.storage.get_command("panic"), "breathe")
+
+
+class _Unpickled:
+  """Creates a file when it's unpickled."""
+
+  def __init__(self, path):
+    self.path = path
+
+  def __reduce__(self):
+    return open, (self.path, "w")
+
+
+class TestConnectionPool(unittest.TestCase):
+
+  def setUp(self):
+    self.opened = []
+
+  def connect(self):
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    self.opened.append(conn)
+    return conn
+
+  def test_reuses_connections(self):
+    pool = ConnectionPool(self.connect, max_size=2)
+    with pool.connection() as first:
+      pass
+    with pool.connection() as second:
+      self.assertIs(first, second)
+    self.assertEqual(len(self.opened), 1)
+    self.assertEqual(pool.stats(), {"open": 1, "idle": 1, "in_use": 0, "max_size": 2})
+
+  def test_bounded(self):
+    pool = ConnectionPool(self.connect, max_size=2, timeout=0.05)
+    first = pool.checkout()
+    second = pool.checkout()
+    self.assertEqual(pool.open_count, 2)
+    with self.assertRaises(TimeoutError):
+      pool.checkout()
+
+    # A waiting thread gets the next connection returned.
+    got = []
+    pool.timeout = 5
+    waiter = threading.Thread(target=lambda: got.append(pool.checkout()))
+    waiter.start()
+    pool.checkin(first)
+    waiter.join()
+    self.assertEqual(got, [first])
+    pool.checkin(second)
+    pool.checkin(first)
+
+  def test_reaps_idle_connections(self):
+    pool = ConnectionPool(self.connect, max_size=4, idle_timeout=0)
+    with pool.connection():
+      pass
+    pool.reap()
+    self.assertEqual(pool.open_count, 0)
+    self.assertEqual(pool.idle_count, 0)
+    with self.assertRaises(sqlite3.ProgrammingError):
+      self.opened[0].execute("SELECT 1")
+
+  def test_close_closes_everything(self):
+    pool = ConnectionPool(self.connect, max_size=4)
+    busy = pool.checkout()
+    with pool.connection():
+      pass
+    pool.close()
+    self.assertEqual(pool.open_count, 1)
+    pool.checkin(busy)
+    self.assertEqual(pool.open_count, 0)
+    for conn in self.opened:
+      with self.assertRaises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+    with self.assertRaises(sqlite3.ProgrammingError):
+      pool.checkout()
+
+
+class TestDatabaseWriter(unittest.TestCase):
+
+  def setUp(self):
+    self.batches = []
+    self.release = threading.Event()
+    self.release.set()
+    self.writer = None
+
+  def tearDown(self):
+    self.release.set()
+    if self.writer:
+      self.writer.close()
+
+  def make_writer(self, **kwargs):
+    def connect():
+      conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+      conn.execute("CREATE TABLE things (name TEXT UNIQUE)")
+      return conn
+    self.writer = DatabaseWriter(connect, self.write_entries, **kwargs)
+    return self.writer
+
+  def write_entries(self, conn, entries):
+    self.release.wait()
+    self.batches.append(list(entries))
+
+  def test_batches_entries(self):
+    writer = self.make_writer(batch_size=10, flush_interval=60)
+    self.release.clear()
+    for i in range(25):
+      writer.log(i)
+    self.release.set()
+    writer.close()
+    self.assertEqual([entry for batch in self.batches for entry in batch], list(range(25)))
+    self.assertLess(len(self.batches), 25)
+    self.assertEqual(writer.written, 25)
+
+  def test_flushes_after_interval(self):
+    writer = self.make_writer(batch_size=100, flush_interval=0.01)
+    writer.log("entry")
+    for _ in range(500):
+      if self.batches:
+        break
+      threading.Event().wait(0.01)
+    self.assertEqual(self.batches, [["entry"]])
+
+  def test_flush_waits_for_write(self):
+    writer = self.make_writer(batch_size=100, flush_interval=60)
+    writer.log("entry")
+    writer.flush()
+    self.assertEqual(self.batches, [["entry"]])
+
+  def test_drop_when_full(self):
+    self.release.clear()
+    writer = self.make_writer(maxsize=1, batch_size=1, when_full="drop")
+    for i in range(10):
+      writer.log(i)
+    self.assertGreater(writer.dropped, 0)
+    self.release.set()
+    writer.close()
+    self.assertEqual(writer.written + writer.dropped, 10)
+
+  def test_close_with_full_queue(self):
+    self.release.clear()
+    writer = self.make_writer(maxsize=1, batch_size=1)
+    # One entry being written, one filling the queue.
+    writer.log(0)
+    writer.log(1)
+    # close() waits for room for its stop marker while the writer works.
+    closer = threading.Thread(target=writer.close)
+    closer.start()
+    closer.join(0.1)
+    self.release.set()
+    closer.join(10)
+    self.assertFalse(closer.is_alive())
+    self.assertEqual(self.batches, [[0], [1]])
+
+  def test_rejects_unknown_policy(self):
+    with self.assertRaises(ValueError):
+      self.make_writer(when_full="panic")
+
+  def test_operations_run_in_order(self):
+    writer = self.make_writer()
+    committed = []
+
+    def insert(name):
+      return writer.submit(
+        lambda conn: conn.execute("INSERT INTO things VALUES (?)", (name,)).lastrowid,
+        on_commit=committed.append)
+
+    futures = [insert("thing %d" % i) for i in range(20)]
+    self.assertEqual([future.result() for future in futures], list(range(1, 21)))
+    self.assertEqual(committed, list(range(1, 21)))
+
+  def test_failed_operation_leaves_others_alone(self):
+    writer = self.make_writer()
+    self.release.clear()
+    writer.log("hold the thread up")
+    first = writer.submit(lambda conn: conn.execute("INSERT INTO things VALUES ('a')"))
+    duplicate = writer.submit(lambda conn: conn.execute("INSERT INTO things VALUES ('a')"))
+    last = writer.submit(lambda conn: conn.execute("INSERT INTO things VALUES ('b')"))
+    self.release.set()
+
+    first.result()
+    last.result()
+    with self.assertRaises(sqlite3.IntegrityError):
+      duplicate.result()
+    count = writer.execute(lambda conn: conn.execute("SELECT COUNT(*) FROM things").fetchone())
+    self.assertEqual(count[0], 2)
+
+  def test_submit_after_close(self):
+    writer = self.make_writer()
+    writer.close()
+    with self.assertRaises(sqlite3.ProgrammingError):
+      writer.submit(lambda conn: None)
+
+  def test_submit_racing_close_never_hangs(self):
+    writer = self.make_writer()
+    futures = []
+    start = threading.Barrier(9)
+
+    def submit():
+      start.wait()
+      for _ in range(200):
+        try:
+          futures.append(writer.submit(lambda conn: None))
+        except sqlite3.ProgrammingError:
+          return
+
+    threads = [threading.Thread(target=submit) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    start.wait()
+    writer.close()
+    for thread in threads:
+      thread.join()
+    for future in futures:
+      self.assertIsNone(future.result(timeout=5))
+
+  def test_flush_without_entries_does_not_write(self):
+    writer = self.make_writer()
+    with mock.patch.object(writer, "execute") as execute:
+      writer.flush()
+    execute.assert_not_called()
+    writer.log("entry")
+    writer.flush()
+    self.assertEqual(self.batches, [["entry"]])
+    with mock.patch.object(writer, "execute") as execute:
+      writer.flush()
+    execute.assert_not_called()
+
+class StorageBackendContract:
+  """Behaviour every storage backend shares. Subclasses set backend."""
+
+  backend = None
+
+  def setUp(self):
+    self.storage = create_storage(self.backend)
+
+  def tearDown(self):
+    self.storage.close()
+
+  def test_commands(self):
+    self.assertEqual(self.storage.add_command("Panic", "breathe $what", "U123"), "create")
+    self.assertEqual(self.storage.add_command_async("panic", "scream $what", "U456").result(),
+                     "update")
+    self.assertEqual(self.storage.get_command("PANIC"), "scream $what")
+    self.assertEqual(self.storage.get_command_creator("panic"), "U123")
+    self.assertEqual(self.storage.match_command("panic now"), "scream now")
+    self.assertEqual(self.storage.command_snapshot().match("panic now"), "scream now")
+    self.assertEqual(self.storage.suggest_commands("panik")[0][0], "panic")
+    self.assertEqual([record.trigger for record in self.storage.iter_commands()], ["panic"])
+    self.assertEqual(self.storage.list_all_commands()[0]["response"], "scream $what")
+    self.assertTrue(self.storage.delete_command("panic", "U123"))
+    self.assertFalse(self.storage.delete_command_async("panic", "U123").result())
+    self.assertIsNone(self.storage.get_command("panic"))
+    self.assertIsNone(self.storage.add_command("x", "too short", "U123"))
+
+  def test_change_feed(self):
+    start = self.storage.generation
+    old = self.storage.snapshot()
+    self.storage.add_command("panic", "breathe", "U123")
+    self.storage.delete_command("panic", "U123")
+    self.assertEqual(self.storage.generation, start + 2)
+    self.assertEqual(old.commands, {})
+    self.assertEqual(self.storage.snapshot().generation, start + 2)
+
+  def test_import(self):
+    self.storage.add_command("panic", "breathe", "U123")
+    counts = self.storage.import_commands([("panic", "scream"), ("calm", "ok"), ("x", "no"),
+                                           (None, "no"), ("number", 7)], "U456")
+    self.assertEqual(counts, {"created": 1, "updated": 0, "skipped": 1, "invalid": 3})
+    with self.assertRaises(CommandConflictError):
+      self.storage.import_commands([("new", "hi"), ("calm", "no")], "U456", on_conflict="fail")
+    self.assertIsNone(self.storage.get_command("new"))
+
+  def test_audit(self):
+    self.storage.add_command("panic", "breathe", "U123")
+    self.storage.add_command("panic", "scream", "U456")
+    self.storage.delete_command("panic", "U456")
+    self.storage.log_audit("create", "other", "U123", "hi")
+
+    self.assertEqual([entry["action"] for entry in self.storage.get_audit_log()],
+                     ["create", "delete", "update", "create"])
+    entries, cursor = self.storage.get_audit_page(2, user_id="U456")
+    self.assertEqual([entry["action"] for entry in entries], ["delete", "update"])
+    self.assertEqual(self.storage.get_audit_page(2, cursor, user_id="U456"), ([], None))
+    self.assertEqual(len(list(self.storage.iter_audit_log(page_size=1, trigger="panic"))), 3)
+
+  def test_flush(self):
+    for i in range(20):
+      self.storage.log_audit("create", "cmd%d" % i, "U123", "hi")
+    self.storage.flush()
+    self.assertEqual(len(self.storage.get_audit_log()), 20)
+
+  def test_usage(self):
+    for trigger in ("panic", "calm", "panic", "panic"):
+      self.storage.record_usage("custom", trigger)
+    for _ in range(2):
+      self.storage.record_usage("standalone", "hug")
+    self.assertEqual([(row["kind"], row["trigger"], row["hits"])
+                      for row in self.storage.get_usage()],
+                     [("custom", "panic", 3), ("standalone", "hug", 2), ("custom", "calm", 1)])
+    self.assertEqual(len(self.storage.get_usage("custom", limit=1)), 1)
+
+  def test_search(self):
+    self.storage.add_command("panic", "breathe $what", "U123")
+    self.storage.add_command("pizza party", "yum", "U123")
+    self.storage.add_command("calm", "breathe", "U456")
+    self.storage.delete_command("calm", "U456")
+
+    found, cursor = self.storage.search_commands("BREATH")
+    self.assertEqual([command["trigger"] for command in found], ["panic"])
+    self.assertIsNone(cursor)
+    self.assertEqual(found[0]["created_by"], "U123")
+    self.assertEqual(len(self.storage.search_commands("pa")[0]), 2)
+    found, cursor = self.storage.search_commands("pa", limit=1)
+    self.assertEqual(len(self.storage.search_commands("pa", 1, cursor)[0]), 1)
+    self.assertEqual(self.storage.search_commands("pizza yum")[0][0]["trigger"], "pizza party")
+    self.assertEqual(self.storage.search_commands("pizza breathe"), ([], None))
+
+    entries, cursor = self.storage.search_audit_log("breathe", limit=2)
+    self.assertEqual([(entry["action"], entry["trigger"]) for entry in entries],
+                     [("delete", "calm"), ("create", "calm")])
+    self.assertEqual([entry["trigger"] for entry in self.storage.search_audit_log(
+      "breathe", 2, cursor)[0]], ["panic"])
+
+  def test_search_pages_by_trigger(self):
+    for trigger in ("pizza c", "pizza a", "pizza d", "pizza b"):
+      self.storage.add_command(trigger, "yum", "U123")
+    pages = []
+    found, cursor = self.storage.search_commands("yum", limit=2)
+    pages.append([command["trigger"] for command in found])
+    while cursor is not None:
+      found, cursor = self.storage.search_commands("yum", limit=2, cursor=cursor)
+      pages.append([command["trigger"] for command in found])
+    # Exactly a page left is the last page, not a hint of more.
+    self.assertEqual(pages, [["pizza a", "pizza b"], ["pizza c", "pizza d"]])
+    self.assertEqual(self.storage.search_audit_log("yum", limit=4)[1], None)
+
+
+class TestMemoryStorage(StorageBackendContract, unittest.TestCase):
+  backend = "memory"
+
+  def test_is_memory_storage(self):
+    self.assertIsInstance(self.storage, MemoryStorage)
+
+
+class TestSQLiteMemoryStorage(StorageBackendContract, unittest.TestCase):
+  backend = "sqlite-memory"
+
+  def test_databases_are_private(self):
+    other = create_storage(self.backend)
+    self.storage.add_command("panic", "breathe", "U123")
+    self.assertIsNone(other.get_command("panic"))
+    other.close()
+
+  def test_unknown_backend(self):
+    with self.assertRaises(ValueError):
+      create_storage("floppy")
+
+
 if __name__ == '__main__':
   unittest.main()
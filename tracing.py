@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Per-stage timing and match tracing for direct commands.
+
+Turn it on with responses.set_tracer(sink). Every direct command then
+produces a Trace, which is passed to sink.record(). When no tracer is set,
+the matcher only pays for a few "is None" checks.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+# Order the matcher tries things in, for reports.
+STAGES = ["cache", "custom", "standalone", "standalone_stripped", "emoji", "starters",
+          "contain"]
+
+
+class Trace:
+  """Timings and result for matching one command."""
+
+  __slots__ = ("command", "stages", "table", "key", "_last")
+
+  def __init__(self, command):
+    self.command = command
+    # (stage name, seconds) in the order the stages ran.
+    self.stages = []
+    # Which rule answered, e.g. ("starter", "hate ").
+    self.table = None
+    self.key = None
+    self._last = time.perf_counter()
+
+  def mark(self, stage):
+    """Record that stage just finished."""
+    now = time.perf_counter()
+    self.stages.append((stage, now - self._last))
+    self._last = now
+
+  @property
+  def total(self):
+    """Seconds spent across all stages."""
+    return sum(seconds for _, seconds in self.stages)
+
+
+class CallbackSink:
+  """Passes every trace to a function."""
+
+  def __init__(self, callback):
+    self.callback = callback
+
+  def record(self, trace):
+    self.callback(trace)
+
+
+class LogSink:
+  """Logs one line per trace."""
+
+  def __init__(self, logger=None, level=logging.DEBUG):
+    self.logger = logger or logging.getLogger("screambot.trace")
+    self.level = level
+
+  def record(self, trace):
+    if not self.logger.isEnabledFor(self.level):
+      return
+    timings = " ".join("%s=%.1fus" % (stage, seconds * 1e6) for stage, seconds in trace.stages)
+    self.logger.log(self.level, "matched table=%s key=%r %s", trace.table, trace.key, timings)
+
+
+class HistogramSink:
+  """Keeps latency histograms per stage and hits per rule, in memory.
+
+  Latencies go into power-of-two microsecond buckets, so memory use is
+  fixed however much traffic is recorded.
+  """
+
+  BUCKETS = 24  # Up to about 8 seconds.
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.stage_counts = collections.defaultdict(lambda: [0] * self.BUCKETS)
+    self.stage_totals = collections.Counter()
+    self.rule_hits = collections.Counter()
+    self.rule_seconds = collections.Counter()
+
+  def record(self, trace):
+    with self._lock:
+      for stage, seconds in trace.stages:
+        bucket = min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)
+        self.stage_counts[stage][bucket] += 1
+        self.stage_totals[stage] += seconds
+      rule = (trace.table, trace.key)
+      self.rule_hits[rule] += 1
+      self.rule_seconds[rule] += trace.total
+
+  def percentile(self, stage, fraction):
+    """Approximate latency percentile for a stage, in microseconds.
+
+    Returns the upper bound of the bucket holding the percentile, or None
+    if the stage was never recorded.
+    """
+    counts = self.stage_counts.get(stage)
+    if not counts:
+      return None
+    target = fraction * sum(counts)
+    seen = 0
+    for bucket, count in enumerate(counts):
+      seen += count
+      if count and seen >= target:
+        return float(1 << bucket)
+    return float(1 << (self.BUCKETS - 1))
+
+  def slowest_rules(self, count=10):
+    """Return [((table, key), mean microseconds)] for the slowest rules."""
+    means = [(rule, self.rule_seconds[rule] * 1e6 / hits)
+             for rule, hits in self.rule_hits.items()]
+    return sorted(means, key=lambda item: -item[1])[:count]
+
+  def dead_rules(self, rules):
+    """Return the rules, as (table, key) pairs, that never matched."""
+    return [rule for rule in rules if rule not in self.rule_hits]
+
+  def summary(self):
+    """Dict of per-stage count, mean, p50 and p99 in microseconds."""
+    report = {}
+    for stage in sorted(self.stage_counts, key=lambda s: STAGES.index(s) if s in STAGES else 99):
+      count = sum(self.stage_counts[stage])
+      report[stage] = {
+        "count": count,
+        "mean_us": self.stage_totals[stage] * 1e6 / count,
+        "p50_us": self.percentile(stage, 0.50),
+        "p99_us": self.percentile(stage, 0.99),
+      }
+    return report